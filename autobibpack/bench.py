@@ -0,0 +1,276 @@
+'''Benchmark the discovery, stats and date collation hot paths.
+
+Each scenario is a fixed piece of work against a local stub Solr made
+from a seeded corpus, with a latency added to every request. The work
+is done in a fresh python process so its peak memory is its own, not
+that of the stub or of scenarios run before it. For each scenario the
+requests sent, wall time, peak RSS and items per second are recorded.
+
+The scenarios
+=============
+list_10k, list_100k, list_1m  auto_list_ids for every item of a corpus
+vidcount_5k                   ViewsAndDownloads.run, stats from the stub
+dates_1y, dates_20y           DateLoader.fetch_stats with the facet query
+dates_1y_days                 DateLoader.fetch_stats with a query per day
+format_50y                    StatMake output of 50 years to plain and gzip
+
+Running the benchmarks
+======================
+python bench.py                       # every scenario except list_1m
+python bench.py list_100k dates_20y   # just these
+python bench.py --latency 0.02        # with 20ms added to each request
+python bench.py --repeat 3            # keep the fastest of three runs
+python bench.py --save base.json      # keep the results as a baseline
+python bench.py --baseline base.json  # compare with a saved baseline
+
+The results are printed as JSON. With a baseline, a table comparing the
+two is also printed and the exit status is 1 if any scenario got worse
+by more than the tolerance.
+'''
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import resource
+import platform
+import tempfile
+import argparse
+import subprocess
+
+import stubsolr
+
+LATENCY = 0.005 # Seconds added to every request by the stub.
+TOLERANCE = 0.10 # Share a scenario may get worse by before it is reported.
+END_YEAR = 2013 # The last year of the corpora with dates.
+# key = name, value = (kind of work, settings)
+SCENARIOS = {'list_10k': ('list', {'size': 10000}),
+             'list_100k': ('list', {'size': 100000}),
+             'list_1m': ('list', {'size': 1000000}),
+             'vidcount_5k': ('vidcount', {'size': 5000, 'concurrency': 8}),
+             'dates_1y': ('dates', {'size': 20000, 'years': 1}),
+             'dates_1y_days': ('dates', {'size': 20000, 'years': 1,
+                                         'facet': False}),
+             'dates_20y': ('dates', {'size': 100000, 'years': 20}),
+             'format_50y': ('format', {'years': 50})}
+DEFAULT = ('list_10k', 'list_100k', 'vidcount_5k', 'dates_1y',
+           'dates_1y_days', 'dates_20y', 'format_50y')
+
+def id_corpus(size, seed=1):
+    '''Return size documents with just an id and a title, to list.'''
+    rand = random.Random(seed)
+    docs = list()
+    for count in range(size):
+        uuid = '%032x'%rand.getrandbits(128)
+        docs.append({'id': 'uuid:%s-%s-%s-%s-%s'%(uuid[:8], uuid[8:12],
+                                uuid[12:16], uuid[16:20], uuid[20:]),
+                     'title': 'Synthetic item %s'%count})
+    return docs
+
+def start_stub(kind, settings, latency):
+    '''Return the started stub the kind of work runs against, or None.'''
+    if kind == 'list':
+        return stubsolr.StubSolr(id_corpus(settings['size']),
+                                 latency=latency).start()
+    if kind == 'vidcount':
+        docs = stubsolr.make_corpus(settings['size'])
+        stats = stubsolr.make_stats([doc['id'] for doc in docs])
+        return stubsolr.StubSolr(docs, stats=stats, latency=latency).start()
+    if kind == 'dates':
+        docs = stubsolr.make_corpus(settings['size'],
+                                    END_YEAR-settings['years']+1, END_YEAR)
+        return stubsolr.StubSolr(docs, latency=latency).start()
+    return None
+
+#  The work, done in the child process
+# ===============================================================
+def work_list(settings, endpoint, stats_server):
+    import fetch
+    search = fetch.Search('bench')
+    ids, log = search.auto_list_ids(endpoint, 'synthetic', 'title',
+                                    compact=True)
+    return len(ids)
+
+def work_vidcount(settings, endpoint, stats_server):
+    import vidcount
+    vidcount.ENABLE_STATIC_REMOTE = True
+    root = tempfile.mkdtemp()
+    try:
+        report = vidcount.ViewsAndDownloads(endpoint)
+        report.LOCAL_ROOT = root+'/' # empty, so every stat is remote
+        report.set_stats_server(stats_server)
+        report.set_concurrency(settings['concurrency'])
+        report.set_search('synthetic', 'title')
+        report.run()
+    finally:
+        shutil.rmtree(root)
+    return len(report.RAW_IDS)
+
+def work_dates(settings, endpoint, stats_server):
+    import years_oxford
+    loader = years_oxford.DateLoader('bench', endpoint, 'timestamp', True,
+                                     END_YEAR-settings['years']+1, END_YEAR,
+                                     settings.get('facet', True))
+    loader.fetch_stats(True)
+    return len(loader.STATS.days())
+
+def work_format(settings, endpoint, stats_server):
+    import years
+    rand = random.Random(1)
+    stats = years.StatMake()
+    stats.set_years(END_YEAR-settings['years']+1, END_YEAR)
+    for year, month, day in stats.days():
+        stats.set_total(year, month, day, rand.randint(0, 5000))
+    root = tempfile.mkdtemp()
+    try:
+        for action in ('pprint', 'rawdata'):
+            for ext in ('txt', 'txt.gz'):
+                stats.save(os.path.join(root, '%s.%s'%(action, ext)), action)
+    finally:
+        shutil.rmtree(root)
+    return len(stats.days())
+
+def peak_rss_kb():
+    '''Return the most memory this process has had resident, in KB.
+
+    The high water mark of /proc is used where there is one, since on
+    Linux ru_maxrss carries over the memory of the parent process.'''
+    try:
+        infile = file('/proc/self/status')
+        try:
+            for line in infile:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+        finally:
+            infile.close()
+    except IOError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+WORK = {'list': work_list, 'vidcount': work_vidcount, 'dates': work_dates,
+        'format': work_format}
+
+def run_child(name, endpoint, stats_server):
+    '''Do the work of scenario name and print what it took as JSON.'''
+    kind, settings = SCENARIOS[name]
+    start = time.time()
+    items = WORK[kind](settings, endpoint, stats_server)
+    seconds = time.time()-start
+    print json.dumps({'items': items, 'seconds': seconds,
+                      'peak_rss_kb': peak_rss_kb()})
+
+#  Running and comparing scenarios
+# ===============================================================
+def run_scenario(name, latency=LATENCY, repeat=1):
+    '''Return the results of one scenario as a dictionary.
+
+    With repeat above one the work is done that many times and the
+    fastest is kept, since short scenarios vary from run to run.'''
+    kind, settings = SCENARIOS[name]
+    stub = start_stub(kind, settings, latency)
+    command = [sys.executable, os.path.abspath(__file__), '--child', name]
+    if stub is not None:
+        command += ['--endpoint', stub.ENDPOINT,
+                    '--stats-server', stub.STATS_SERVER]
+    found = None
+    try:
+        for count in range(repeat):
+            before = stub.REQUESTS if stub is not None else 0
+            output = subprocess.check_output(command)
+            this = json.loads(output.splitlines()[-1])
+            this['requests'] = stub.REQUESTS-before if stub is not None else 0
+            if found is None or this['seconds'] < found['seconds']:
+                found = this
+    finally:
+        if stub is not None:
+            stub.stop()
+    found.update({'scenario': name, 'settings': settings, 'latency': latency,
+                  'repeat': repeat})
+    found['throughput'] = found['items']/max(found['seconds'], 1e-9)
+    return found
+
+def run(names=DEFAULT, latency=LATENCY, repeat=1, log=None):
+    '''Return the results of the named scenarios, ready to save as JSON.'''
+    results = dict()
+    for name in names:
+        if log:
+            log('%s ...'%name)
+        results[name] = run_scenario(name, latency, repeat)
+    return {'when': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'python': platform.python_version(), 'latency': latency,
+            'results': results}
+
+def compare(run_results, baseline, tolerance=TOLERANCE):
+    '''Return (lines of a comparison table, names of worse scenarios).
+
+    A scenario is worse if it sent more requests, or took more time or
+    memory than the baseline by more than tolerance.'''
+    lines = ['scenario\trequests\tseconds\tpeak_rss_kb\tchange']
+    worse = list()
+    old = baseline['results']
+    for name in sorted(run_results['results']):
+        new = run_results['results'][name]
+        if name not in old:
+            lines.append('%s\t%s\t%.3f\t%s\tnew'%(name, new['requests'],
+                                        new['seconds'], new['peak_rss_kb']))
+            continue
+        was = old[name]
+        changes = list()
+        if new['requests'] > was['requests']:
+            changes.append('more requests')
+        for key in ('seconds', 'peak_rss_kb'):
+            if new[key] > was[key]*(1+tolerance):
+                changes.append('%s +%.0f%%'%(key, 100.0*new[key]/was[key]-100))
+        if changes:
+            worse.append(name)
+        lines.append('%s\t%s/%s\t%.3f/%.3f\t%s/%s\t%s'%(name,
+                     new['requests'], was['requests'], new['seconds'],
+                     was['seconds'], new['peak_rss_kb'], was['peak_rss_kb'],
+                     ', '.join(changes) or 'ok'))
+    return lines, worse
+
+def log_err(message):
+    sys.stderr.write(message+'\n')
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run the benchmarks.')
+    parser.add_argument('scenarios', nargs='*', help='default: %s'%(
+                        ' '.join(DEFAULT)))
+    parser.add_argument('--latency', type=float, default=LATENCY)
+    parser.add_argument('--save', help='write the results to this file')
+    parser.add_argument('--baseline', help='compare with the results here')
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE)
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='keep the fastest of this many runs')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    parser.add_argument('--endpoint', help=argparse.SUPPRESS)
+    parser.add_argument('--stats-server', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    if args.child:
+        run_child(args.child, args.endpoint, args.stats_server)
+        return 0
+    for name in args.scenarios:
+        if name not in SCENARIOS:
+            parser.error('unknown scenario %s, choose from %s'%(name,
+                         ', '.join(sorted(SCENARIOS))))
+    results = run(args.scenarios or DEFAULT, args.latency, args.repeat,
+                  log_err)
+    text = json.dumps(results, indent=2, sort_keys=True)
+    print text
+    if args.save:
+        outfile = file(args.save, 'w')
+        outfile.write(text+'\n')
+        outfile.close()
+    if args.baseline:
+        infile = file(args.baseline)
+        baseline = json.load(infile)
+        infile.close()
+        lines, worse = compare(results, baseline, args.tolerance)
+        log_err('\n'.join(lines))
+        if worse:
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
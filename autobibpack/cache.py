@@ -0,0 +1,221 @@
+'''Keep responses on disk so repeated queries do not go to the source.
+
+Each response is kept with the time it was stored, how long it stays
+fresh (its TTL) and the ETag or Last-Modified header sent with it. A
+fresh response is used without asking the source. A stale one with an
+ETag or Last-Modified is checked with a conditional request, so an
+unchanged answer costs a tiny 304 response instead of the whole page.
+
+The least recently used responses are removed when the cache grows
+past its size limit.
+
+Using the cache
+===============
+c = ResponseCache('/tmp/autobib_cache')
+s = fetch.Search('cached')
+s.set_cache(c, ttl=PAST_TTL) # these results will not change
+...
+print c.stats()
+'''
+import os
+import time
+import json
+import hashlib
+import threading
+import urllib
+import urlparse
+
+DEFAULT_TTL = 3600 # Seconds a response stays fresh unless told otherwise.
+PAST_TTL = 365*86400 # For queries about dates that are fully in the past.
+MAX_BYTES = 200*1024*1024 # Size of the cache before old responses go.
+EVICT_TO = 0.9 # Share of MAX_BYTES left once old responses have gone.
+
+def normal_url(url):
+    '''Return url with its query parameters in a fixed order.'''
+    parts = urlparse.urlsplit(url)
+    params = urlparse.parse_qsl(parts.query, keep_blank_values=True)
+    query = urllib.urlencode(sorted(params))
+    return urlparse.urlunsplit((parts.scheme, parts.netloc.lower(),
+                                parts.path, query, ''))
+
+def settled(day, today=None):
+    '''Return True if the total for day (year, month, day) will not change.
+    
+    Items can still be added for recent days, so days in the current
+    month or later are always fetched again.'''
+    if today is None:
+        today = time.gmtime()[:3]
+    return tuple(day) < (today[0], today[1], 1)
+
+def ttl_for_date(last, today=None):
+    '''Return the TTL for a query about dates up to and including last.
+
+    Totals for settled days will not change, so they can be kept for a
+    long time, anything in the current month can not.'''
+    if settled(last, today):
+        return PAST_TTL
+    return DEFAULT_TTL
+
+class ResponseCache(object):
+    '''Responses kept in a directory, keyed by the normalised url.'''
+    def __init__(self, root, max_bytes=MAX_BYTES, default_ttl=DEFAULT_TTL):
+        self.ROOT = root
+        self.MAX_BYTES = max_bytes
+        self.DEFAULT_TTL = default_ttl
+        self.LOCK = threading.Lock()
+        self.ENTRIES = dict() # key = hash of url, value = [size, last used]
+        self.BYTES = 0 # The total size of ENTRIES, kept as they change.
+        self.STATS = {'hits': 0, 'misses': 0, 'stale': 0, 'revalidated': 0,
+                      'stores': 0, 'evictions': 0}
+        if not os.path.exists(root):
+            os.makedirs(root)
+        self.load()
+
+    def load(self):
+        '''Find the responses already in the cache directory.'''
+        for name in os.listdir(self.ROOT):
+            if name.endswith('.body'):
+                info = os.stat(os.path.join(self.ROOT, name))
+                self.ENTRIES[name[:-5]] = [info.st_size, info.st_mtime]
+                self.BYTES += info.st_size
+
+    def path(self, key, ext):
+        return os.path.join(self.ROOT, '%s.%s'%(key, ext))
+
+    def key(self, url):
+        return hashlib.sha1(normal_url(url)).hexdigest()
+
+    def stats(self):
+        '''Return a copy of the counters with the size of the cache.'''
+        with self.LOCK:
+            found = dict(self.STATS)
+            found['entries'] = len(self.ENTRIES)
+            found['bytes'] = self.BYTES
+        return found
+
+    def count(self, name):
+        with self.LOCK:
+            self.STATS[name] += 1
+
+    def lookup(self, url):
+        '''Return the cached entry for url or None.
+
+        The entry is a dictionary with the body, etag, last_modified
+        and fresh, which is False when it needs to be checked again.'''
+        key = self.key(url)
+        with self.LOCK:
+            if key not in self.ENTRIES:
+                self.STATS['misses'] += 1
+                return None
+        try:
+            meta = json.loads(self.read(key, 'json'))
+            body = self.read(key, 'body')
+        except (IOError, ValueError):
+            self.forget(key)
+            self.count('misses')
+            return None
+        now = time.time()
+        meta['body'] = body
+        meta['fresh'] = now-meta['stored'] < meta['ttl']
+        if meta['fresh']:
+            self.count('hits')
+            self.used(key, now)
+        else:
+            self.count('stale')
+        return meta
+
+    def used(self, key, now):
+        '''Mark key as just used so it is the last to be evicted.'''
+        with self.LOCK:
+            if key in self.ENTRIES:
+                self.ENTRIES[key][1] = now
+        try:
+            os.utime(self.path(key, 'body'), (now, now))
+        except OSError:
+            pass
+
+    def store(self, url, body, etag=None, last_modified=None, ttl=None):
+        '''Keep the body of the response for url.'''
+        if ttl is None:
+            ttl = self.DEFAULT_TTL
+        key = self.key(url)
+        meta = {'url': normal_url(url), 'etag': etag, 'stored': time.time(),
+                'last_modified': last_modified, 'ttl': ttl}
+        self.write(key, 'body', body)
+        self.write(key, 'json', json.dumps(meta))
+        with self.LOCK:
+            old = self.ENTRIES.get(key)
+            if old is not None:
+                self.BYTES -= old[0]
+            self.ENTRIES[key] = [len(body), meta['stored']]
+            self.BYTES += len(body)
+            self.STATS['stores'] += 1
+        self.evict()
+
+    def refresh(self, url, ttl=None):
+        '''Mark the response for url as fresh again, after a 304 answer.'''
+        if ttl is None:
+            ttl = self.DEFAULT_TTL
+        key = self.key(url)
+        try:
+            meta = json.loads(self.read(key, 'json'))
+        except (IOError, ValueError):
+            return
+        meta['stored'] = time.time()
+        meta['ttl'] = ttl
+        self.write(key, 'json', json.dumps(meta))
+        self.count('revalidated')
+        self.used(key, meta['stored'])
+
+    def read(self, key, ext):
+        '''Return the contents of one of the files kept for key.'''
+        infile = open(self.path(key, ext), 'rb')
+        data = infile.read()
+        infile.close()
+        return data
+
+    def write(self, key, ext, data):
+        '''Write a file in one go so a reader never sees half of it.'''
+        final = self.path(key, ext)
+        temp = '%s.%s.tmp'%(final, threading.current_thread().ident)
+        outfile = open(temp, 'wb')
+        outfile.write(data)
+        outfile.close()
+        os.rename(temp, final)
+
+    def forget(self, key):
+        '''Remove the response for key from the cache.'''
+        with self.LOCK:
+            old = self.ENTRIES.pop(key, None)
+            if old is not None:
+                self.BYTES -= old[0]
+        for ext in ('body', 'json'):
+            try:
+                os.remove(self.path(key, ext))
+            except OSError:
+                pass
+
+    def evict(self):
+        '''Remove the least recently used responses once over MAX_BYTES.
+        
+        Responses go until the cache is down to EVICT_TO of MAX_BYTES, so
+        the entries are not sorted again for every response stored.'''
+        with self.LOCK:
+            total = self.BYTES
+            if total <= self.MAX_BYTES:
+                return
+            oldest = sorted(self.ENTRIES, key=lambda k: self.ENTRIES[k][1])
+            going = list()
+            for key in oldest:
+                if total <= self.MAX_BYTES*EVICT_TO:
+                    break
+                total -= self.ENTRIES[key][0]
+                going.append(key)
+            self.STATS['evictions'] += len(going)
+        for key in going:
+            self.forget(key)
+
+    def clear(self):
+        '''Remove every response from the cache.'''
+        for key in list(self.ENTRIES):
+            self.forget(key)
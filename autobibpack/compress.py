@@ -0,0 +1,83 @@
+'''Ask for compressed responses and unpack them as they arrive.
+
+Pages of JSON from Solr shrink to a fraction of their size with gzip,
+so asking for it saves most of the bytes sent over the network. The
+bytes on the wire and the time spent unpacking them are recorded for
+every response.'''
+import time
+import zlib
+
+ACCEPT_ENCODING = 'gzip, deflate' # What we tell servers we can unpack.
+CHUNK = 65536 # How many bytes to read from the network at a time.
+
+class Decoder(object):
+    '''Unpack gzip or deflate data given a chunk at a time.'''
+    def __init__(self, encoding):
+        self.ENCODING = (encoding or '').strip().lower()
+        if self.ENCODING in ('gzip', 'x-gzip'):
+            self.UNPACK = zlib.decompressobj(16+zlib.MAX_WBITS)
+        elif self.ENCODING == 'deflate':
+            self.UNPACK = None # decided by the first chunk, see below
+        else:
+            self.ENCODING = ''
+            self.UNPACK = None
+        self.SECONDS = 0.0 # Time spent unpacking.
+
+    def decode(self, data):
+        '''Return the unpacked bytes for the next chunk of data.'''
+        if not self.ENCODING:
+            return data
+        start = time.time()
+        if self.UNPACK is None:
+            # Some servers send raw deflate data without the zlib header.
+            try:
+                self.UNPACK = zlib.decompressobj()
+                answer = self.UNPACK.decompress(data)
+            except zlib.error:
+                self.UNPACK = zlib.decompressobj(-zlib.MAX_WBITS)
+                answer = self.UNPACK.decompress(data)
+        else:
+            answer = self.UNPACK.decompress(data)
+        self.SECONDS += time.time()-start
+        return answer
+
+    def flush(self):
+        '''Return any bytes still held by the decoder.'''
+        if not self.UNPACK:
+            return ''
+        start = time.time()
+        answer = self.UNPACK.flush()
+        self.SECONDS += time.time()-start
+        return answer
+
+def iter_body(load, info=None):
+    '''Yield the unpacked body of the response load a chunk at a time.
+
+    If info is a dictionary it is filled with the encoding, wire_bytes,
+    bytes and decompress_seconds once the body has been read.'''
+    if info is None:
+        info = dict()
+    decoder = Decoder(load.info().getheader('content-encoding'))
+    wire = 0
+    size = 0
+    while True:
+        data = load.read(CHUNK)
+        if not data:
+            break
+        wire += len(data)
+        data = decoder.decode(data)
+        size += len(data)
+        if data:
+            yield data
+    data = decoder.flush()
+    size += len(data)
+    if data:
+        yield data
+    info['encoding'] = decoder.ENCODING or 'identity'
+    info['wire_bytes'] = wire
+    info['bytes'] = size
+    info['decompress_seconds'] = decoder.SECONDS
+
+def read_body(load, info=None):
+    '''Return the whole unpacked body of the response load.'''
+    return ''.join(iter_body(load, info))
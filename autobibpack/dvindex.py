@@ -0,0 +1,196 @@
+'''A memory-mapped index of the views and downloads in the dv tree.
+
+The stats for each item live in their own tiny file under
+results/dv/d1/d2/fname, so a report opens thousands of files. This
+module scans the tree once into a single binary file that can be
+memory-mapped and searched without opening any other file.
+
+The index is a hash table of fixed size records. Each record holds
+the 16 bytes of the item uuid and the views and downloads. A second
+file beside the index keeps the modified time of every d1/d2 directory
+so the next build only rescans directories that have changed. Files
+rewritten in place do not change their directory's time, so use
+full=True when the stats are updated that way.
+
+Using the index
+===============
+build_index('/var/www/', 'dv.index') # once, or after stats are updated
+index = DVIndex('dv.index')
+views, downloads = index.lookup('uuid:83530474-369e-417b-a8db-ac06ebf42c84')
+'''
+import os
+import json
+import mmap
+import struct
+import binascii
+
+MAGIC = 'DVIX'
+HEADER = struct.Struct('<4sII') # magic, version, number of slots
+RECORD = struct.Struct('<16sII') # uuid, views, downloads
+VERSION = 1
+EMPTY = '\0'*16
+DV_DIR = os.path.join('results', 'dv')
+
+def uuid_bytes(item):
+    '''Return the 16 byte key for an id such as uuid:8353..., or None.'''
+    if item.startswith('uuid:'):
+        item = item[5:]
+    try:
+        key = binascii.unhexlify(item.replace('-', ''))
+    except (TypeError, binascii.Error):
+        return None
+    if len(key) != 16 or key == EMPTY:
+        return None
+    return key
+
+def slot_for(key, slots):
+    '''Return the first slot to look in for key.'''
+    return struct.unpack_from('<Q', key)[0] & (slots-1)
+
+def parse_stats(text):
+    '''Return (views, downloads) from a stats file, None if it is not valid.'''
+    bits = text.split(';')
+    try:
+        return int(bits[0].strip()), int(bits[1].strip())
+    except (IndexError, ValueError):
+        return None
+
+def scan_dir(path, d1, d2):
+    '''Return {key: (views, downloads)} for the stats files in path.'''
+    found = dict()
+    for fname in os.listdir(path):
+        key = uuid_bytes(d1+d2+fname)
+        if key is None:
+            continue
+        try:
+            infile = file(os.path.join(path, fname))
+            stats = parse_stats(infile.read())
+            infile.close()
+        except IOError:
+            continue
+        if stats is not None:
+            found[key] = stats
+    return found
+
+def read_records(path):
+    '''Return {key: (views, downloads)} from an existing index file.'''
+    found = dict()
+    index = DVIndex(path)
+    try:
+        for key, views, downloads in index.records():
+            found[key] = (views, downloads)
+    finally:
+        index.close()
+    return found
+
+def write_index(path, records):
+    '''Write the records to path as a hash table, replacing it in one go.'''
+    slots = 16
+    while slots < len(records)*2: # keep the table at most half full
+        slots *= 2
+    table = bytearray(slots*RECORD.size)
+    for key in records:
+        slot = slot_for(key, slots)
+        while table[slot*RECORD.size:slot*RECORD.size+16] != EMPTY:
+            slot = (slot+1) & (slots-1)
+        views, downloads = records[key]
+        RECORD.pack_into(table, slot*RECORD.size, key, views, downloads)
+    temp = path+'.tmp'
+    outfile = file(temp, 'wb')
+    outfile.write(HEADER.pack(MAGIC, VERSION, slots))
+    outfile.write(table)
+    outfile.close()
+    os.rename(temp, path)
+
+def build_index(root, path, full=False):
+    '''Scan the dv tree under root into the index at path.
+
+    Only directories whose modified time has changed since the last
+    build are scanned, unless full is True. Returns a log dictionary.'''
+    log = {'directories': 0, 'scanned': 0, 'items': 0}
+    dirs_path = path+'.dirs'
+    known = dict()
+    old = dict()
+    if not full and os.path.exists(path) and os.path.exists(dirs_path):
+        infile = file(dirs_path)
+        known = json.load(infile)
+        infile.close()
+        old = read_records(path)
+    # Old records are kept by the directory their uuid starts with.
+    kept = dict()
+    for key in old:
+        kept.setdefault(binascii.hexlify(key[:2]), dict())[key] = old[key]
+    records = dict()
+    seen = dict()
+    top = os.path.join(root, DV_DIR)
+    for d1 in sorted(os.listdir(top)):
+        if not os.path.isdir(os.path.join(top, d1)):
+            continue
+        for d2 in sorted(os.listdir(os.path.join(top, d1))):
+            path_d2 = os.path.join(top, d1, d2)
+            if not os.path.isdir(path_d2):
+                continue
+            name = '%s/%s'%(d1, d2)
+            seen[name] = os.path.getmtime(path_d2)
+            log['directories'] += 1
+            if known.get(name) == seen[name]:
+                records.update(kept.get((d1+d2).lower(), dict()))
+            else:
+                records.update(scan_dir(path_d2, d1, d2))
+                log['scanned'] += 1
+    write_index(path, records)
+    outfile = file(dirs_path+'.tmp', 'w')
+    json.dump(seen, outfile)
+    outfile.close()
+    os.rename(dirs_path+'.tmp', dirs_path)
+    log['items'] = len(records)
+    return log
+
+class DVIndex(object):
+    '''Look up views and downloads in a memory-mapped index file.'''
+    def __init__(self, path):
+        self.PATH = path
+        self.FILE = file(path, 'rb')
+        self.MAP = mmap.mmap(self.FILE.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, slots = HEADER.unpack_from(self.MAP, 0)
+        if magic != MAGIC or version != VERSION:
+            self.close()
+            raise ValueError('%s is not a dv index'%path)
+        self.SLOTS = slots
+
+    def lookup(self, item):
+        '''Return (views, downloads) for the item id, or None if not found.'''
+        key = uuid_bytes(item)
+        if key is None:
+            return None
+        slot = slot_for(key, self.SLOTS)
+        while True:
+            offset = HEADER.size+slot*RECORD.size
+            have, views, downloads = RECORD.unpack_from(self.MAP, offset)
+            if have == key:
+                return views, downloads
+            if have == EMPTY:
+                return None
+            slot = (slot+1) & (self.SLOTS-1)
+
+    def records(self):
+        '''Yield (key, views, downloads) for every item in the index.'''
+        for slot in range(self.SLOTS):
+            offset = HEADER.size+slot*RECORD.size
+            record = RECORD.unpack_from(self.MAP, offset)
+            if record[0] != EMPTY:
+                yield record
+
+    def close(self):
+        self.MAP.close()
+        self.FILE.close()
+
+if __name__ == '__main__':
+    import sys
+    root = '/var/www/'
+    path = 'dv.index'
+    if len(sys.argv) > 1:
+        root = sys.argv[1]
+    if len(sys.argv) > 2:
+        path = sys.argv[2]
+    print build_index(root, path)
@@ -1,8 +1,112 @@
 '''Search bibliographic sources and fetch content.'''
 import urllib # for encoding the url
-import urllib2 # for getting page
-import StringIO # for reading results
+import httppool # for keeping connections open between pages
+import compress # for asking for gzip pages and unpacking them
 import json # for converting json
+import threading, Queue # for fetching the next page in the background
+import re # for reading the number found without decoding everything
+import collections # for the least recently used counts
+import itertools # for putting back the first streamed document
+import jsondecode # for decoding documents as they arrive
+import records # for keeping documents in less memory
+import metrics # for the latency of every request
+import time # for timing requests
+
+import workers # for fetching many pages at the same time
+import cache # for putting the query parameters in a fixed order
+
+# Endpoints known to support (True) or ignore (False) cursorMark paging.
+CURSOR_SUPPORT = dict()
+COUNT_MEMO_SIZE = 20000 # How many counts are remembered by COUNTS.
+# Parameters that make no difference to the number of items found.
+COUNT_IGNORES = ('rows', 'start', 'sort', 'fl', 'cursorMark', 'indent')
+NUM_FOUND = re.compile(r'"numFound"\s*:\s*(\d+)')
+
+class CountMemo(object):
+    '''The most recently used counts, keyed by the normalised query url.'''
+    def __init__(self, size=COUNT_MEMO_SIZE):
+        self.LOCK = threading.Lock()
+        self.SIZE = size
+        self.COUNTS = collections.OrderedDict()
+        self.STATS = {'hits': 0, 'misses': 0}
+
+    def get(self, key):
+        '''Return the count for key or None, marking it as just used.'''
+        with self.LOCK:
+            found = self.COUNTS.pop(key, None)
+            if found is None:
+                self.STATS['misses'] += 1
+                return None
+            self.COUNTS[key] = found
+            self.STATS['hits'] += 1
+            return found
+
+    def put(self, key, count):
+        '''Remember count for key, forgetting the least recently used.'''
+        with self.LOCK:
+            self.COUNTS.pop(key, None)
+            self.COUNTS[key] = count
+            while len(self.COUNTS) > self.SIZE:
+                self.COUNTS.popitem(last=False)
+
+    def clear(self):
+        with self.LOCK:
+            self.COUNTS.clear()
+
+COUNTS = CountMemo() # Counts shared by every search in this process.
+
+def encode_params(params):
+    '''Return the query string of params, a dictionary.
+    
+    Unicode values are sent as UTF-8 and a list or tuple value is sent
+    as the same parameter once for each item, e.g. facet.range.'''
+    pairs = list()
+    for key, value in params.items():
+        values = value if isinstance(value, (list, tuple)) else [value]
+        for one in values:
+            if isinstance(one, unicode):
+                one = one.encode('utf-8')
+            pairs.append((key, one))
+    return urllib.urlencode(pairs)
+
+def prefetch(iterable, ahead=1):
+    '''Yield from iterable while a thread works up to ahead items in front.
+    
+    Errors raised by the iterable are raised again where it is used.'''
+    waiting = Queue.Queue(ahead)
+    stopped = threading.Event()
+    def send(more, item):
+        while not stopped.is_set():
+            try:
+                waiting.put((more, item), timeout=0.1)
+                return True
+            except Queue.Full:
+                pass
+        return False # nobody is waiting for items any more
+    def work():
+        try:
+            for item in iterable:
+                if not send(True, item):
+                    return
+            send(False, None)
+        except Exception, error:
+            send(False, error)
+    worker = threading.Thread(target=work)
+    worker.daemon = True
+    worker.start()
+    try:
+        while True:
+            try: # a get with no timeout blocks Ctrl-C
+                more, item = waiting.get(timeout=0.1)
+            except Queue.Empty:
+                continue
+            if not more:
+                if item is not None:
+                    raise item
+                return
+            yield item
+    finally:
+        stopped.set() # let the worker finish if we stop early
 
 class Search(object):
     '''A general class for searching for items.'''
@@ -20,6 +124,23 @@ class Search(object):
         self.DOCUMENTS = dict() # keys = document UUIDs in ORA, ID in others?
         self.DOCS_FOUND = 0 # How many document found during the first search
         self.NEXT_START = 0 # Where in the sequence are we
+        self.PAGE_COUNT = 0 # Documents in the last page read.
+        self.NEXT_CURSOR = '' # The cursor mark for the next page, if any.
+        self.CURSOR_PAGING = False # True, False or None to detect support.
+        self.PAGED_BY = '' # How get_all went through the pages.
+        self.CONCURRENCY = 1 # How many pages get_all can fetch at once.
+        self.RETRIES = 2 # How many times to retry pages fetched at once.
+        self.ADAPTIVE = 0 # Most pages at once when the endpoint chooses.
+        self.ADAPTED = None # Its controller's summary after get_all.
+        self.COMPRESS = True # Ask the source to gzip or deflate the data.
+        self.TRANSFERS = list() # Sizes and unpacking time for each fetch.
+        self.CACHE = None # A cache.ResponseCache to keep responses in.
+        self.CACHE_TTL = None # Seconds responses stay fresh in the cache.
+        self.STREAM = False # Decode documents as they arrive, see set_streaming.
+        self.METRICS = metrics.METRICS # Records every request, see set_metrics.
+        self.TRANSPORT = None # Sends requests instead of httppool, see below.
+        self.RECORDS = 'dict' # How DOCUMENTS are kept, see set_records.
+        self.RECORD_FIELDS = None # The fields kept by 'tuple' records.
         self.AND_JOINERS_TESTED = ['&', ' AND '] # What to use for AND queries
         # It looks like ORA supports the first and PLoS uses the second.
         self.AND_JOINER = self.AND_JOINERS_TESTED[0]
@@ -66,8 +187,94 @@ class Search(object):
         '''Set the start record to return for the query.'''
         self.set_at('start', count)
             
+    def set_concurrency(self, count, retries=2):
+        '''Let get_all fetch up to count pages at once, retrying failures.'''
+        self.CONCURRENCY = max(1, int(count))
+        self.RETRIES = retries
+
+    def set_adaptive(self, most=8):
+        '''Let get_all fetch up to most pages at once, as the endpoint copes.
+        
+        The pages at once are chosen by the workers.Controller shared by
+        everything using the endpoint, 0 turns this off. most is capped
+        at the connections httppool keeps for a host.'''
+        self.ADAPTIVE = max(0, int(most))
+
+    def set_compression(self, enable=True):
+        '''Enable asking the source to compress the data it returns.'''
+        self.COMPRESS = enable
+
+    def set_cache(self, cache, ttl=None):
+        '''Keep responses in cache, fresh for ttl seconds or its default.'''
+        self.CACHE = cache
+        self.CACHE_TTL = ttl
+
+    def set_streaming(self, enable=True):
+        '''Decode each document as it arrives instead of the whole page.
+        
+        get_all and iter_documents then use each document as it is
+        decoded, so neither the text nor the decoded page is held. Calls
+        that return a page, like get_documents, still return a list of
+        its documents, but the text is not kept in RAWDATA.'''
+        self.STREAM = enable
+
+    def set_transport(self, transport):
+        '''Send this search's requests with transport, None for the pool.
+        
+        A replay.RecordTransport or ReplayTransport records the requests
+        or answers them from an archive.'''
+        self.TRANSPORT = transport
+
+    def urlopen(self, url, headers):
+        '''Open url with the transport of this search or the shared one.'''
+        if self.TRANSPORT is not None:
+            return self.TRANSPORT.urlopen(url, None, headers)
+        return httppool.urlopen(url, headers=headers)
+
+    def set_metrics(self, recorder):
+        '''Record the latency and outcome of each request in recorder.'''
+        self.METRICS = recorder
+
+    def set_records(self, kind='ids', fields=None):
+        '''Keep DOCUMENTS as 'dict', 'tuple' or 'ids' records.
+        
+        'dict' keeps each document as Solr sent it. 'tuple' keeps a small
+        tuple with an attribute for each of fields, the fl fields if not
+        given, but dicts if a * in them leaves the fields unknown. 'ids'
+        keeps just the ids in a records.IdSet, with uuids packed as 16
+        bytes each, so DOCUMENTS is a set instead. 'tuple' needs fields
+        or set_field_getlist to be called first.'''
+        if kind not in ('dict', 'tuple', 'ids'):
+            raise ValueError('unknown kind of record: %s'%kind)
+        if kind == 'tuple' and not fields and not self.QUERY_AT.get('fl'):
+            raise ValueError('tuple records need fields or fl to be set')
+        self.RECORDS = kind
+        self.RECORD_FIELDS = fields
+        if kind == 'ids':
+            self.DOCUMENTS = records.IdSet(self.DOCUMENTS)
+        elif isinstance(self.DOCUMENTS, records.IdSet):
+            self.DOCUMENTS = dict()
+
+    def set_cursor(self, mark='*'):
+        '''Set the cursor mark for the page wanted, where * is the first page.
+        
+        Cursors need a sort that ends with the unique id and do not work
+        with a start position, so the sort and start are changed to suit.'''
+        self.set_at('cursorMark', mark)
+        if 'start' in self.QUERY_AT:
+            del self.QUERY_AT['start']
+        sort = self.QUERY_AT.get('sort', '')
+        keys = [part.strip().split(' ')[0] for part in sort.split(',')]
+        if 'id' not in keys:
+            if sort:
+                self.set_at('sort', '%s,id asc'%sort)
+            else:
+                self.set_sort('id')
+            
     def set_field_getlist(self, fields):
         '''Limit the returned results to specific fields.'''
+        if not isinstance(fields, basestring): # e.g. ('id', 'title')
+            fields = ','.join(fields)
         self.set_at('fl',fields)
          
     def set_sort(self, key, descending=False):
@@ -77,7 +284,36 @@ class Search(object):
         else:
             order = 'asc'    
         self.set_at('sort', '%s %s'%(key, order))
+
+    def set_facet_range(self, field, start, end, gap='+1DAY', method='range'):
+        '''Count items in field for each gap from start up to end.
+        
+        Older Solr versions only have the date facet, so method can be
+        'date' instead of 'range'. Start and end are Solr dates such as
+        2013-01-01T00:00:00Z and the end is not included. Call it
+        again for other fields to count them all in the same request.'''
+        self.set_at('facet', 'true')
+        fields = self.QUERY_AT.get('facet.%s'%method, list())
+        if not isinstance(fields, list):
+            fields = [fields]
+        if field not in fields:
+            fields.append(field)
+        self.set_at('facet.%s'%method, fields)
+        options = {'start': start, 'end': end, 'gap': gap}
+        for option in options:
+            self.set_at('f.%s.facet.%s.%s'%(field, method, option),
+                        options[option])
         
+    def add_facet_query(self, query):
+        '''Count the items matching query too, e.g. field:[start TO end].'''
+        self.set_at('facet', 'true')
+        queries = self.QUERY_AT.get('facet.query', list())
+        if not isinstance(queries, list):
+            queries = [queries]
+        if query not in queries:
+            queries.append(query)
+        self.set_at('facet.query', queries)
+
     #  Methods that alter the SOLR query (q) string.
     # ===============================================================        
     def query(self, field, value):
@@ -148,8 +384,8 @@ class Search(object):
         if not made: #Tested with test126_make_and_noquery in ORA tests
             made = '*:*'
         self.QUERY_AT['q'] = made
-        # by adding 'q' above we can let urlencode deal with all options
-        return urllib.urlencode(self.QUERY_AT)
+        # by adding 'q' above we can let urlencode deal with all options.
+        return encode_params(self.QUERY_AT)
         
     def make_query(self):
         '''Return the URL that should return data.'''
@@ -160,48 +396,368 @@ class Search(object):
         else:
             return ''
 
+    def make_count_query(self):
+        '''Return the URL that only asks for the number of items found.'''
+        self.make_and() # puts the q parameter in QUERY_AT
+        params = dict()
+        for key in self.QUERY_AT:
+            if key in COUNT_IGNORES or key.startswith(('facet', 'f.')):
+                continue
+            params[key] = self.QUERY_AT[key]
+        params['rows'] = 0
+        return self.END_POINT + encode_params(params)
+
+    def fetch_url(self, url):
+        '''Return the data from url without changing this search.
+        
+        The size on the wire, the unpacked size and the time taken to
+        unpack the data are added to TRANSFERS. With a cache, a fresh
+        response is used as it is and a stale one is checked with the
+        source using its ETag or Last-Modified date.'''
+        info = {'url': url, 'cache': 'off'}
+        start = time.time()
+        try:
+            raw = self._load_url(url, info)
+        except Exception as error:
+            self.METRICS.record('solr', url, time.time()-start,
+                                info.get('wire_bytes', 0), error=error)
+            raise
+        self.METRICS.record('solr', url, time.time()-start,
+                            info.get('wire_bytes', 0), metrics.find_qtime(raw),
+                            info['cache'])
+        return raw
+
+    def _load_url(self, url, info):
+        '''Return the data from url for fetch_url, filling in info.'''
+        headers = self.request_headers()
+        kept = None
+        if self.CACHE:
+            kept = self.CACHE.lookup(url)
+            info['cache'] = 'miss'
+        if kept and kept['fresh']:
+            info.update({'cache': 'hit', 'encoding': 'identity',
+                         'wire_bytes': 0, 'bytes': len(kept['body']),
+                         'decompress_seconds': 0.0})
+            self.TRANSFERS.append(info)
+            return kept['body']
+        if kept and kept['etag']:
+            headers['If-None-Match'] = kept['etag']
+        if kept and kept['last_modified']:
+            headers['If-Modified-Since'] = kept['last_modified']
+        load = self.urlopen(url, headers)
+        try:
+            raw = compress.read_body(load, info)
+        finally:
+            load.close()
+        if self.CACHE:
+            if load.code == 304 and kept:
+                self.CACHE.refresh(url, self.CACHE_TTL)
+                info['cache'] = 'revalidated'
+                raw = kept['body']
+            else:
+                self.CACHE.store(url, raw, load.getheader('etag'),
+                                 load.getheader('last-modified'),
+                                 self.CACHE_TTL)
+        self.TRANSFERS.append(info)
+        return raw
+
+    def request_headers(self):
+        '''Return the headers sent with every request.'''
+        headers = dict()
+        if self.COMPRESS:
+            headers['Accept-Encoding'] = compress.ACCEPT_ENCODING
+        return headers
+
+    def iter_url(self, url):
+        '''Yield the data from url a chunk at a time as it arrives.
+        
+        With a cache the whole response is got by fetch_url instead.'''
+        if self.CACHE:
+            yield self.fetch_url(url)
+            return
+        info = {'url': url, 'cache': 'off'}
+        start = time.time()
+        qtime = None
+        try:
+            load = self.urlopen(url, self.request_headers())
+            try:
+                for chunk in compress.iter_body(load, info):
+                    if qtime is None and chunk:
+                        qtime = metrics.find_qtime(chunk)
+                    yield chunk
+            finally:
+                load.close()
+        except Exception as error:
+            self.METRICS.record('solr', url, time.time()-start,
+                                info.get('wire_bytes', 0), qtime, error=error)
+            raise
+        self.METRICS.record('solr', url, time.time()-start,
+                            info.get('wire_bytes', 0), qtime, info['cache'])
+        self.TRANSFERS.append(info)
+
+    def url_documents(self, url):
+        '''Return (docs, data) for url, data is the response without docs.
+        
+        docs is a list, when streaming it is gathered as it is decoded.'''
+        if self.STREAM:
+            self.RAWDATA = '' # not kept when streaming
+            return jsondecode.stream_docs(self.iter_url(url))
+        data = self.parse_json(self.fetch_url(url))
+        return data['response']['docs'], data
+
+    def transfer_summary(self):
+        '''Return the totals for all the data fetched by this search.'''
+        summary = {'requests': len(self.TRANSFERS), 'wire_bytes': 0,
+                   'bytes': 0, 'decompress_seconds': 0.0}
+        for info in self.TRANSFERS:
+            for key in ('wire_bytes', 'bytes', 'decompress_seconds'):
+                summary[key] += info[key]
+        if summary['wire_bytes']:
+            ratio = summary['bytes']/float(summary['wire_bytes'])
+        else:
+            ratio = 1.0
+        summary['ratio'] = ratio
+        return summary
+
     def fetch_data(self):
         '''Return the data from the course and cache it.'''
-        load = urllib2.urlopen(self.make_query())
-        self.RAWDATA = load.read()
-        load.close()
+        self.RAWDATA = self.fetch_url(self.make_query())
         return self.RAWDATA
 
     #  Process fetched data
     # ===============================================================
+    def parse_json(self, raw):
+        '''Return the JSON in the raw data from a source.'''
+        return jsondecode.loads(raw)
+
     def get_json_raw(self):
         '''Return the data as JSON with response headers.'''
         self.fetch_data()
-        data = StringIO.StringIO(self.RAWDATA)
-        return json.load(data)
+        return self.parse_json(self.RAWDATA)
     
+    def count(self, memo=COUNTS):
+        '''Return the number of items found by the query, without any docs.
+        
+        Only rows=0 is asked for and just numFound is read from the
+        answer. Counts are kept in memo, so the same count asked for
+        again by any search in this process needs no request. Use
+        memo=None to always ask the source.'''
+        url = self.make_count_query()
+        key = cache.normal_url(url)
+        found = None
+        if memo is not None:
+            found = memo.get(key)
+        if found is None:
+            raw = self.fetch_url(url)
+            number = NUM_FOUND.search(raw)
+            if number:
+                found = int(number.group(1))
+            else: # unusual spacing or layout, so decode it all
+                found = self.parse_json(raw)['response']['numFound']
+            if memo is not None:
+                memo.put(key, found)
+        self.DOCS_FOUND = found
+        return found
+
     def get_documents(self):
         '''Return a tuple containing items found and prepare next query.'''
-        data = self.get_json_raw()
-        documents = data['response']['docs']
+        if self.STREAM:
+            documents, data = self.url_documents(self.make_query())
+        else:
+            data = self.get_json_raw()
+            documents = data['response']['docs']
+        self.page_read(data, len(documents))
+        return documents
+
+    def stream_documents(self):
+        '''Return an iterator of the page's documents as they are decoded.
         
+        Neither the text nor the decoded page is held, just a document
+        at a time. The first is decoded before returning, so a failed
+        request raises here. The next query is prepared, as by
+        get_documents, once the last document has been used.'''
+        page = jsondecode.StreamedPage(self.iter_url(self.make_query()))
+        docs = page.docs()
+        first = list(itertools.islice(docs, 1))
+        def rest():
+            for doc in itertools.chain(first, docs):
+                yield doc
+            self.page_read(page.DATA, page.COUNT)
+        return rest()
+
+    def page_read(self, data, count):
+        '''Prepare the next query from data, a page without its docs.'''
         # Enable it so we can run the query again with different start point
         if not self.DOCS_FOUND:
             self.DOCS_FOUND = data['response']['numFound']
         this_start = data['response']['start']
-        this_count = len(documents)
-        self.NEXT_START = int(this_start)+int(this_count)+1
+        self.PAGE_COUNT = count
+        self.NEXT_START = int(this_start)+int(count)
+        self.NEXT_CURSOR = data.get('nextCursorMark', '')
+
+    def get_facet_ranges(self):
+        '''Return a dictionary of {field: {bucket start: count}} from facets.
         
-        return documents
+        Both range and date facets are read. A field is missing from the
+        answer if the source ignored the facet part of the query.'''
+        data = self.get_json_raw()
+        self.DOCS_FOUND = data['response']['numFound']
+        facets = data.get('facet_counts', dict())
+        found = dict()
+        for field, info in facets.get('facet_ranges', dict()).items():
+            counts = info['counts']
+            if isinstance(counts, dict): # when json.nl=map was used
+                found[field] = counts
+            else: # default is a flat list of bucket, count, bucket, ...
+                found[field] = dict(zip(counts[::2], counts[1::2]))
+        not_buckets = ('gap', 'start', 'end', 'before', 'after', 'between')
+        for field, info in facets.get('facet_dates', dict()).items():
+            if field in found:
+                continue
+            found[field] = dict()
+            for bucket in info:
+                if bucket not in not_buckets:
+                    found[field][bucket] = info[bucket]
+        return found
+
+    def get_facet_queries(self):
+        '''Return {query: count} for the facet queries, None if ignored.'''
+        data = self.get_json_raw()
+        self.DOCS_FOUND = data['response']['numFound']
+        return data.get('facet_counts', dict()).get('facet_queries')
+
+    def iter_pages(self, load=None):
+        '''Yield each page of documents in turn, doing muliple fetches.
+        
+        Pages are found by start position unless CURSOR_PAGING is True, or
+        None and the endpoint supports cursors. Deep start positions make
+        Solr sort everything before them, a cursor page always costs the
+        same. A source that ignores the cursor, or when guessing rejects
+        it as a bad request, is paged by start instead. Each page comes
+        from load, get_documents unless given, and must be used up before
+        the next is asked for.'''
+        if load is None:
+            load = self.get_documents
+        cursor = self.CURSOR_PAGING
+        guess = cursor is None
+        if guess:
+            cursor = CURSOR_SUPPORT.get(self.END_POINT, True)
+        before = dict(self.QUERY_AT) # the sort and start without a cursor
+        if cursor:
+            self.set_cursor()
+        try:
+            new_docs = load()
+        except IOError, error:
+            if not (guess and cursor and getattr(error, 'code', None) == 400):
+                raise
+            CURSOR_SUPPORT[self.END_POINT] = False
+            cursor = False
+            self.QUERY_AT = before
+            new_docs = load()
+        yield new_docs
+        if cursor:
+            CURSOR_SUPPORT[self.END_POINT] = bool(self.NEXT_CURSOR)
+            if self.NEXT_CURSOR:
+                self.PAGED_BY = 'cursor'
+                while self.PAGE_COUNT and \
+                      self.NEXT_CURSOR != self.QUERY_AT['cursorMark']:
+                    self.set_cursor(self.NEXT_CURSOR)
+                    yield load()
+                return
+            del self.QUERY_AT['cursorMark'] # the first page is still valid
+        self.PAGED_BY = 'start'
+        while self.PAGE_COUNT and self.NEXT_START < self.DOCS_FOUND:
+            self.set_start(self.NEXT_START)
+            yield load()
 
     def get_all(self):
         '''Get all the documents, doing muliple fetches when needed.'''
-        new_docs =  self.get_documents()
+        if self.CONCURRENCY > 1 or self.ADAPTIVE:
+            self.get_all_parallel()
+            return
+        load = self.stream_documents if self.STREAM else None
+        for new_docs in self.iter_pages(load):
+            self.update_documents(new_docs)
+
+    def get_all_parallel(self):
+        '''Get all the documents, fetching CONCURRENCY pages at once.
+        
+        The first page says how many documents there are, so the start
+        of every other page is known and they can be fetched together.
+        Pages are added to DOCUMENTS in start order so the result is the
+        same as fetching one at a time. A failed page is retried up to
+        RETRIES times without fetching the other pages again. With
+        ADAPTIVE set the endpoint's controller chooses the pages at once.'''
+        new_docs = self.get_documents()
         self.update_documents(new_docs)
-        while self.NEXT_START <= self.DOCS_FOUND:
-            self.set_start(self.NEXT_START)
-            new_docs = self.get_documents()
+        step = len(new_docs)
+        if not step:
+            return
+        urls = list()
+        for start in range(self.NEXT_START, self.DOCS_FOUND, step):
+            self.set_start(start)
+            urls.append(self.make_query())
+        def fetch_page(url):
+            return self.url_documents(url)[0]
+        concurrency, control = self.CONCURRENCY, None
+        if self.ADAPTIVE:
+            control = workers.controller_for(self.END_POINT, self.ADAPTIVE)
+            concurrency = self.ADAPTIVE
+        pages = workers.map_ordered(fetch_page, urls, concurrency,
+                                    self.RETRIES, control=control)
+        if control is not None:
+            self.ADAPTED = control.summary() # see settled for pages at once
+        for new_docs in pages:
             self.update_documents(new_docs)
+        if urls:
+            self.NEXT_START = start+len(pages[-1])
+        self.PAGED_BY = 'parallel'
+
+    def iter_documents(self, ids_only=False):
+        '''Yield documents as they arrive, without keeping them in DOCUMENTS.
+        
+        Pages are fetched in the background while the current one is
+        used: up to three pages are held, the one in use, one waiting and
+        one arriving. With STREAM the documents are decoded as they arrive
+        instead, up to a page of them ahead of the one in use, so the next
+        page is asked for while the current one is still being used. With
+        ids_only just the id field is asked for and each id is yielded.'''
+        if ids_only:
+            self.set_field_getlist('id')
+        if self.STREAM:
+            def streamed():
+                for page in self.iter_pages(self.stream_documents):
+                    for doc in page:
+                        yield doc
+            ahead = int(self.QUERY_AT.get('rows', 10))
+            docs = prefetch(streamed(), ahead)
+        else:
+            docs = (doc for page in prefetch(self.iter_pages())
+                    for doc in page)
+        for doc in docs:
+            if ids_only:
+                yield doc['id']
+            else:
+                yield doc
     
     #  Post-processing of data
     # ===============================================================        
     def update_documents(self, new_documents):
         '''Add new documents to internal list of documents found.'''
+        if self.RECORDS == 'ids':
+            for doc in new_documents:
+                self.DOCUMENTS.add(doc['id'])
+            return
+        if self.RECORDS == 'tuple':
+            fields = self.RECORD_FIELDS
+            if not fields: # Solr allows commas or spaces between fl fields
+                fields = [f for f in re.split(r'[,\s]+', self.QUERY_AT['fl'])
+                          if f]
+        if self.RECORDS == 'tuple' and '*' not in ''.join(fields):
+            make = records.record_type(fields)
+            for doc in new_documents:
+                self.DOCUMENTS[doc['id']] = make(*[doc.get(f) for f in fields])
+            return
         for doc in new_documents:
             key = doc['id']
             self.DOCUMENTS[key] = doc
@@ -213,24 +769,57 @@ class Search(object):
 
     #  Combine fetching, processing and returning results
     # ===============================================================
-    def auto_list_ids(self, endpoint, value, field='*', batchsize=999):
-        '''Search endpoint for value in field and return list of ids.'''
-        # Setup the query
-        log = dict()
+    def _setup_list_ids(self, endpoint, value, field, batchsize, cursor, log):
+        '''Prepare the query used to list ids and log how it was set up.'''
+        self.CURSOR_PAGING = cursor
         self.set_endpoint(endpoint)
         self.set_rows(batchsize)
         self.set_field_getlist(('id'))
+        self.set_streaming() # pages of ids are large and used one at a time
         log['2a. Value searching for'] = value
         log['2b. Field searching in'] = field
         self.query(field, value)
         log['2c. First query'] = self.make_query()
+
+    def auto_list_ids(self, endpoint, value, field='*', batchsize=999,
+                      cursor=None, compact=False):
+        '''Search endpoint for value in field and return list of ids.
+        
+        By default a cursor is used to page through the ids when the
+        endpoint supports it. With compact the ids are kept and returned
+        as a records.IdSet, a small part of the memory of a list.'''
+        # Setup the query
+        log = dict()
+        self._setup_list_ids(endpoint, value, field, batchsize, cursor, log)
+        if compact:
+            self.set_records('ids')
         
         # Run it and return results.
         self.get_all()
         log['2d. Number of IDs found'] = self.DOCS_FOUND
-        unique = self.DOCUMENTS.keys()
+        if compact:
+            unique = self.DOCUMENTS
+        else:
+            unique = self.DOCUMENTS.keys()
         log['2e. Number of unique IDs'] = len(unique)
         return unique, log
+
+    def auto_iter_ids(self, endpoint, value, field='*', batchsize=999,
+                      cursor=None, log=None):
+        '''Search endpoint for value in field and yield ids as they arrive.
+        
+        This is the streaming version of auto_list_ids. Each id is only
+        yielded once and the log dictionary, if given, is filled in the
+        same way once all the ids have been yielded.'''
+        if log is None:
+            log = dict()
+        self._setup_list_ids(endpoint, value, field, batchsize, cursor, log)
+        seen = records.IdSet()
+        for key in self.iter_documents(ids_only=True):
+            if seen.add(key):
+                yield key
+        log['2d. Number of IDs found'] = self.DOCS_FOUND
+        log['2e. Number of unique IDs'] = len(seen)
         
 if __name__ == '__main__':
     import fetch_test_ora as get
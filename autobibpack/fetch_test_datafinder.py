@@ -3,11 +3,14 @@ import unittest
 import fetch
 from sources import Datafinder8000
 
+# Set to test another endpoint, like the stand-in from stubsources.
+END_POINT = None
+
 class TestDataFinderBasic(unittest.TestCase):
     '''Check the basic functionality of Solr search of datafinder.'''          
     def setUp(self):
         self.NAME = 'dfinder_solr'
-        self.END = Datafinder8000().ENDPOINT
+        self.END = END_POINT or Datafinder8000().ENDPOINT
         self.FIELD = 'silo'
         # We are going to use the following thesis as our test item.
         self.SILO = 'eprints'
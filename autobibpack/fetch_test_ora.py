@@ -6,11 +6,14 @@ import unittest
 import fetch
 from sources import Ora
 
+# Set to test another endpoint, like the stand-in from stubsources.
+END_POINT = None
+
 class TestOraBasic(unittest.TestCase):
     '''Check the basic functionality of the Solr bibliographic search.'''          
     def setUp(self):
         self.NAME = 'ora_solr'
-        self.END = Ora().ENDPOINT
+        self.END = END_POINT or Ora().ENDPOINT
         self.FIELD = 'author'
         # We are going to use the following thesis as our test item.
         # http://ora.ox.ac.uk/objects/uuid:83530474-369e-417b-a8db-ac06ebf42c84
@@ -152,12 +155,12 @@ class TestOraBasic(unittest.TestCase):
         self.do_prepare_query()
         self.assertEqual(self.SEARCH.NEXT_START, 0)
         self.do_get_docs()
-        self.assertEqual(self.SEARCH.NEXT_START, 11)
+        self.assertEqual(self.SEARCH.NEXT_START, 10)
     
     def test165_next_start_url(self):
         self.do_get_docs()
         self.SEARCH.set_start(self.SEARCH.NEXT_START)
-        self.assertIn('start=11',self.SEARCH.make_query())
+        self.assertIn('start=10',self.SEARCH.make_query())
         
     #  Test title searches in the query string
     # ===============================================================
@@ -284,7 +287,7 @@ class TestOraLonger(unittest.TestCase):
     '''Check the basic functionality of the Solr bibliographic search.'''          
     def setUp(self):
         self.NAME = 'ora_solr'
-        self.END = Ora().ENDPOINT
+        self.END = END_POINT or Ora().ENDPOINT
         self.FIELD = 'author'
         self.AUTHOR = 'cummings'
         self.SEARCH = fetch.Search(self.NAME)
@@ -310,7 +313,7 @@ class TestOraAuto(unittest.TestCase):
     '''Check the methods that combine different parts of the system.'''          
     def setUp(self):
         self.NAME = 'ora_solr_idlist'
-        self.END = Ora().ENDPOINT
+        self.END = END_POINT or Ora().ENDPOINT
         self.FIELD = 'recordContentSource'
         self.VALUE = 'polonsky'
         # Did a visual check of ORA to confirm this id is from the source above.
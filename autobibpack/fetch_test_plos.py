@@ -8,13 +8,15 @@ import fetch
 from sources import Plos
 
 ENABLE_REMOTE = False # This will stop queries going to PLOS.
+# Set to test another endpoint, like the stand-in from stubsources.
+END_POINT = None
 
 class TestApi(unittest.TestCase):
     '''Check API keys can be used in Solr bibliographic search.'''          
     def setUp(self):
         self.NAME = 'plos_test'
         p = Plos()
-        self.END = p.ENDPOINT 
+        self.END = END_POINT or p.ENDPOINT 
         self.KEY = p.KEY
         self.URL_API_KEY = p.URL_KEY_FIELD 
         self.SEARCH = fetch.Search(self.NAME)
@@ -46,7 +48,7 @@ class TestCustomQuery(unittest.TestCase):
     def setUp(self):
         self.NAME = 'plos_solr'
         p = Plos()
-        self.END = p.ENDPOINT 
+        self.END = END_POINT or p.ENDPOINT 
         self.KEY = p.KEY
         self.URL_API_KEY = p.URL_KEY_FIELD
         self.AUTHOR = 'Majlender'
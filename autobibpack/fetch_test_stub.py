@@ -0,0 +1,690 @@
+'''Test the search interface against a local stub Solr.
+
+The stub answers from a synthetic corpus so these tests do not need a
+network connection and the expected numbers never change.'''
+import unittest
+import urllib2
+import tempfile
+import shutil
+import json
+import cache
+import fetch
+import httppool
+import jsondecode
+import records
+import replay
+import os
+import stubsolr
+import time
+import socket
+import workers
+
+class TestStubPaging(unittest.TestCase):
+    '''Check every document is found whichever way pages are fetched.'''
+    def setUp(self):
+        self.NAME = 'stub_paging'
+        self.DOCS = stubsolr.make_corpus(95)
+        self.STUB = stubsolr.StubSolr(self.DOCS).start()
+        self.SEARCH = fetch.Search(self.NAME)
+        self.ROWS = 10
+
+    def tearDown(self):
+        self.STUB.stop()
+
+    def do_prepare_query(self, stub=None):
+        stub = stub or self.STUB
+        self.SEARCH.set_endpoint(stub.ENDPOINT)
+        self.SEARCH.set_rows(self.ROWS)
+        fetch.CURSOR_SUPPORT.clear()
+
+    def check_all(self):
+        expected = set(doc['id'] for doc in self.DOCS)
+        self.assertEqual(expected, set(self.SEARCH.DOCUMENTS))
+
+    def test100_next_start(self):
+        self.do_prepare_query()
+        self.SEARCH.get_documents()
+        self.assertEqual(self.SEARCH.NEXT_START, self.ROWS)
+
+    def test105_get_all_start(self):
+        self.do_prepare_query()
+        self.SEARCH.get_all()
+        self.assertEqual(self.SEARCH.PAGED_BY, 'start')
+        self.check_all()
+
+    def test110_get_all_cursor(self):
+        self.do_prepare_query()
+        self.SEARCH.CURSOR_PAGING = True
+        self.SEARCH.get_all()
+        self.assertEqual(self.SEARCH.PAGED_BY, 'cursor')
+        self.assertNotIn('start', self.SEARCH.QUERY_AT)
+        self.assertEqual(self.SEARCH.QUERY_AT['sort'], 'id asc')
+        self.check_all()
+
+    def test115_cursor_ignored(self):
+        stub = stubsolr.StubSolr(self.DOCS, cursor=False).start()
+        try:
+            self.do_prepare_query(stub)
+            self.SEARCH.CURSOR_PAGING = None
+            self.SEARCH.get_all()
+            requests = stub.REQUESTS
+        finally:
+            stub.stop()
+        self.assertEqual(self.SEARCH.PAGED_BY, 'start')
+        self.assertEqual(requests, 10) # the first page is not fetched twice
+        self.assertFalse(fetch.CURSOR_SUPPORT[stub.ENDPOINT])
+        self.check_all()
+
+    def test117_cursor_rejected(self):
+        stub = stubsolr.StubSolr(self.DOCS, cursor='reject').start()
+        try:
+            self.do_prepare_query(stub)
+            self.SEARCH.CURSOR_PAGING = None
+            self.SEARCH.get_all()
+        finally:
+            stub.stop()
+        self.assertEqual(self.SEARCH.PAGED_BY, 'start')
+        self.assertFalse(fetch.CURSOR_SUPPORT[stub.ENDPOINT])
+        self.assertNotIn('sort', self.SEARCH.QUERY_AT)
+        self.check_all()
+
+    def test120_auto_list_ids(self):
+        fetch.CURSOR_SUPPORT.clear()
+        ids, log = self.SEARCH.auto_list_ids(self.STUB.ENDPOINT, '*', batchsize=7)
+        self.assertEqual(self.SEARCH.PAGED_BY, 'cursor')
+        self.assertEqual(len(ids), len(self.DOCS))
+        self.assertEqual(len(log), 5)
+
+class TestStubStreaming(unittest.TestCase):
+    '''Check documents can be used as they arrive.'''
+    def setUp(self):
+        self.DOCS = stubsolr.make_corpus(45)
+        self.STUB = stubsolr.StubSolr(self.DOCS).start()
+        self.SEARCH = fetch.Search('stub_streaming')
+        self.SEARCH.set_endpoint(self.STUB.ENDPOINT)
+        self.SEARCH.set_rows(10)
+
+    def tearDown(self):
+        self.STUB.stop()
+
+    def test100_iter_documents(self):
+        docs = list(self.SEARCH.iter_documents())
+        self.assertEqual(len(docs), len(self.DOCS))
+        self.assertEqual(len(docs[0]), len(self.DOCS[0]))
+        self.assertEqual(self.SEARCH.DOCUMENTS, dict())
+
+    def test105_iter_ids_only(self):
+        ids = list(self.SEARCH.iter_documents(ids_only=True))
+        self.assertEqual(set(ids), set(doc['id'] for doc in self.DOCS))
+
+    def test110_stop_early(self):
+        for doc in self.SEARCH.iter_documents():
+            break
+        self.assertLessEqual(self.STUB.REQUESTS, 2)
+
+    def test115_auto_iter_ids(self):
+        log = dict()
+        ids = self.SEARCH.auto_iter_ids(self.STUB.ENDPOINT, '*', log=log)
+        self.assertEqual(len(list(ids)), len(self.DOCS))
+        self.assertEqual(len(log), 5)
+        self.assertEqual(log['2e. Number of unique IDs'], len(self.DOCS))
+
+class FlakySearch(fetch.Search):
+    '''A search where the first fetch of each url in FAIL raises an error.'''
+    def reset(self, name):
+        fetch.Search.reset(self, name)
+        self.FAIL = list()
+        self.FETCHED = list()
+
+    def fetch_url(self, url):
+        self.FETCHED.append(url)
+        if url in self.FAIL:
+            self.FAIL.remove(url)
+            raise IOError('flaky page')
+        return fetch.Search.fetch_url(self, url)
+
+class TestStubParallel(unittest.TestCase):
+    '''Check pages fetched at the same time give the same documents.'''
+    def setUp(self):
+        self.DOCS = stubsolr.make_corpus(95)
+        self.STUB = stubsolr.StubSolr(self.DOCS).start()
+        self.SEARCH = FlakySearch('stub_parallel')
+        self.SEARCH.set_endpoint(self.STUB.ENDPOINT)
+        self.SEARCH.set_rows(10)
+        self.SEARCH.set_concurrency(4)
+
+    def tearDown(self):
+        self.STUB.stop()
+
+    def test100_get_all_parallel(self):
+        self.SEARCH.get_all()
+        self.assertEqual(self.SEARCH.PAGED_BY, 'parallel')
+        self.assertEqual(self.SEARCH.NEXT_START, len(self.DOCS))
+        self.assertEqual(self.STUB.REQUESTS, 10)
+        expected = set(doc['id'] for doc in self.DOCS)
+        self.assertEqual(expected, set(self.SEARCH.DOCUMENTS))
+
+    def test105_retry_failed_page(self):
+        self.SEARCH.set_start(50)
+        self.SEARCH.FAIL.append(self.SEARCH.make_query())
+        self.SEARCH.set_start(0)
+        self.SEARCH.get_all()
+        self.assertEqual(len(self.SEARCH.DOCUMENTS), len(self.DOCS))
+        self.assertEqual(len(self.SEARCH.FETCHED), 11) # one page twice
+        self.assertEqual(self.STUB.REQUESTS, 10)
+
+    def test110_give_up(self):
+        self.SEARCH.set_concurrency(4, retries=0)
+        self.SEARCH.set_start(50)
+        self.SEARCH.FAIL.append(self.SEARCH.make_query())
+        self.SEARCH.set_start(0)
+        self.assertRaises(IOError, self.SEARCH.get_all)
+
+class TestStubFaults(unittest.TestCase):
+    '''Check the stub can be slowed down and made to fail.'''
+    def test100_latency_errors(self):
+        stub = stubsolr.StubSolr(stubsolr.make_corpus(30), latency=0.05,
+                                 error_rate=0.5).start()
+        try:
+            failed = 0
+            start = time.time()
+            for count in range(8):
+                search = fetch.Search('stub_faults')
+                search.set_endpoint(stub.ENDPOINT)
+                try:
+                    search.get_documents()
+                except urllib2.HTTPError, error:
+                    self.assertEqual(error.code, 503)
+                    failed += 1
+            self.assertGreaterEqual(time.time()-start, 8*0.05)
+        finally:
+            stub.stop()
+        self.assertEqual((stub.REQUESTS, stub.ERRORS), (8, failed))
+        self.assertTrue(0 < failed < 8)
+
+class TestStubAdaptive(unittest.TestCase):
+    '''Check the pages at once grow while the stub copes and then back off.'''
+    def setUp(self):
+        self.DOCS = stubsolr.make_corpus(300)
+        self.STUB = stubsolr.StubSolr(self.DOCS, latency=0.01).start()
+        self.SEARCH = fetch.Search('stub_adaptive')
+        self.SEARCH.set_endpoint(self.STUB.ENDPOINT)
+        self.SEARCH.set_rows(10)
+
+    def tearDown(self):
+        self.STUB.stop()
+
+    def test100_grows(self):
+        self.SEARCH.set_adaptive(6)
+        self.SEARCH.get_all()
+        self.assertEqual(self.SEARCH.PAGED_BY, 'parallel')
+        self.assertEqual(len(self.SEARCH.DOCUMENTS), len(self.DOCS))
+        control = workers.controller_for(self.STUB.ENDPOINT)
+        self.assertGreater(control.LIMIT, workers.FIRST_LIMIT)
+        most = httppool.POOL.HOST_LIMIT # 6 would queue for connections
+        self.assertEqual(control.MOST, most)
+        self.assertTrue(1 < control.STATS['most_active'] <= most)
+        self.assertEqual(control.STATS['overloads'], 0)
+        self.assertTrue(1 <= self.SEARCH.ADAPTED['settled'] <= most)
+
+    def test105_backs_off(self):
+        control = workers.controller_for(self.STUB.ENDPOINT, 8)
+        control.LIMIT = 4.0
+        self.STUB.ERROR_RATE = 1.0
+        self.assertRaises(urllib2.HTTPError, self.SEARCH.get_documents)
+        self.assertEqual(control.LIMIT, 2.0)
+        self.assertEqual(control.STATS['overloads'], 1)
+        start = time.time()
+        control.acquire() # waits for the Retry-After of the 503
+        control.release()
+        self.assertGreaterEqual(time.time()-start, 0.5)
+
+class TestStubPool(unittest.TestCase):
+    '''Check searches share keep-alive connections.'''
+    def setUp(self):
+        self.STUB = stubsolr.StubSolr(stubsolr.make_corpus(30)).start()
+        self.POOL = httppool.ConnectionPool(size=4, host_limit=2)
+
+    def tearDown(self):
+        self.POOL.close_all()
+        self.STUB.stop()
+
+    def do_open(self, url=None):
+        load = self.POOL.urlopen(url or self.STUB.ENDPOINT+'q=*:*')
+        data = load.read()
+        load.close()
+        return data
+
+    def test100_reuse(self):
+        for count in range(3):
+            self.do_open()
+        stats = self.POOL.stats()
+        self.assertEqual(stats['requests'], 3)
+        self.assertEqual(stats['opened'], 1)
+        self.assertEqual(stats['reused'], 2)
+
+    def test105_shared_by_searches(self):
+        httppool.POOL.reset_stats()
+        for name in ('one', 'two'):
+            search = fetch.Search(name)
+            search.set_endpoint(self.STUB.ENDPOINT)
+            search.get_documents()
+        self.assertEqual(httppool.POOL.stats()['reused'], 1)
+
+    def test110_idle_timeout(self):
+        self.POOL.configure(idle_timeout=0)
+        self.do_open()
+        self.do_open()
+        self.assertEqual(self.POOL.stats()['reused'], 0)
+
+    def test115_http_error(self):
+        url = 'http://127.0.0.1:%s/solr/select?q=bad'%self.STUB.PORT
+        self.assertRaises(urllib2.HTTPError, self.do_open, url)
+        self.do_open() # the connection is still usable
+        self.assertEqual(self.POOL.stats()['reused'], 1)
+
+    def test117_stalled_bodies(self):
+        self.STUB.STALL = 0.5
+        url = self.STUB.ENDPOINT+'q=*:*'
+        for count in range(self.POOL.HOST_LIMIT+1): # would block if leaked
+            load = self.POOL.urlopen(url, timeout=0.1)
+            self.assertRaises(socket.timeout, load.read)
+        self.assertEqual(sum(self.POOL.ACTIVE.values()), 0)
+        self.STUB.STALL = 0.0
+        self.assertTrue('numFound' in self.do_open())
+
+    def test118_host_limits(self):
+        self.POOL.limit_host(self.STUB.ENDPOINT, 1)
+        key = httppool.key_of(self.STUB.ENDPOINT)
+        conn, reused = self.POOL.acquire(key)
+        self.assertRaises(socket.timeout, self.POOL.acquire, key, 0.1)
+        other = ('http', 'example.org', 80) # keeps the pool's limit of 2
+        for count in range(2):
+            self.POOL.acquire(other, 0.1)
+        self.POOL.release(key, conn, False)
+        self.assertTrue('numFound' in self.do_open())
+
+    def test120_proxy(self):
+        saved = dict((name, os.environ.pop(name, None))
+                     for name in ('http_proxy', 'no_proxy'))
+        # The stub answers a proxy request as it would a direct one.
+        os.environ['http_proxy'] = 'http://127.0.0.1:%s'%self.STUB.PORT
+        try:
+            data = self.do_open('http://solr.invalid/solr/select?q=*:*')
+        finally:
+            del os.environ['http_proxy']
+            for name, value in saved.items():
+                if value is not None:
+                    os.environ[name] = value
+        self.assertTrue('numFound' in data)
+        self.assertEqual(self.POOL.stats()['proxied'], 1)
+        self.assertEqual(self.POOL.stats()['requests'], 0)
+
+class TestStubCompress(unittest.TestCase):
+    '''Check compressed pages are asked for, unpacked and measured.'''
+    def setUp(self):
+        self.STUB = stubsolr.StubSolr(stubsolr.make_corpus(50)).start()
+        self.SEARCH = fetch.Search('stub_compress')
+        self.SEARCH.set_endpoint(self.STUB.ENDPOINT)
+        self.SEARCH.set_rows(50)
+
+    def tearDown(self):
+        self.STUB.stop()
+
+    def test100_gzip(self):
+        docs = self.SEARCH.get_documents()
+        self.assertEqual(len(docs), 50)
+        info = self.SEARCH.TRANSFERS[-1]
+        self.assertEqual(info['encoding'], 'gzip')
+        self.assertEqual(info['bytes'], len(self.SEARCH.RAWDATA))
+        self.assertLess(info['wire_bytes'], info['bytes'])
+
+    def test105_no_compression(self):
+        self.SEARCH.set_compression(False)
+        self.SEARCH.get_documents()
+        info = self.SEARCH.TRANSFERS[-1]
+        self.assertEqual(info['encoding'], 'identity')
+        self.assertEqual(info['wire_bytes'], info['bytes'])
+
+    def test110_summary(self):
+        self.SEARCH.get_documents()
+        self.SEARCH.get_documents()
+        summary = self.SEARCH.transfer_summary()
+        self.assertEqual(summary['requests'], 2)
+        self.assertGreater(summary['ratio'], 1.0)
+
+class TestStubCache(unittest.TestCase):
+    '''Check responses are kept on disk and checked when stale.'''
+    def setUp(self):
+        self.STUB = stubsolr.StubSolr(stubsolr.make_corpus(20)).start()
+        self.ROOT = tempfile.mkdtemp()
+        self.CACHE = cache.ResponseCache(self.ROOT)
+
+    def tearDown(self):
+        self.STUB.stop()
+        shutil.rmtree(self.ROOT)
+
+    def do_search(self, ttl=None):
+        search = fetch.Search('stub_cache')
+        search.set_endpoint(self.STUB.ENDPOINT)
+        search.set_cache(self.CACHE, ttl)
+        search.get_documents()
+        return search
+
+    def test100_hit(self):
+        first = self.do_search()
+        second = self.do_search()
+        self.assertEqual(self.STUB.REQUESTS, 1)
+        self.assertEqual(second.TRANSFERS[-1]['cache'], 'hit')
+        self.assertEqual(first.RAWDATA, second.RAWDATA)
+
+    def test105_revalidate(self):
+        first = self.do_search(ttl=0)
+        second = self.do_search(ttl=0)
+        self.assertEqual(self.STUB.REQUESTS, 2)
+        self.assertEqual(second.TRANSFERS[-1]['cache'], 'revalidated')
+        self.assertEqual(second.TRANSFERS[-1]['wire_bytes'], 0)
+        self.assertEqual(first.RAWDATA, second.RAWDATA)
+        self.assertEqual(self.CACHE.stats()['revalidated'], 1)
+
+    def test110_normal_url(self):
+        one = cache.normal_url('http://Host/solr?q=a&wt=json&rows=2')
+        two = cache.normal_url('http://host/solr?rows=2&q=a&wt=json')
+        self.assertEqual(one, two)
+
+    def test115_evict_oldest(self):
+        self.CACHE.MAX_BYTES = 25
+        for name in ('a', 'b', 'c'):
+            self.CACHE.store('http://host/?q=%s'%name, name*10)
+        self.assertEqual(self.CACHE.stats()['evictions'], 1)
+        self.assertEqual(self.CACHE.stats()['bytes'], 20)
+        self.assertEqual(self.CACHE.lookup('http://host/?q=a'), None)
+        self.assertEqual(self.CACHE.lookup('http://host/?q=b')['body'], 'b'*10)
+
+    def test120_ttl_for_date(self):
+        self.assertEqual(cache.ttl_for_date((2012, 1, 1)), cache.PAST_TTL)
+        self.assertEqual(cache.ttl_for_date((2013, 5, 2), (2013, 5, 2)),
+                         cache.DEFAULT_TTL)
+        # Earlier this month is still changing, as years.settled says.
+        self.assertEqual(cache.ttl_for_date((2013, 5, 1), (2013, 5, 20)),
+                         cache.DEFAULT_TTL)
+        self.assertEqual(cache.ttl_for_date((2013, 4, 30), (2013, 5, 20)),
+                         cache.PAST_TTL)
+
+class TestStubCount(unittest.TestCase):
+    '''Check counts need no documents and are only asked for once.'''
+    def setUp(self):
+        self.DOCS = stubsolr.make_corpus(95)
+        self.STUB = stubsolr.StubSolr(self.DOCS).start()
+        fetch.COUNTS.clear() # counts from other tests' stubs on this port
+
+    def tearDown(self):
+        self.STUB.stop()
+        fetch.COUNTS.clear()
+
+    def make_search(self, fields='id'):
+        search = fetch.Search('stub_count')
+        search.set_endpoint(self.STUB.ENDPOINT)
+        search.query('funder', 'jisc')
+        search.set_field_getlist(fields)
+        search.set_rows(10)
+        return search
+
+    def test100_count_same(self):
+        search = self.make_search()
+        search.get_all()
+        expected = len(search.DOCUMENTS)
+        self.assertGreater(expected, 0)
+        self.assertEqual(self.make_search().count(memo=None), expected)
+        self.assertTrue('rows=0' in self.make_search().make_count_query())
+
+    def test102_unicode_query(self):
+        search = self.make_search()
+        search.query('author', u'M\xfcller')
+        self.assertTrue('M%C3%BCller' in search.make_query())
+        self.assertTrue('M%C3%BCller' in search.make_count_query())
+
+    def test105_count_memo(self):
+        memo = fetch.CountMemo(2)
+        first = self.make_search().count(memo)
+        before = self.STUB.REQUESTS
+        # Asking for other fields or rows does not change the count.
+        again = self.make_search(('id', 'title'))
+        self.assertEqual(again.count(memo), first)
+        self.assertEqual(again.DOCS_FOUND, first)
+        self.assertEqual(self.STUB.REQUESTS, before)
+        self.assertEqual(memo.STATS, {'hits': 1, 'misses': 1})
+        # Only the two most recently used counts are kept.
+        for value in ('wellcome', 'epsrc'):
+            search = self.make_search()
+            search.query('funder', value)
+            search.count(memo)
+        self.make_search().count(memo)
+        self.assertEqual(self.STUB.REQUESTS, before+3)
+
+class TestStubStreamDecode(unittest.TestCase):
+    '''Check documents decoded as they arrive match whole page decoding.'''
+    def setUp(self):
+        self.DOCS = stubsolr.make_corpus(120)
+        self.STUB = stubsolr.StubSolr(self.DOCS).start()
+
+    def tearDown(self):
+        self.STUB.stop()
+
+    def chunks(self, text, size):
+        return [text[at:at+size] for at in range(0, len(text), size)]
+
+    def test100_chunks(self):
+        data = {'responseHeader': {'params': {'q': 'title:"docs":['}},
+                'response': {'numFound': 2, 'start': 0,
+                             'docs': [{'id': 'a', 'title': u'caf\xe9 ]'},
+                                      {'id': 'b', 'n': [1, {'docs': []}]}]},
+                'nextCursorMark': 'x'}
+        text = json.dumps(data, ensure_ascii=False).encode('utf8')
+        for size in (1, 7, 64, len(text)):
+            docs, rest = jsondecode.stream_docs(self.chunks(text, size))
+            self.assertEqual(docs, data['response']['docs'])
+            self.assertEqual(rest['response']['docs'], [])
+            self.assertEqual(rest['nextCursorMark'], 'x')
+        text = json.dumps({'facet_counts': {}})
+        docs, rest = jsondecode.stream_docs(self.chunks(text, 5))
+        self.assertEqual((docs, rest), ([], {'facet_counts': {}}))
+        self.assertRaises(ValueError, jsondecode.stream_docs,
+                          self.chunks(text.replace('{}', '[{"docs":['), 3))
+
+    def test105_same_documents(self):
+        found = list()
+        for stream in (False, True):
+            search = fetch.Search('stub_stream')
+            search.set_endpoint(self.STUB.ENDPOINT)
+            search.set_rows(50)
+            search.set_streaming(stream)
+            docs = search.get_documents()
+            found.append((docs, search.DOCS_FOUND, search.NEXT_START,
+                          search.TRANSFERS[-1]['bytes']))
+        self.assertEqual(found[0], found[1])
+        search = fetch.Search('stub_stream')
+        ids, log = search.auto_list_ids(self.STUB.ENDPOINT, 'jisc',
+                                        'funder', 20)
+        self.assertTrue(search.STREAM)
+        expected = [doc['id'] for doc in self.DOCS
+                    if 'jisc' in doc['funder'].lower()]
+        self.assertEqual(sorted(ids), sorted(expected))
+
+    def test110_iter_same(self):
+        found = list()
+        for stream in (False, True):
+            search = fetch.Search('stub_stream')
+            search.set_endpoint(self.STUB.ENDPOINT)
+            search.set_rows(50)
+            search.set_streaming(stream)
+            found.append(list(search.iter_documents()))
+        self.assertEqual(found[0], found[1])
+        self.assertEqual(len(found[1]), len(self.DOCS))
+
+    def test115_get_all_streamed(self):
+        found = list()
+        for stream in (False, True):
+            search = fetch.Search('stub_stream')
+            search.set_endpoint(self.STUB.ENDPOINT)
+            search.set_rows(50)
+            search.set_streaming(stream)
+            search.get_all()
+            found.append((search.DOCUMENTS, search.NEXT_START,
+                          search.PAGED_BY))
+        self.assertEqual(found[0], found[1])
+        self.assertEqual(len(found[1][0]), len(self.DOCS))
+
+class TestStubRecords(unittest.TestCase):
+    '''Check compact records keep the same documents and ids.'''
+    def setUp(self):
+        self.DOCS = stubsolr.make_corpus(95)
+        self.STUB = stubsolr.StubSolr(self.DOCS).start()
+
+    def tearDown(self):
+        self.STUB.stop()
+
+    def test100_id_set(self):
+        ids = [doc['id'] for doc in stubsolr.make_corpus(3000)]
+        packed = records.IdSet(ids)
+        self.assertEqual(len(packed), 3000)
+        self.assertEqual(sorted(packed), sorted(ids))
+        self.assertFalse(packed.add(ids[10]))
+        self.assertTrue(ids[2999] in packed)
+        self.assertFalse('uuid:00000000-0000-0000-0000-000000000001' in packed)
+        # Ids that are not plain lower case uuids are kept as they are.
+        for other in ('doi:10.1/abc', ids[0].upper(), 'uuid:1234'):
+            self.assertTrue(packed.add(other))
+            self.assertTrue(other in packed)
+        self.assertEqual(len(packed), 3003)
+        self.assertLess(packed.nbytes(), 3000*16*4)
+
+    def test105_compact_list(self):
+        plain = fetch.Search('stub_records')
+        ids, log = plain.auto_list_ids(self.STUB.ENDPOINT, 'jisc', 'funder', 20)
+        compact = fetch.Search('stub_records')
+        packed, log = compact.auto_list_ids(self.STUB.ENDPOINT, 'jisc',
+                                            'funder', 20, compact=True)
+        self.assertTrue(isinstance(packed, records.IdSet))
+        self.assertEqual(sorted(packed), sorted(ids))
+        self.assertEqual(log['2e. Number of unique IDs'], len(ids))
+
+    def test110_tuple_records(self):
+        search = fetch.Search('stub_records')
+        search.set_endpoint(self.STUB.ENDPOINT)
+        search.set_field_getlist(('id', 'title'))
+        search.set_rows(50)
+        search.set_records('tuple')
+        search.get_all()
+        self.assertEqual(len(search.DOCUMENTS), len(self.DOCS))
+        first = self.DOCS[0]
+        record = search.DOCUMENTS[first['id']]
+        self.assertEqual((record.id, record.title),
+                         (first['id'], first['title']))
+        self.assertRaises(ValueError, search.set_records, 'list')
+        bare = fetch.Search('stub_records')
+        self.assertRaises(ValueError, bare.set_records, 'tuple')
+
+    def test115_tuple_fl(self):
+        search = fetch.Search('stub_records')
+        search.set_endpoint(self.STUB.ENDPOINT)
+        search.set_rows(50)
+        search.set_at('fl', 'id, title funder')
+        search.set_records('tuple')
+        search.get_all()
+        first = self.DOCS[0]
+        record = search.DOCUMENTS[first['id']]
+        self.assertEqual(record._fields, ('id', 'title', 'funder'))
+        self.assertEqual(record.funder, first['funder'])
+        # The fields * stands for are not known, so whole documents are kept.
+        search = fetch.Search('stub_records')
+        search.set_endpoint(self.STUB.ENDPOINT)
+        search.set_rows(50)
+        search.set_at('fl', 'id,*')
+        search.set_records('tuple')
+        search.get_all()
+        self.assertEqual(search.DOCUMENTS[first['id']], first)
+
+class TestStubReplay(unittest.TestCase):
+    '''Check a recorded search can be played back without the source.'''
+    def setUp(self):
+        self.DOCS = stubsolr.make_corpus(95)
+        self.STUB = stubsolr.StubSolr(self.DOCS).start()
+        self.ROOT = tempfile.mkdtemp()
+        self.PATH = os.path.join(self.ROOT, 'run.archive')
+
+    def tearDown(self):
+        self.STUB.stop()
+        shutil.rmtree(self.ROOT)
+
+    def do_list(self, transport):
+        search = fetch.Search('stub_replay')
+        search.set_transport(transport)
+        return search.auto_list_ids(self.STUB.ENDPOINT, 'jisc', 'funder', 20)
+
+    def test100_replay_same(self):
+        recorder = replay.RecordTransport(self.PATH)
+        ids, log = self.do_list(recorder)
+        bad = fetch.Search('stub_replay')
+        bad.set_transport(recorder)
+        self.assertRaises(urllib2.HTTPError, bad.fetch_url,
+                          self.STUB.ENDPOINT+'q=nocolon')
+        recorder.close()
+        self.assertEqual(recorder.COUNT, self.STUB.REQUESTS)
+        endpoint = self.STUB.ENDPOINT
+        self.STUB.stop() # so nothing can come from the source
+        player = replay.ReplayTransport(self.PATH)
+        again, log = self.do_list(player)
+        self.assertEqual(sorted(again), sorted(ids))
+        try:
+            bad.set_transport(player)
+            bad.fetch_url(endpoint+'q=nocolon')
+            self.fail('the recorded error was not raised')
+        except urllib2.HTTPError, error:
+            self.assertEqual(error.code, 400)
+        self.assertEqual((player.MISSES, player.unused()), ([], []))
+        self.assertRaises(replay.ReplayMiss, bad.fetch_url, endpoint+'q=id:1')
+        self.assertEqual(len(player.MISSES), 1)
+        self.assertTrue('missed\t%sq=id:1'%endpoint in player.report())
+        player.close()
+
+    def test105_no_index(self):
+        recorder = replay.RecordTransport(self.PATH)
+        ids, log = self.do_list(recorder)
+        recorder.ARCHIVE.FILE.flush() # as if the run stopped here
+        archive = replay.Archive(self.PATH)
+        self.assertEqual(sum(len(places) for places in
+                             archive.INDEX.values()), recorder.COUNT)
+        archive.close()
+        recorder.close()
+
+    def test110_threads(self):
+        recorder = replay.RecordTransport(self.PATH)
+        def fetch_page(start):
+            load = recorder.urlopen(self.STUB.ENDPOINT+'q=*:*&start=%s'%start)
+            return load.read()
+        workers.map_ordered(fetch_page, range(0, 95, 5), 8)
+        recorder.close()
+        self.assertEqual(recorder.COUNT, 19)
+        archive = replay.Archive(self.PATH)
+        self.assertEqual(sum(len(places) for places in
+                             archive.INDEX.values()), 19)
+        archive.close()
+
+# ===============================================================
+#  Enable use of these tests by external script.
+# ===============================================================
+SUITE_NAME = str(__name__)
+TESTS_AVAILABLE = [TestStubPaging, TestStubStreaming, TestStubParallel,
+                   TestStubFaults, TestStubAdaptive, TestStubPool,
+                   TestStubCompress, TestStubCache, TestStubCount,
+                   TestStubStreamDecode, TestStubRecords, TestStubReplay]
+def suite(tests=TESTS_AVAILABLE):
+    '''Return a test suite of tests so this can run run by external script.'''
+    suite  = unittest.TestSuite()
+    for test in tests:
+        suite.addTests(unittest.TestLoader().loadTestsFromTestCase(test))
+    return suite 
+    
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
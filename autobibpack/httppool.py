@@ -0,0 +1,339 @@
+'''Keep-alive HTTP connections shared by every search and report.
+
+Opening a new connection for every request means thousands of TCP
+handshakes in a single report. This module keeps idle connections open
+for each host so the next request can use them again.
+
+Using the pool
+==============
+The module level POOL is shared by fetch.Search, DateLoader and vidcount.
+load = urlopen(url) # use like urllib2.urlopen
+data = load.read()
+load.close() # gives the connection back to the pool
+POOL.configure(size=10, host_limit=2, idle_timeout=60)
+print POOL.stats()
+use_transport(replay.ReplayTransport(path)) # answer from an archive instead
+
+A host reached through a proxy, from http_proxy, https_proxy and
+no_proxy in the environment, is asked with urllib2 as before, without
+keeping connections open or the per host limit.
+'''
+import httplib
+import urlparse
+import threading
+import socket
+import time
+import urllib
+import urllib2
+import StringIO
+
+POOL_SIZE = 20 # Most idle connections kept across all hosts.
+HOST_LIMIT = 4 # Most connections open to one host at the same time.
+IDLE_TIMEOUT = 30.0 # Seconds an unused connection is kept open.
+MAX_REDIRECTS = 5 # How many redirects to follow, like urllib2.
+USER_AGENT = 'autobib (Python-urllib/%s)'%urllib2.__version__
+
+class PooledResponse(object):
+    '''A response that gives its connection back to the pool when closed.
+
+    It can be used like the file returned by urllib2.urlopen.'''
+    def __init__(self, pool, key, conn, response, url):
+        self.POOL = pool
+        self.KEY = key
+        self.CONN = conn
+        self.RESPONSE = response
+        self.URL = url
+        self.code = response.status
+        self.msg = response.reason
+        self.headers = response.msg
+
+    def info(self):
+        return self.headers
+
+    def geturl(self):
+        return self.URL
+
+    def getheader(self, name, default=None):
+        return self.RESPONSE.getheader(name, default)
+
+    def read(self, amt=None):
+        '''Read amt bytes or everything that is left.'''
+        if self.CONN is None:
+            return ''
+        try:
+            data = self.RESPONSE.read(amt)
+        except: # e.g. a timeout part way, the connection can not be used
+            self.POOL.release(self.KEY, self.CONN, False)
+            self.CONN = None
+            raise
+        if self.RESPONSE.isclosed(): # all read, so the connection is free
+            self.close()
+        return data
+
+    def close(self):
+        '''Give the connection back, only keeping it if it was fully read.'''
+        if self.CONN is None:
+            return
+        response = self.RESPONSE
+        keep = response.isclosed() and not response.will_close
+        self.POOL.release(self.KEY, self.CONN, keep)
+        self.CONN = None
+
+class ProxiedResponse(object):
+    '''A response from urllib2 through a proxy, used like a PooledResponse.'''
+    def __init__(self, load):
+        self.LOAD = load
+        self.URL = load.geturl()
+        self.code = load.code
+        self.msg = load.msg
+        self.headers = load.info()
+
+    def info(self):
+        return self.headers
+
+    def geturl(self):
+        return self.URL
+
+    def getheader(self, name, default=None):
+        return self.headers.getheader(name, default)
+
+    def read(self, amt=None):
+        if amt is None:
+            return self.LOAD.read()
+        return self.LOAD.read(amt)
+
+    def close(self):
+        self.LOAD.close()
+
+def uses_proxy(url):
+    '''Return True if the environment sends requests for url to a proxy.'''
+    parts = urlparse.urlsplit(url)
+    return parts.scheme in urllib.getproxies() and \
+           not urllib.proxy_bypass(parts.hostname or '')
+
+def key_of(url):
+    '''Return the (scheme, host, port) the pool keeps connections for url by.'''
+    parts = urlparse.urlsplit(url)
+    port = parts.port or {'http': 80, 'https': 443}.get(parts.scheme)
+    return (parts.scheme, parts.hostname, port)
+
+class ConnectionPool(object):
+    '''Idle keep-alive connections keyed by scheme, host and port.'''
+    def __init__(self, size=POOL_SIZE, host_limit=HOST_LIMIT,
+                 idle_timeout=IDLE_TIMEOUT):
+        self.LOCK = threading.Condition()
+        self.IDLE = dict() # key = (scheme, host, port), list of (conn, when)
+        self.ACTIVE = dict() # key = (scheme, host, port), connections in use
+        self.HOST_LIMITS = dict() # key = (scheme, host, port), its own limit
+        self.configure(size, host_limit, idle_timeout)
+        self.reset_stats()
+
+    def configure(self, size=None, host_limit=None, idle_timeout=None):
+        '''Change the size, per host limit or idle timeout of the pool.'''
+        with self.LOCK:
+            if size is not None:
+                self.SIZE = size
+            if host_limit is not None:
+                self.HOST_LIMIT = host_limit
+            if idle_timeout is not None:
+                self.IDLE_TIMEOUT = idle_timeout
+            self.LOCK.notify_all()
+
+    def limit_host(self, url, host_limit=None):
+        '''Give the host of url its own limit, or the pool's if None.'''
+        key = key_of(url)
+        with self.LOCK:
+            if host_limit is None:
+                self.HOST_LIMITS.pop(key, None)
+            else:
+                self.HOST_LIMITS[key] = host_limit
+            self.LOCK.notify_all()
+
+    def host_limit(self, url):
+        '''Return the most connections open at once to the host of url.'''
+        return self.HOST_LIMITS.get(key_of(url), self.HOST_LIMIT)
+
+    def reset_stats(self):
+        '''Set the connection counters back to zero.'''
+        self.STATS = {'requests': 0, # requests sent
+                      'opened': 0, # new connections made
+                      'reused': 0, # requests sent on an idle connection
+                      'discarded': 0, # connections closed by the pool
+                      'waits': 0, # times the per host limit made us wait
+                      'proxied': 0} # requests sent with urllib2 to a proxy
+
+    def stats(self):
+        '''Return a copy of the counters with the connection reuse ratio.'''
+        with self.LOCK:
+            found = dict(self.STATS)
+        requests = found['requests'] or 1
+        found['reuse_ratio'] = found['reused']/float(requests)
+        return found
+
+    def _count(self, name):
+        with self.LOCK:
+            self.STATS[name] += 1
+
+    def _expire(self, now):
+        '''Close idle connections that are too old or over the pool size.'''
+        idle = list()
+        for key in self.IDLE:
+            for conn, when in self.IDLE[key]:
+                idle.append((when, key, conn))
+        idle.sort()
+        keep = idle[len(idle)-self.SIZE:] if self.SIZE > 0 else []
+        for when, key, conn in idle:
+            if (when, key, conn) in keep and now-when < self.IDLE_TIMEOUT:
+                continue
+            self.IDLE[key].remove((conn, when))
+            conn.close()
+            self.STATS['discarded'] += 1
+
+    def acquire(self, key, timeout=None):
+        '''Return (connection, reused) for key, waiting for the host limit.
+        
+        With a timeout, socket.timeout is raised if no connection is
+        free for key within that many seconds.'''
+        give_up = None if timeout is None else time.time()+timeout
+        with self.LOCK:
+            while True:
+                self._expire(time.time())
+                if self.IDLE.get(key):
+                    conn, when = self.IDLE[key].pop()
+                    reused = True
+                    break
+                limit = self.HOST_LIMITS.get(key, self.HOST_LIMIT)
+                if self.ACTIVE.get(key, 0) < limit:
+                    conn = None
+                    reused = False
+                    break
+                self.STATS['waits'] += 1
+                if give_up is None:
+                    self.LOCK.wait()
+                    continue
+                left = give_up-time.time()
+                if left <= 0:
+                    raise socket.timeout('timed out waiting for a connection'
+                                         ' to %s:%s'%key[1:])
+                self.LOCK.wait(left)
+            self.ACTIVE[key] = self.ACTIVE.get(key, 0)+1
+        if conn is None:
+            scheme, host, port = key
+            if scheme == 'https':
+                maker = httplib.HTTPSConnection
+            else:
+                maker = httplib.HTTPConnection
+            if timeout is None:
+                conn = maker(host, port)
+            else:
+                conn = maker(host, port, timeout=timeout)
+            self._count('opened')
+        else:
+            conn.timeout = timeout
+            if conn.sock is not None:
+                conn.sock.settimeout(timeout)
+        return conn, reused
+
+    def release(self, key, conn, keep=True):
+        '''Give back a connection, closing it unless keep is True.'''
+        with self.LOCK:
+            self.ACTIVE[key] -= 1
+            if keep and self.SIZE > 0:
+                self.IDLE.setdefault(key, list()).append((conn, time.time()))
+            else:
+                conn.close()
+                self.STATS['discarded'] += 1
+            self.LOCK.notify_all()
+
+    def close_all(self):
+        '''Close every idle connection.'''
+        with self.LOCK:
+            for key in self.IDLE:
+                for conn, when in self.IDLE[key]:
+                    conn.close()
+            self.IDLE = dict()
+
+    def _send(self, key, path, headers, timeout):
+        '''Send a request on a pooled connection, return (conn, response).'''
+        conn, reused = self.acquire(key, timeout)
+        try:
+            conn.request('GET', path, headers=headers)
+            response = conn.getresponse()
+        except (httplib.HTTPException, socket.error):
+            self.release(key, conn, False)
+            if not reused:
+                raise
+            # The server may have closed an idle connection, so try a new one.
+            conn, reused = self.acquire(key, timeout)
+            try:
+                conn.request('GET', path, headers=headers)
+                response = conn.getresponse()
+            except:
+                self.release(key, conn, False)
+                raise
+        self._count('requests')
+        if reused:
+            self._count('reused')
+        return conn, response
+
+    def urlopen(self, url, timeout=None, headers=None):
+        '''Return a PooledResponse for url, raising errors like urllib2.'''
+        send = {'User-Agent': USER_AGENT}
+        send.update(headers or dict())
+        if uses_proxy(url):
+            return self.urlopen_proxied(url, timeout, send)
+        for count in range(MAX_REDIRECTS+1):
+            parts = urlparse.urlsplit(url)
+            if parts.scheme not in ('http', 'https'):
+                raise urllib2.URLError('unknown url type: %s'%parts.scheme)
+            key = key_of(url)
+            path = parts.path or '/'
+            if parts.query:
+                path += '?'+parts.query
+            try:
+                conn, response = self._send(key, path, send, timeout)
+            except (httplib.HTTPException, socket.error), error:
+                raise urllib2.URLError(error)
+            load = PooledResponse(self, key, conn, response, url)
+            if load.code in (301, 302, 303, 307) and load.getheader('location'):
+                load.read()
+                load.close()
+                url = urlparse.urljoin(url, load.getheader('location'))
+                continue
+            if load.code >= 400:
+                body = StringIO.StringIO(load.read())
+                load.close()
+                raise urllib2.HTTPError(url, load.code, load.msg,
+                                        load.headers, body)
+            return load
+        raise urllib2.URLError('too many redirects for %s'%url)
+
+    def urlopen_proxied(self, url, timeout, headers):
+        '''Return a ProxiedResponse for url, opened by urllib2's proxy.'''
+        self._count('proxied')
+        request = urllib2.Request(url, headers=headers)
+        try:
+            if timeout is None:
+                return ProxiedResponse(urllib2.urlopen(request))
+            return ProxiedResponse(urllib2.urlopen(request, timeout=timeout))
+        except urllib2.HTTPError, error:
+            if error.code == 304: # not modified is an answer, as in the pool
+                return ProxiedResponse(error)
+            raise
+
+POOL = ConnectionPool() # The pool shared by all searches and reports.
+TRANSPORT = None # Sends every request instead of POOL when set.
+
+def use_transport(transport=None):
+    '''Send every request with transport, e.g. a replay.ReplayTransport.
+
+    Anything with a urlopen(url, timeout, headers) method will do. None
+    goes back to the shared pool.'''
+    global TRANSPORT
+    TRANSPORT = transport
+
+def urlopen(url, timeout=None, headers=None):
+    '''Open url using a connection from the shared pool, or TRANSPORT.'''
+    if TRANSPORT is not None:
+        return TRANSPORT.urlopen(url, timeout, headers)
+    return POOL.urlopen(url, timeout, headers)
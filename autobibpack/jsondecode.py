@@ -0,0 +1,110 @@
+'''Decode Solr JSON responses, a document at a time if wanted.
+
+A page of 999 documents decoded in one go needs the whole text and the
+whole decoded tree in memory together. StreamedPage decodes the items
+of response.docs one at a time as the chunks of text arrive, so only
+the documents not yet used and a chunk of text are held.
+
+A faster decoder is used for whole pages when one is installed, ujson
+or simplejson, otherwise the standard json module.
+
+Using the decoder
+=================
+page = StreamedPage(compress.iter_body(load))
+for doc in page.docs():
+    print doc['id']
+print page.DATA['response']['numFound'] # the rest, with docs as []
+'''
+import re
+import json
+
+try:
+    import ujson as fast_json
+except ImportError:
+    try:
+        import simplejson as fast_json
+    except ImportError:
+        fast_json = None
+
+DECODER = json.JSONDecoder() # Decodes one document from a buffer.
+DOCS_START = re.compile(r'"docs"\s*:\s*\[')
+RESPONSE_START = re.compile(r'"response"\s*:\s*\{')
+SPACE = re.compile(r'[\s,]*')
+KEEP_TEXT = 65536 # Characters of used text kept before the buffer is cut.
+
+def loads(text):
+    '''Return the decoded JSON text using the fastest decoder there is.'''
+    if fast_json is not None:
+        return fast_json.loads(text)
+    return json.loads(text)
+
+class StreamedPage(object):
+    '''The documents of one response decoded as its text arrives.'''
+    def __init__(self, chunks):
+        self.CHUNKS = iter(chunks)
+        self.DATA = None # The response without its docs, once all are read.
+        self.COUNT = 0 # Documents decoded so far.
+
+    def more(self):
+        '''Return the next chunk of text, or None at the end.'''
+        for chunk in self.CHUNKS:
+            if chunk:
+                return chunk
+        return None
+
+    def docs(self):
+        '''Yield each item of response.docs, then set DATA from the rest.'''
+        head = ''
+        while True: # find where the docs of the response start
+            found = RESPONSE_START.search(head)
+            start = found and DOCS_START.search(head, found.end())
+            if start:
+                break
+            chunk = self.more()
+            if chunk is None: # not a list of documents, so decode it all
+                self.DATA = loads(head)
+                for doc in self.DATA.get('response', dict()).get('docs', []):
+                    self.COUNT += 1
+                    yield doc
+                return
+            head += chunk
+        buf = head[start.end():]
+        head = head[:start.end()]
+        pos = 0
+        while True:
+            pos = SPACE.match(buf, pos).end()
+            if pos < len(buf) and buf[pos] == ']':
+                break
+            try:
+                if pos == len(buf):
+                    raise ValueError('need more text')
+                doc, end = DECODER.raw_decode(buf, pos)
+            except ValueError:
+                chunk = self.more()
+                if chunk is None:
+                    raise ValueError('response ended inside the docs')
+                buf = buf[pos:]+chunk
+                pos = 0
+                continue
+            pos = end
+            if pos > KEEP_TEXT:
+                buf = buf[pos:]
+                pos = 0
+            self.COUNT += 1
+            yield doc
+        rest = [buf[pos:]]
+        while True:
+            chunk = self.more()
+            if chunk is None:
+                break
+            rest.append(chunk)
+        self.DATA = loads(head+''.join(rest))
+
+def stream_docs(chunks):
+    '''Return (list of docs, rest of the response) read from chunks.
+    
+    The text is never held whole, but the decoded docs are, for callers
+    that want a page. Use StreamedPage.docs() for one at a time.'''
+    page = StreamedPage(chunks)
+    docs = list(page.docs())
+    return docs, page.DATA
@@ -0,0 +1,209 @@
+'''Record the latency, size and outcome of every request made.
+
+Each Solr query made by fetch.Search and each stats file read by
+vidcount is recorded with its URL template, latency, bytes, the Solr
+QTime, whether the cache answered it and the class of any error.
+Samples are gathered for each kind of request and endpoint into a
+latency histogram and percentiles, so a slow run shows whether the
+time went on Solr, the remote stats server or the local disk.
+
+Using the metrics
+=================
+METRICS is shared by every search and report unless told otherwise.
+METRICS.reset()
+... run a report ...
+print METRICS.report()
+METRICS.add_hook(my_function) # called with each sample as a dictionary
+watch(my_function) # the same for the samples of every Recorder
+'''
+import re
+import time
+import random
+import threading
+import urlparse
+from array import array
+
+# Upper bounds in milliseconds of the latency histogram buckets.
+BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+MAX_SAMPLES = 10000 # Latencies kept for percentiles for each endpoint.
+PERCENTILES = (50, 90, 99)
+QTIME = re.compile(r'"QTime"\s*:\s*(\d+)')
+ID_PART = re.compile(r'^[0-9a-fA-F-]+$') # directory and file names of stats
+WATCHERS = list() # Functions called with the samples of every Recorder.
+
+def watch(func):
+    '''Call func(sample) for every sample of every Recorder from now on.'''
+    if func not in WATCHERS:
+        WATCHERS.append(func)
+
+def url_template(url):
+    '''Return url with the parts that change for each request taken out.
+
+    Query values are dropped and path parts made of hex digits, like
+    the directories and files of stats, become *.'''
+    parts = urlparse.urlsplit(url)
+    path = '/'.join(ID_PART.sub('*', bit) if bit else bit
+                    for bit in parts.path.split('/'))
+    names = sorted(set(name for name, value in
+                       urlparse.parse_qsl(parts.query, True)))
+    query = '&'.join('%s='%name for name in names)
+    return urlparse.urlunsplit((parts.scheme, parts.netloc, path, query, ''))
+
+def endpoint_of(url):
+    '''Return the scheme and host of url, or local for a file path.'''
+    parts = urlparse.urlsplit(url)
+    if not parts.netloc:
+        return 'local'
+    return '%s://%s'%(parts.scheme, parts.netloc)
+
+def find_qtime(text):
+    '''Return the QTime in the start of a Solr response, or None.'''
+    found = QTIME.search(text[:2048])
+    if found:
+        return int(found.group(1))
+    return None
+
+def find_retry_after(error):
+    '''Return the seconds in the Retry-After header of an HTTP error.'''
+    headers = getattr(error, 'hdrs', None)
+    if headers is None:
+        return None
+    try:
+        return float(headers.getheader('retry-after'))
+    except (TypeError, ValueError):
+        return None
+
+def percentile(ordered, wanted):
+    '''Return the wanted percentile of a sorted list, None if it is empty.'''
+    if not ordered:
+        return None
+    index = int(round((len(ordered)-1)*wanted/100.0))
+    return ordered[index]
+
+class Series(object):
+    '''The samples for one kind of request to one endpoint.'''
+    def __init__(self):
+        self.COUNT = 0
+        self.SECONDS = 0.0
+        self.BYTES = 0
+        self.HISTOGRAM = [0]*(len(BUCKETS_MS)+1) # the last is for slower
+        self.LATENCIES = array('d') # seconds, a sample of at most MAX_SAMPLES
+        self.QTIMES = array('l') # milliseconds, sampled the same way
+        self.CACHE = dict() # key = hit, miss, ..., value = count
+        self.ERRORS = dict() # key = error class name, value = count
+        self.TEMPLATES = dict() # key = url template, value = count
+        self.RANDOM = random.Random(1)
+
+    def keep(self, values, value):
+        '''Add value to values, replacing a random one once it is full.'''
+        if len(values) < MAX_SAMPLES:
+            values.append(value)
+        else:
+            at = self.RANDOM.randint(0, self.COUNT-1)
+            if at < MAX_SAMPLES:
+                values[at] = value
+
+    def add(self, sample):
+        self.COUNT += 1
+        self.SECONDS += sample['seconds']
+        self.BYTES += sample['bytes'] or 0
+        ms = sample['seconds']*1000
+        bucket = 0
+        while bucket < len(BUCKETS_MS) and ms > BUCKETS_MS[bucket]:
+            bucket += 1
+        self.HISTOGRAM[bucket] += 1
+        self.keep(self.LATENCIES, sample['seconds'])
+        if sample['qtime'] is not None:
+            self.keep(self.QTIMES, sample['qtime'])
+        for name, counts in (('cache', self.CACHE), ('error', self.ERRORS),
+                             ('template', self.TEMPLATES)):
+            if sample[name]:
+                counts[sample[name]] = counts.get(sample[name], 0)+1
+
+    def summary(self):
+        '''Return the totals, percentiles and histogram as a dictionary.'''
+        latencies = sorted(self.LATENCIES)
+        qtimes = sorted(self.QTIMES)
+        found = {'count': self.COUNT, 'seconds': self.SECONDS,
+                 'bytes': self.BYTES, 'cache': dict(self.CACHE),
+                 'errors': dict(self.ERRORS),
+                 'templates': dict(self.TEMPLATES),
+                 'histogram': zip(BUCKETS_MS+('more',), self.HISTOGRAM)}
+        for wanted in PERCENTILES:
+            found['p%s'%wanted] = percentile(latencies, wanted)
+            found['qtime_p%s'%wanted] = percentile(qtimes, wanted)
+        found['max'] = latencies[-1] if latencies else None
+        return found
+
+class Recorder(object):
+    '''Samples of every request, kept by kind and endpoint.'''
+    def __init__(self):
+        self.LOCK = threading.Lock()
+        self.HOOKS = list() # Functions called with each sample.
+        self.reset()
+
+    def reset(self):
+        '''Forget every sample.'''
+        with self.LOCK:
+            self.SERIES = dict() # key = (kind, endpoint), value = Series
+
+    def add_hook(self, hook):
+        '''Call hook(sample) for every sample from now on.'''
+        self.HOOKS.append(hook)
+
+    def record(self, kind, url, seconds, nbytes=0, qtime=None, cache=None,
+               error=None):
+        '''Record one request of kind, e.g. solr, stats_local, stats_remote.
+
+        error is the exception raised, if any, of which the class is kept
+        with its message, the HTTP status and any Retry-After seconds.'''
+        status, message, retry_after = None, None, None
+        if error is not None and not isinstance(error, basestring):
+            status = getattr(error, 'code', None)
+            message = str(error)[:200]
+            retry_after = find_retry_after(error)
+            error = error.__class__.__name__
+        sample = {'kind': kind, 'endpoint': endpoint_of(url),
+                  'template': url_template(url), 'seconds': seconds,
+                  'bytes': nbytes, 'qtime': qtime, 'cache': cache,
+                  'error': error, 'status': status, 'message': message,
+                  'retry_after': retry_after, 'when': time.time()}
+        key = (kind, sample['endpoint'])
+        with self.LOCK:
+            if key not in self.SERIES:
+                self.SERIES[key] = Series()
+            self.SERIES[key].add(sample)
+        for hook in self.HOOKS+WATCHERS:
+            hook(sample)
+        return sample
+
+    def summary(self):
+        '''Return {(kind, endpoint): summary dictionary} for every series.'''
+        with self.LOCK:
+            return dict((key, series.summary())
+                        for key, series in self.SERIES.items())
+
+    def report(self):
+        '''Return the summary as text to add to a report.'''
+        lines = ['Kind\tEndpoint\tRequests\tSeconds\tBytes\tp50 ms\tp90 ms'
+                 '\tp99 ms\tMax ms\tQTime p50\tQTime p99\tCache\tErrors']
+        def ms(value):
+            if value is None:
+                return '-'
+            return '%.1f'%(value*1000)
+        def counts(found):
+            return ','.join('%s=%s'%(k, found[k]) for k in sorted(found)) or '-'
+        summary = self.summary()
+        for kind, endpoint in sorted(summary):
+            found = summary[(kind, endpoint)]
+            lines.append('\t'.join([kind, endpoint, str(found['count']),
+                '%.3f'%found['seconds'], str(found['bytes']),
+                ms(found['p50']), ms(found['p90']), ms(found['p99']),
+                ms(found['max']), str(found['qtime_p50']),
+                str(found['qtime_p99']), counts(found['cache']),
+                counts(found['errors'])]))
+            lines.append('\t'+' '.join('<=%s:%s'%(bound, count) for
+                         bound, count in found['histogram'] if count))
+        return '\n'.join(lines)+'\n'
+
+METRICS = Recorder() # Shared by every search and report.
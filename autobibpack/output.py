@@ -0,0 +1,42 @@
+'''Write reports a line at a time to plain or gzip compressed files.
+
+Reports are made as a stream of lines so the whole report never has to
+be held in memory as one string.
+
+Using the writers
+=================
+outfile = open_output('days.csv.gz') # gzip because of the name
+write_lines(outfile, stats.iter_lines('rawdata'))
+outfile.close()
+'''
+import gzip
+
+BLOCK_LINES = 1000 # Lines held before they are written out.
+
+def open_output(path, compress=None):
+    '''Open path for writing, compressed with gzip if compress is True.
+
+    When compress is None paths ending in .gz are compressed.'''
+    if compress is None:
+        compress = path.endswith('.gz')
+    if compress:
+        return gzip.open(path, 'wb')
+    return file(path, 'w')
+
+def write_lines(outfile, lines):
+    '''Write each line from the iterable lines to outfile, return the count.
+
+    Lines are joined into blocks of BLOCK_LINES before writing, since
+    every write to a gzip file has a cost of its own.'''
+    count = 0
+    block = list()
+    for line in lines:
+        block.append(line)
+        if len(block) == BLOCK_LINES:
+            outfile.write(''.join(block))
+            count += len(block)
+            block = list()
+    if block:
+        outfile.write(''.join(block))
+        count += len(block)
+    return count
@@ -0,0 +1,132 @@
+'''Compact ways to keep the documents found by a search.
+
+A Solr document decoded from JSON is a dictionary with a unicode string
+for every key and value, hundreds of bytes even when only the id was
+asked for. IdSet keeps ids of the form uuid:8353...-...-ac06ebf42c84 as
+16 bytes each in one block of memory, and record_type makes small tuple
+classes with one attribute for each field asked for.
+
+Using the records
+=================
+ids = IdSet()
+ids.add('uuid:83530474-369e-417b-a8db-ac06ebf42c84')
+print len(ids), list(ids)
+Record = record_type(['id', 'title'])
+print Record(u'uuid:...', u'A title').title
+'''
+import binascii
+import collections
+
+import dvindex # for the 16 byte keys and where to look for them
+
+KEY_SIZE = 16
+FIRST_SLOTS = 1024 # Slots in a new IdSet, doubled when half are used.
+
+def format_uuid(key):
+    '''Return the id for a 16 byte key, e.g. uuid:83530474-369e-...'''
+    h = binascii.hexlify(key)
+    return 'uuid:%s-%s-%s-%s-%s'%(h[:8], h[8:12], h[12:16], h[16:20], h[20:])
+
+def compact_key(item):
+    '''Return the 16 byte key for item, or None if it can not be packed.
+
+    Only ids that come back exactly the same from their key are packed.'''
+    key = dvindex.uuid_bytes(item)
+    if key is None or format_uuid(key) != item:
+        return None
+    return key
+
+class IdSet(object):
+    '''A set of ids keeping uuids packed as 16 bytes each.
+
+    The uuids are kept in a hash table in a single bytearray, any other
+    ids in an ordinary set. Ids come back in table order.'''
+    def __init__(self, items=()):
+        self.SLOTS = FIRST_SLOTS
+        self.TABLE = bytearray(self.SLOTS*KEY_SIZE)
+        self.USED = 0 # Slots holding a uuid.
+        self.OTHER = set() # Ids that are not uuids.
+        for item in items:
+            self.add(item)
+
+    def _find(self, key):
+        '''Return (slot, True) where key is, or (empty slot, False).'''
+        table = self.TABLE
+        mask = self.SLOTS-1
+        slot = dvindex.slot_for(key, self.SLOTS)
+        while True:
+            have = table[slot*KEY_SIZE:(slot+1)*KEY_SIZE]
+            if have == key:
+                return slot, True
+            if have == dvindex.EMPTY:
+                return slot, False
+            slot = (slot+1) & mask
+
+    def _grow(self):
+        '''Double the table and put every key back in it.'''
+        keys = list(self._keys())
+        self.SLOTS *= 2
+        self.TABLE = bytearray(self.SLOTS*KEY_SIZE)
+        for key in keys:
+            slot, found = self._find(key)
+            self.TABLE[slot*KEY_SIZE:(slot+1)*KEY_SIZE] = key
+
+    def _keys(self):
+        '''Yield the 16 byte keys in the table.'''
+        table = self.TABLE
+        for slot in range(self.SLOTS):
+            key = str(table[slot*KEY_SIZE:(slot+1)*KEY_SIZE])
+            if key != dvindex.EMPTY:
+                yield key
+
+    def add(self, item):
+        '''Add item to the set, return True if it was not there before.'''
+        key = compact_key(item)
+        if key is None:
+            if item in self.OTHER:
+                return False
+            self.OTHER.add(item)
+            return True
+        slot, found = self._find(key)
+        if found:
+            return False
+        self.TABLE[slot*KEY_SIZE:(slot+1)*KEY_SIZE] = key
+        self.USED += 1
+        if self.USED*2 > self.SLOTS: # keep the table at most half full
+            self._grow()
+        return True
+
+    def __contains__(self, item):
+        key = compact_key(item)
+        if key is None:
+            return item in self.OTHER
+        return self._find(key)[1]
+
+    def __len__(self):
+        return self.USED+len(self.OTHER)
+
+    def __iter__(self):
+        for key in self._keys():
+            yield format_uuid(key)
+        for item in self.OTHER:
+            yield item
+
+    def keys(self):
+        '''Return a list of the ids, like the keys of DOCUMENTS.'''
+        return list(self)
+
+    def nbytes(self):
+        '''Return the bytes used by the packed table.'''
+        return len(self.TABLE)
+
+RECORD_TYPES = dict() # key = tuple of fields, value = the record class.
+
+def record_type(fields):
+    '''Return a tuple class with an attribute for each of fields.
+
+    Fields that are not valid attribute names are renamed _0, _1, ...'''
+    fields = tuple(fields)
+    if fields not in RECORD_TYPES:
+        RECORD_TYPES[fields] = collections.namedtuple('Record', fields,
+                                                      rename=True)
+    return RECORD_TYPES[fields]
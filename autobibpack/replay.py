@@ -0,0 +1,270 @@
+'''Record the requests of a run to an archive and play them back later.
+
+A RecordTransport sends each request on to the connection pool and
+keeps the answer, its headers and how long it took in an archive file.
+A ReplayTransport answers the same requests from the archive, at full
+speed or as slowly as they were recorded, without going to the network.
+A request that is not in the archive is kept in MISSES and raises a
+ReplayMiss error instead of being sent to the source.
+
+The archive is a file of zlib packed records, each with its length in
+front, then a packed index from each request to the records answering
+it. If a recording ends without writing the index, the records are
+scanned to make it again.
+
+Using the transports
+====================
+recorder = RecordTransport('/tmp/ora.archive')
+httppool.use_transport(recorder) # or set_transport on a search or report
+vidcount_ora.Report().run()
+recorder.close()
+
+player = ReplayTransport('/tmp/ora.archive', pace=1.0) # recorded latency
+httppool.use_transport(player)
+vidcount_ora.Report().run()
+print player.report()
+'''
+import os
+import json
+import time
+import zlib
+import struct
+import socket
+import httplib
+import urllib2
+import threading
+import StringIO
+
+import cache # for putting the query parameters in a fixed order
+import httppool # for sending the requests being recorded
+
+MAGIC = 'autobib archive 1\n'
+FOOTER = struct.Struct('>Q8s') # where the index starts, then END
+END = 'AUTOBIBX'
+LENGTH = struct.Struct('>I') # in front of each packed record
+# Request headers that change the answer, so are part of the key.
+KEY_HEADERS = ('accept-encoding', 'if-none-match', 'if-modified-since')
+
+def request_key(url, headers=None):
+    '''Return the key a request is kept under in an archive.'''
+    sent = dict((name.lower(), value) for name, value in
+                (headers or dict()).items())
+    bits = [cache.normal_url(url)]
+    for name in KEY_HEADERS:
+        if sent.get(name):
+            bits.append('%s: %s'%(name, sent[name]))
+    return '\n'.join(bits)
+
+class ReplayMiss(urllib2.URLError):
+    '''A request that was not recorded in the archive.'''
+
+class Headers(dict):
+    '''Response headers kept by lower case name, read like httplib's.'''
+    def getheader(self, name, default=None):
+        return self.get(name.lower(), default)
+
+class ArchivedResponse(object):
+    '''A response from an archive, used like the file from urllib2.urlopen.'''
+    def __init__(self, url, status, headers, body):
+        self.URL = url
+        self.code = status
+        self.msg = httplib.responses.get(status, '')
+        self.headers = Headers(headers)
+        self.BODY = StringIO.StringIO(body)
+
+    def info(self):
+        return self.headers
+
+    def geturl(self):
+        return self.URL
+
+    def getheader(self, name, default=None):
+        return self.headers.getheader(name, default)
+
+    def read(self, amt=None):
+        if amt is None:
+            return self.BODY.read()
+        return self.BODY.read(amt)
+
+    def close(self):
+        pass
+
+class Archive(object):
+    '''Packed records of requests and their answers, found by request key.'''
+    def __init__(self, path, mode='r'):
+        self.PATH = path
+        self.MODE = mode
+        self.LOCK = threading.Lock()
+        self.INDEX = dict() # key = request key, value = list of (offset, size)
+        if mode == 'w':
+            self.FILE = file(path, 'wb')
+            self.FILE.write(MAGIC)
+        else:
+            self.FILE = file(path, 'rb')
+            if self.FILE.read(len(MAGIC)) != MAGIC:
+                raise IOError('not an archive: %s'%path)
+            self.load_index()
+
+    def add(self, key, meta, body=''):
+        '''Add a record of meta, a dictionary, and body under key.'''
+        packed = zlib.compress(json.dumps(meta)+'\n'+body)
+        with self.LOCK:
+            offset = self.FILE.tell()
+            self.FILE.write(LENGTH.pack(len(packed))+packed)
+            self.INDEX.setdefault(key, list()).append(
+                                        (offset, LENGTH.size+len(packed)))
+
+    def read(self, offset, size):
+        '''Return (meta, body) of the record at offset.'''
+        with self.LOCK:
+            self.FILE.seek(offset)
+            data = self.FILE.read(size)
+        meta, body = zlib.decompress(data[LENGTH.size:]).split('\n', 1)
+        return json.loads(meta), body
+
+    def load_index(self):
+        '''Read the index at the end, or scan the records if there is none.'''
+        self.FILE.seek(0, os.SEEK_END)
+        end = self.FILE.tell()
+        if end >= len(MAGIC)+FOOTER.size:
+            self.FILE.seek(end-FOOTER.size)
+            start, tag = FOOTER.unpack(self.FILE.read(FOOTER.size))
+            if tag == END:
+                self.FILE.seek(start)
+                packed = self.FILE.read(end-FOOTER.size-start)
+                for key, places in json.loads(zlib.decompress(packed)).items():
+                    self.INDEX[key] = [tuple(place) for place in places]
+                return
+        self.scan(end)
+
+    def scan(self, end):
+        '''Make the index by reading each record from the start.'''
+        offset = len(MAGIC)
+        while offset+LENGTH.size <= end:
+            self.FILE.seek(offset)
+            size = LENGTH.size+LENGTH.unpack(self.FILE.read(LENGTH.size))[0]
+            if offset+size > end: # cut off while it was being written
+                break
+            meta, body = self.read(offset, size)
+            self.INDEX.setdefault(meta['key'], list()).append((offset, size))
+            offset += size
+
+    def close(self):
+        '''Write the index after the records when writing, then close.'''
+        with self.LOCK:
+            if self.FILE is None:
+                return
+            if self.MODE == 'w':
+                start = self.FILE.tell()
+                self.FILE.write(zlib.compress(json.dumps(self.INDEX)))
+                self.FILE.write(FOOTER.pack(start, END))
+            self.FILE.close()
+            self.FILE = None
+
+class RecordTransport(object):
+    '''Send requests to the pool and keep each answer in an archive.'''
+    def __init__(self, path, inner=None):
+        self.ARCHIVE = Archive(path, 'w')
+        self.INNER = inner or httppool.POOL # what really sends the requests
+        self.LOCK = threading.Lock() # Requests are recorded from many threads.
+        self.COUNT = 0 # How many requests have been recorded.
+
+    def urlopen(self, url, timeout=None, headers=None):
+        '''Return the answer to url, as the pool does, after recording it.
+
+        The whole body is read before returning, so its time is kept.'''
+        key = request_key(url, headers)
+        meta = {'key': key, 'url': url}
+        body = ''
+        start = time.time()
+        try:
+            load = self.INNER.urlopen(url, timeout, headers)
+            try:
+                body = load.read()
+            finally:
+                load.close()
+        except urllib2.HTTPError, error:
+            body = error.read()
+            meta.update({'status': error.code,
+                         'headers': dict((error.hdrs or dict()).items())})
+            self.keep(key, meta, body, start)
+            raise urllib2.HTTPError(url, error.code, error.msg, error.hdrs,
+                                    StringIO.StringIO(body))
+        except urllib2.URLError, error:
+            meta['error'] = ('url', str(error.reason))
+            self.keep(key, meta, body, start)
+            raise
+        except (socket.error, httplib.HTTPException), error:
+            meta['error'] = ('socket', str(error))
+            self.keep(key, meta, body, start)
+            raise
+        meta.update({'status': load.code,
+                     'headers': dict(load.headers.items())})
+        self.keep(key, meta, body, start)
+        return ArchivedResponse(url, load.code, meta['headers'], body)
+
+    def keep(self, key, meta, body, start):
+        meta['seconds'] = time.time()-start
+        with self.LOCK:
+            self.ARCHIVE.add(key, meta, body)
+            self.COUNT += 1
+
+    def close(self):
+        '''Finish the archive, writing its index.'''
+        self.ARCHIVE.close()
+
+class ReplayTransport(object):
+    '''Answer requests from an archive instead of the network.
+
+    pace scales the recorded time each request took: 0 answers at once,
+    1 takes as long as when it was recorded. A request asked for more
+    times than it was recorded gets the last recorded answer again.'''
+    def __init__(self, path, pace=0.0):
+        self.ARCHIVE = Archive(path)
+        self.PACE = pace
+        self.LOCK = threading.Lock()
+        self.USED = dict() # key = request key, value = answers used
+        self.MISSES = list() # (url, key) of requests not in the archive
+        self.COUNT = 0 # How many requests were answered.
+
+    def urlopen(self, url, timeout=None, headers=None):
+        '''Return the recorded answer to url, raising what it raised.'''
+        key = request_key(url, headers)
+        with self.LOCK:
+            places = self.ARCHIVE.INDEX.get(key)
+            if not places:
+                self.MISSES.append((url, key))
+                raise ReplayMiss('not in the archive: %s'%url)
+            used = self.USED.get(key, 0)
+            self.USED[key] = used+1
+            self.COUNT += 1
+        meta, body = self.ARCHIVE.read(*places[min(used, len(places)-1)])
+        if self.PACE:
+            time.sleep(meta['seconds']*self.PACE)
+        if 'error' in meta:
+            kind, message = meta['error']
+            if kind == 'socket':
+                raise socket.error(message)
+            raise urllib2.URLError(message)
+        if meta['status'] >= 400:
+            raise urllib2.HTTPError(url, meta['status'],
+                                    httplib.responses.get(meta['status'], ''),
+                                    Headers(meta['headers']),
+                                    StringIO.StringIO(body))
+        return ArchivedResponse(url, meta['status'], meta['headers'], body)
+
+    def unused(self):
+        '''Return the keys of recorded requests that were never asked for.'''
+        return sorted(key for key in self.ARCHIVE.INDEX if key not in self.USED)
+
+    def report(self):
+        '''Return a summary of the replay, listing each request missed.'''
+        lines = ['Requests answered: %s'%self.COUNT,
+                 'Requests not in the archive: %s'%len(self.MISSES),
+                 'Recorded requests not asked for: %s'%len(self.unused())]
+        for url, key in self.MISSES:
+            lines.append('missed\t%s'%url)
+        return '\n'.join(lines)+'\n'
+
+    def close(self):
+        self.ARCHIVE.close()
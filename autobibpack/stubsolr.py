@@ -0,0 +1,434 @@
+'''A local stand-in for a Solr select endpoint, for tests and benchmarks.
+
+It implements the subset of the Solr select interface that fetch.Search
+uses, answering from an in memory list of documents. It also counts the
+requests made so that benchmarks can compare how hard a method hits the
+endpoint. Given the stats of items it serves them the way orastats does,
+from /results/dv/... paths. Each request can be slowed by a latency and
+a share of them answered with 503 errors.
+
+Using the stub
+==============
+docs = make_corpus(1000)
+stub = StubSolr(docs)
+stub.start()
+s = fetch.Search('stub')
+s.set_endpoint(stub.ENDPOINT)
+...
+stub.stop()
+
+stats = make_stats([doc['id'] for doc in docs])
+stub = StubSolr(docs, stats=stats, latency=0.05, error_rate=0.01)
+report.set_stats_server(stub.STATS_SERVER)
+'''
+import BaseHTTPServer
+import SocketServer
+import threading
+import socket
+import time
+import bisect
+import urlparse
+import datetime
+import random
+import json
+import base64
+import re
+import zlib
+import hashlib
+
+import vidcount # for where the stats file of each item is
+
+DATE_FIELDS = ('timestamp', 'creationDate', 'modifiedDate')
+FUNDERS = ('JISC', 'wellcome', 'European Union', 'EPSRC', 'AHRC')
+SOURCES = ('polonsky', 'economics.ouls.ox.ac.uk', 'ora', 'eprints')
+AND_SPLIT = re.compile(r'&| AND ')
+SECONDS = '%Y-%m-%dT%H:%M:%S'
+FACET_KINDS = ('range', 'date', 'query') # served when facet is True
+STATS_MODIFIED = 'Mon, 01 Jul 2013 00:00:00 GMT' # of every stats file
+DATE_BITS = re.compile(r'(\d+)-(\d+)-(\d+)(?:T(\d{1,2}):(\d{1,2}):(\d{1,2}))?')
+
+def make_corpus(size, start_year=2007, end_year=2013, seed=1):
+    '''Return a list of size synthetic documents with dates between years.'''
+    rand = random.Random(seed)
+    first = datetime.datetime(start_year, 1, 1)
+    seconds = (datetime.datetime(end_year+1, 1, 1)-first).days*86400
+    docs = list()
+    for count in range(size):
+        uuid = '%032x'%rand.getrandbits(128)
+        doc = {'id': 'uuid:%s-%s-%s-%s-%s'%(uuid[:8], uuid[8:12], uuid[12:16],
+                                            uuid[16:20], uuid[20:]),
+               'title': 'Synthetic item %s'%count,
+               'author': 'author%s'%rand.randint(1, 50),
+               'funder': rand.choice(FUNDERS),
+               'recordContentSource': rand.choice(SOURCES)}
+        for field in DATE_FIELDS:
+            when = first + datetime.timedelta(seconds=rand.randint(0, seconds-1),
+                                    milliseconds=rand.randint(0, 999))
+            doc[field] = when.strftime('%Y-%m-%dT%H:%M:%S.') + \
+                         '%03dZ'%(when.microsecond/1000)
+        docs.append(doc)
+    return docs
+
+def make_stats(ids, seed=1, missing=10):
+    '''Return {id: views;downloads text} for ids, leaving out one in missing.'''
+    rand = random.Random(seed)
+    stats = dict()
+    for count, item in enumerate(ids):
+        if count % missing == 0:
+            continue
+        stats[item] = '%s;%s\n'%(rand.randint(0, 500), rand.randint(0, 90))
+    return stats
+
+def parse_date(text):
+    '''Return a datetime from the leading part of a Solr date.'''
+    found = DATE_BITS.match(text.strip())
+    if not found:
+        return None
+    bits = [int(bit or 0) for bit in found.groups()]
+    return datetime.datetime(*bits)
+
+def step_date(when, gap):
+    '''Return the date when moved forward by a Solr gap such as +1DAY.'''
+    if gap == '+1MONTH':
+        if when.month == 12:
+            return when.replace(year=when.year+1, month=1)
+        return when.replace(month=when.month+1)
+    if gap == '+1YEAR':
+        return when.replace(year=when.year+1)
+    return when + datetime.timedelta(days=1)
+
+class StubIndex(object):
+    '''Answer Solr select parameters from a list of documents.'''
+    def __init__(self, docs, facet=True, cursor=True):
+        self.DOCS = docs
+        # False behaves like a source without faceting, a tuple such as
+        # ('query',) only serves those kinds of facet, the others are a
+        # bad request, like an older Solr.
+        self.FACET = facet
+        self.CURSOR = cursor # False ignores cursorMark, like Solr before 4.7
+        # and 'reject' answers it with 400, like Solr with grouping on.
+        self.LAST = None # ((q, sort), docs, sort values) of the last query
+
+    def term(self, value):
+        '''Return a function that tests a document against field:value.'''
+        if value.startswith('[') and value.endswith(']'):
+            # Dates are compared as text to the second, like 2013-01-21T11:14:22
+            low, high = [parse_date(bit).strftime(SECONDS)
+                         for bit in value[1:-1].split(' TO ')]
+            return lambda have: low <= have[:19] <= high
+        if value.startswith('"') and value.endswith('"'):
+            exact = value[1:-1].lower()
+            return lambda have: exact == have.lower()
+        part = value.lower()
+        return lambda have: part in have.lower()
+
+    def match(self, q):
+        '''Return the documents matching the query string q.'''
+        if not q or q == '*:*':
+            return list(self.DOCS)
+        clauses = [self.clause(part) for part in AND_SPLIT.split(q)]
+        def matched(doc):
+            for clause in clauses:
+                if not self.found(doc, clause):
+                    return False
+            return True
+        return [doc for doc in self.DOCS if matched(doc)]
+
+    def found(self, doc, clause):
+        '''Return True if any (field, test) pair of clause matches doc.'''
+        for field, test in clause:
+            if field == '*':
+                if any(test(doc[key]) for key in doc):
+                    return True
+            elif field in doc and test(doc[field]):
+                return True
+        return False
+
+    def clause(self, part):
+        '''Return the (field, test) pairs of a field:value clause, any may match.
+
+        Like Solr, an unquoted value of several words looks for the first
+        word in the field and for the others in any field.'''
+        field, value = [bit.strip() for bit in part.split(':', 1)]
+        words = value.split()
+        if len(words) > 1 and value[0] not in '["':
+            return [(field, self.term(words[0]))] + \
+                   [('*', self.term(word)) for word in words[1:]]
+        return [(field, self.term(value))]
+
+    def facet_queries(self, docs, param):
+        '''Return {query: count} of docs for each facet.query.'''
+        answer = dict()
+        for query in param('facet.query', many=True):
+            clause = self.clause(query)
+            answer[query] = sum(1 for doc in docs if self.found(doc, clause))
+        return answer
+
+    def facet_counts(self, docs, param, kind):
+        '''Return the range (or date) facet counts for docs.'''
+        answer = dict()
+        for field in param('facet.%s'%kind, many=True):
+            def option(name):
+                return param('f.%s.facet.%s.%s'%(field, kind, name)) or \
+                       param('facet.%s.%s'%(kind, name))
+            first = parse_date(option('start'))
+            last = parse_date(option('end'))
+            gap = option('gap') or '+1DAY'
+            buckets = list()
+            when = first
+            while when < last:
+                buckets.append(when)
+                when = step_date(when, gap)
+            totals = [0]*len(buckets)
+            for doc in docs:
+                if field not in doc:
+                    continue
+                have = parse_date(doc[field])
+                if have < first or have >= last:
+                    continue
+                totals[bisect.bisect_right(buckets, have)-1] += 1
+            keys = [b.strftime('%Y-%m-%dT%H:%M:%SZ') for b in buckets]
+            info = {'gap': gap, 'start': option('start'), 'end': option('end')}
+            if kind == 'range':
+                counts = list()
+                for key, total in zip(keys, totals):
+                    counts.extend([key, total])
+                info['counts'] = counts
+            else:
+                info.update(dict(zip(keys, totals)))
+            answer[field] = info
+        return answer
+
+    def ordered(self, q, sort):
+        '''Return (documents matching q in sort order, their sort values).
+
+        The sort values are None unless every key is ascending. The last
+        answer is kept, since paging asks the same question many times.'''
+        last = self.LAST
+        if last and last[0] == (q, sort):
+            return last[1], last[2]
+        docs = self.match(q)
+        for key, order in reversed(sort): # stable sorts, last key first
+            docs.sort(key=lambda doc: doc.get(key), reverse=(order == 'desc'))
+        keys = None
+        if all(order == 'asc' for key, order in sort):
+            keys = [[doc.get(key) for key, order in sort] for doc in docs]
+        self.LAST = ((q, sort), docs, keys)
+        return docs, keys
+
+    def select(self, params):
+        '''Return the response for a dictionary of url parameters.'''
+        def param(name, default='', many=False):
+            values = params.get(name, [])
+            if many:
+                return values
+            return values[-1] if values else default
+        q = param('q', '*:*')
+        sort = [tuple((part.strip().split(' ') + ['asc'])[:2])
+                for part in param('sort').split(',') if part.strip()]
+        docs, keys = self.ordered(q, sort)
+        found = len(docs)
+        start = int(param('start', '0'))
+        rows = int(param('rows', '10'))
+        mark = param('cursorMark')
+        if self.CURSOR == 'reject' and mark:
+            raise ValueError('Cursor functionality is not available')
+        if self.CURSOR and mark:
+            # The mark is the sort values of the last document sent.
+            def values(doc):
+                return [doc.get(key) for key, order in sort]
+            if mark != '*':
+                after = json.loads(base64.urlsafe_b64decode(mark))
+                if keys is None:
+                    docs = [doc for doc in docs if values(doc) > after]
+                else: # in ascending order, so look the mark up
+                    docs = docs[bisect.bisect_right(keys, after):]
+            page = docs[:rows]
+            if page:
+                mark = base64.urlsafe_b64encode(json.dumps(values(page[-1])))
+            start = 0
+        else:
+            mark = ''
+            page = docs[start:start+rows]
+        fl = param('fl')
+        if fl and '*' not in fl:
+            wanted = re.findall(r'\w+', fl)
+            page = [dict((k, d[k]) for k in wanted if k in d) for d in page]
+        header = dict((key, param(key)) for key in params)
+        data = {'responseHeader': {'status': 0, 'QTime': 0, 'params': header},
+                'response': {'numFound': found, 'start': start,
+                             'docs': page}}
+        if mark:
+            data['nextCursorMark'] = mark
+        if self.FACET and param('facet') == 'true':
+            kinds = FACET_KINDS if self.FACET is True else self.FACET
+            for kind in FACET_KINDS:
+                if param('facet.%s'%kind) and kind not in kinds:
+                    raise ValueError('facet.%s is not supported'%kind)
+            data['facet_counts'] = {
+                'facet_queries': self.facet_queries(docs, param),
+                'facet_fields': {},
+                'facet_ranges': self.facet_counts(docs, param, 'range'),
+                'facet_dates': self.facet_counts(docs, param, 'date')}
+        return data
+
+class StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    '''Serve select requests from the index on the server.'''
+    protocol_version = 'HTTP/1.1'
+    wbufsize = -1 # send each response in one go, not a write per header
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        stub = self.server.STUB
+        stub.count_request()
+        if stub.LATENCY:
+            time.sleep(stub.LATENCY)
+        if stub.fail():
+            body = json.dumps({'error': {'msg': 'stub error', 'code': 503}})
+            self.send_body(503, body, {'Retry-After': '1'})
+            return
+        parts = urlparse.urlsplit(self.path)
+        if parts.path.startswith('/results/'):
+            self.send_stats(stub.STATS.get(parts.path))
+            return
+        params = urlparse.parse_qs(parts.query, keep_blank_values=True)
+        try:
+            body = json.dumps(stub.INDEX.select(params))
+            status = 200
+        except (ValueError, TypeError, AttributeError), error:
+            # Solr says a query it can not parse is a bad request.
+            body = json.dumps({'error': {'msg': str(error), 'code': 400}})
+            status = 400
+        etag = '"%s"'%hashlib.md5(body).hexdigest()
+        if status == 200 and self.headers.getheader('if-none-match') == etag:
+            self.send_body(304, '', {'ETag': etag})
+            return
+        accept = self.headers.getheader('accept-encoding') or ''
+        headers = {'ETag': etag}
+        if stub.COMPRESS and 'gzip' in accept:
+            packer = zlib.compressobj(6, zlib.DEFLATED, 16+zlib.MAX_WBITS)
+            body = packer.compress(body)+packer.flush()
+            headers['Content-Encoding'] = 'gzip'
+        self.send_body(status, body, headers)
+
+    def send_stats(self, text):
+        '''Send the views;downloads text of an item, like orastats.'''
+        if text is None:
+            self.send_body(404, 'Not found\n')
+            return
+        headers = {'ETag': '"%s"'%hashlib.md5(text).hexdigest(),
+                   'Last-Modified': STATS_MODIFIED}
+        if self.headers.getheader('if-none-match') == headers['ETag'] or \
+           self.headers.getheader('if-modified-since') == STATS_MODIFIED:
+            self.send_body(304, '', headers)
+            return
+        self.send_body(200, text, headers)
+
+    def send_body(self, status, body, headers=None):
+        '''Send a response with body and the extra headers.'''
+        self.send_response(status)
+        for name, value in (headers or dict()).items():
+            self.send_header(name, value)
+        if status != 304:
+            self.send_header('Content-Type', 'text/plain; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.server.STUB.STALL and len(body) > 1:
+            half = len(body)/2
+            self.wfile.write(body[:half])
+            self.wfile.flush()
+            time.sleep(self.server.STUB.STALL)
+            body = body[half:]
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        '''Keep test and benchmark output quiet.'''
+        pass
+
+class StubServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def process_request(self, request, client_address):
+        '''Keep track of open keep-alive connections so stop can end them.'''
+        self.OPEN.add(request)
+        SocketServer.ThreadingMixIn.process_request(self, request,
+                                                    client_address)
+
+    def shutdown_request(self, request):
+        self.OPEN.discard(request)
+        BaseHTTPServer.HTTPServer.shutdown_request(self, request)
+
+    def handle_error(self, request, client_address):
+        '''Clients dropping keep-alive connections is not an error here.'''
+        pass
+
+    def close_open(self, wait=1.0):
+        '''Close every connection still open to a client.
+
+        Waits up to wait seconds for the threads serving them to finish.'''
+        for request in list(self.OPEN):
+            try:
+                request.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+        end = time.time()+wait
+        while self.OPEN and time.time() < end:
+            time.sleep(0.01)
+
+class StubSolr(object):
+    '''Run a StubIndex behind a local http server in a background thread.'''
+    def __init__(self, docs, facet=True, cursor=True, compress=True, port=0,
+                 stats=None, latency=0.0, error_rate=0.0, seed=1):
+        self.INDEX = StubIndex(docs, facet, cursor)
+        self.COMPRESS = compress # gzip responses when the client asks.
+        self.PORT = port # zero lets the system choose a free port.
+        self.STATS = dict() # key = stats file path, value = views;downloads
+        for item, text in (stats or dict()).items():
+            self.STATS[vidcount.stats_path(item)] = text
+        self.LATENCY = latency # Seconds each request waits before answering.
+        self.ERROR_RATE = error_rate # Share of requests answered with 503.
+        self.STALL = 0.0 # Seconds each body stops for halfway through.
+        self.RANDOM = random.Random(seed) # Chooses the requests that fail.
+        self.REQUESTS = 0 # How many requests the server has answered.
+        self.ERRORS = 0 # How many of those were errors made on purpose.
+        self.LOCK = threading.Lock()
+        self.SERVER = None
+        self.ENDPOINT = ''
+        self.STATS_SERVER = ''
+
+    def count_request(self):
+        with self.LOCK:
+            self.REQUESTS += 1
+
+    def fail(self):
+        '''Return True if this request should be answered with an error.'''
+        if not self.ERROR_RATE:
+            return False
+        with self.LOCK:
+            if self.RANDOM.random() < self.ERROR_RATE:
+                self.ERRORS += 1
+                return True
+        return False
+
+    def start(self):
+        '''Start serving and set ENDPOINT to the select url.'''
+        self.SERVER = StubServer(('127.0.0.1', self.PORT), StubHandler)
+        self.SERVER.STUB = self
+        self.SERVER.OPEN = set()
+        self.PORT = self.SERVER.server_address[1]
+        self.ENDPOINT = 'http://127.0.0.1:%s/solr/select?'%self.PORT
+        self.STATS_SERVER = 'http://127.0.0.1:%s'%self.PORT
+        thread = threading.Thread(target=self.SERVER.serve_forever,
+                                  kwargs={'poll_interval': 0.05})
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        '''Stop serving.'''
+        if self.SERVER:
+            self.SERVER.shutdown()
+            self.SERVER.server_close()
+            self.SERVER.close_open()
+            self.SERVER = None
@@ -0,0 +1,169 @@
+'''Synthetic stand-ins for ORA, PLoS and datafinder served by stub Solrs.
+
+Each corpus is made from a seed, so it is the same on every run, and
+holds the items the fetch_test_ora, fetch_test_plos and
+fetch_test_datafinder suites look for in the numbers they expect. The
+ORA stub also serves the stats of its items like orastats does.
+
+Using the stand-ins
+===================
+stubs = start_sources(latency=0.02)
+s = fetch.Search('ora')
+s.set_endpoint(stubs['ora'].ENDPOINT)
+...
+stop_sources(stubs)
+
+Run this module directly to serve the three sources until interrupted,
+e.g. python stubsources.py 0.05 0.01 for 50ms latency and 1% errors.
+'''
+import sys
+import time
+import random
+
+import stubsolr
+
+SIZES = {'ora': 5000, 'plos': 2000, 'datafinder': 1000} # Synthetic items.
+
+# The items the live suites expect, as they were in 2013.
+ORA_THESIS = {'id': 'uuid:83530474-369e-417b-a8db-ac06ebf42c84',
+              'author': 'Cummings',
+              'title': 'Neural control of convergence eye movements',
+              'timestamp': '2013-01-21T11:14:22.227Z'}
+ORA_AUTHOR_ITEMS = 340 # by cummings, at least 334 expected
+ORA_DAY = '2013-01-21' # with exactly ORA_DAY_ITEMS timestamps
+ORA_DAY_ITEMS = 248
+ORA_POLONSKY = 'uuid:278c6978-9421-46af-af61-a062a2044591'
+ORA_POLONSKY_ITEMS = 1250 # at least 1242 expected
+PLOS_ARTICLE = {'id': '10.1371/journal.pone.0011273', 'author': 'Majlender',
+                'title': 'Open Access to the Scientific Journal Literature',
+                'publication_date': '2010-06-23T00:00:00Z'}
+PLOS_AUTHOR2 = ('Welling', 8)
+PLOS_DAY_ITEMS = 260 # on the day of PLOS_ARTICLE, at least 259 expected
+DATAFINDER_ITEM = {'id': 'oai:generic-eprints-org:774', 'silo': 'eprints',
+                   'timestamp': '2012-08-21T15:13:33.521Z'}
+DATAFINDER_SILOS = ('eprints', 'dataset', 'ora-data')
+DATAFINDER_EPRINTS = 340 # at least 331 expected
+WORDS = ('reading', 'saccade', 'vergence', 'cortex', 'fixation', 'model',
+         'response', 'signal', 'visual', 'target', 'depth', 'motion')
+
+def abstract(rand, words=400):
+    '''Return a long made up abstract, so pages are the size of ORA's.'''
+    return ' '.join(rand.choice(WORDS) for count in range(words))
+
+def day_total(docs, field, day):
+    '''Return how many of docs have field on day, e.g. 2013-01-21.'''
+    return sum(1 for doc in docs if doc.get(field, '').startswith(day))
+
+def make_day(rand, day, midnight=False):
+    '''Return a Solr date on day, at midnight or a random time.'''
+    if midnight:
+        return '%sT00:00:00Z'%day
+    return '%sT%02d:%02d:%02d.%03dZ'%(day, rand.randint(0, 23),
+                rand.randint(0, 59), rand.randint(0, 59), rand.randint(0, 999))
+
+def ora_corpus(size=None, seed=1):
+    '''Return the ORA items, size synthetic ones and those expected.'''
+    rand = random.Random(seed)
+    docs = stubsolr.make_corpus(size or SIZES['ora'], seed=seed)
+    for count, doc in enumerate(stubsolr.make_corpus(ORA_AUTHOR_ITEMS,
+                                                     seed=seed+1)):
+        doc.update({'author': 'Cummings, A%s'%count,
+                    'title': 'Eye movements of reading %s'%count,
+                    'abstract': abstract(rand)})
+        docs.append(doc)
+    docs.append(dict(stubsolr.make_corpus(1, seed=seed+2)[0], **ORA_THESIS))
+    docs.append(dict(stubsolr.make_corpus(1, seed=seed+3)[0],
+                     id=ORA_POLONSKY, recordContentSource='polonsky'))
+    have = sum(1 for doc in docs if doc['recordContentSource'] == 'polonsky')
+    extra = stubsolr.make_corpus(max(0, ORA_POLONSKY_ITEMS-have), seed=seed+4)
+    for doc in extra:
+        doc['recordContentSource'] = 'polonsky'
+    docs.extend(extra)
+    days = stubsolr.make_corpus(ORA_DAY_ITEMS-day_total(docs, 'timestamp',
+                                                        ORA_DAY), seed=seed+5)
+    for doc in days:
+        doc['timestamp'] = make_day(rand, ORA_DAY)
+    docs.extend(days)
+    return docs
+
+def plos_corpus(size=None, seed=1):
+    '''Return the PLoS articles, size synthetic ones and those expected.'''
+    rand = random.Random(seed)
+    day = PLOS_ARTICLE['publication_date'][:10]
+    docs = list()
+    for count in range(size or SIZES['plos']):
+        when = '%s-%02d-%02d'%(rand.randint(2003, 2013), rand.randint(1, 12),
+                               rand.randint(1, 28))
+        docs.append({'id': '10.1371/journal.pone.%07d'%(count+1),
+                     'author': 'author%s'%rand.randint(1, 200),
+                     'title': 'Synthetic article %s'%count,
+                     'abstract': abstract(rand, 40),
+                     'publication_date': make_day(rand, when, True)})
+    docs.append(dict(PLOS_ARTICLE))
+    name, total = PLOS_AUTHOR2
+    for count in range(total):
+        docs[count*7]['author'] = name
+    for count in range(PLOS_DAY_ITEMS-day_total(docs, 'publication_date',
+                                                 day)):
+        docs[-count-2]['publication_date'] = make_day(rand, day, True)
+    return docs
+
+def datafinder_corpus(size=None, seed=1):
+    '''Return the datafinder records, size synthetic ones and one expected.'''
+    rand = random.Random(seed)
+    docs = list()
+    for count in range(size or SIZES['datafinder']):
+        when = '%s-%02d-%02d'%(rand.randint(2011, 2013), rand.randint(1, 12),
+                               rand.randint(1, 28))
+        doc = {'id': 'oai:generic-eprints-org:%s'%(count+1000),
+               'silo': rand.choice(DATAFINDER_SILOS),
+               'timestamp': make_day(rand, when)}
+        if rand.random() < 0.1:
+            doc['embargoedUntilDate'] = make_day(rand, '2082-08-21')
+        docs.append(doc)
+    docs.append(dict(DATAFINDER_ITEM))
+    have = sum(1 for doc in docs if doc['silo'] == 'eprints')
+    for doc in docs:
+        if have >= DATAFINDER_EPRINTS:
+            break
+        if doc['silo'] != 'eprints':
+            doc['silo'] = 'eprints'
+            have += 1
+    return docs
+
+CORPORA = {'ora': ora_corpus, 'plos': plos_corpus,
+           'datafinder': datafinder_corpus}
+
+def start_sources(sizes=None, latency=0.0, error_rate=0.0, seed=1):
+    '''Start a stub for each source, return {name: StubSolr}.
+
+    sizes can give the synthetic items for each name, otherwise SIZES.'''
+    sizes = sizes or dict()
+    stubs = dict()
+    for name in CORPORA:
+        docs = CORPORA[name](sizes.get(name), seed)
+        stats = None
+        if name == 'ora':
+            stats = stubsolr.make_stats([doc['id'] for doc in docs], seed)
+        stubs[name] = stubsolr.StubSolr(docs, stats=stats, latency=latency,
+                                        error_rate=error_rate,
+                                        seed=seed).start()
+    return stubs
+
+def stop_sources(stubs):
+    '''Stop every stub started by start_sources.'''
+    for stub in stubs.values():
+        stub.stop()
+
+if __name__ == '__main__':
+    latency = float(sys.argv[1]) if len(sys.argv) > 1 else 0.0
+    error_rate = float(sys.argv[2]) if len(sys.argv) > 2 else 0.0
+    stubs = start_sources(latency=latency, error_rate=error_rate)
+    for name in sorted(stubs):
+        print '%s\t%s'%(name, stubs[name].ENDPOINT)
+    print 'stats\t%s'%stubs['ora'].STATS_SERVER
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        stop_sources(stubs)
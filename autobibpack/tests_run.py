@@ -3,12 +3,16 @@ import unittest
 
 # The modules with test suites
 import fetch_test_ora as s1
-#import fetch_test_plos as s2
-#import fetch_test_datafinder as s3
+import fetch_test_plos as s2
+import fetch_test_datafinder as s3
+import years_test_stub as s4 # offline, uses a local stub Solr
+import fetch_test_stub as s5 # offline, uses a local stub Solr
+import vidcount_test_stub as s6 # offline, uses a local stub Solr
+import stubsources # stand-ins for the sources tested by s1, s2 and s3
 
 # Define which test suites will be used.
-#test_suites = [s1, s2, s3]
-test_suites = [s1, ]
+test_suites = [s1, s2, s3, s4, s5, s6]
+LIVE = False # True tests s1, s2 and s3 against the live sources instead.
 
 # Run all the suites.
 def run(suites, verb=0):
@@ -17,11 +21,26 @@ def run(suites, verb=0):
         log('Running: %s'%suite.SUITE_NAME)
         unittest.TextTestRunner(verbosity=verb).run(suite.suite())
 
+def run_offline(suites, verb=0):
+    '''Run the suites with s1, s2 and s3 pointed at local stand-ins.'''
+    stubs = stubsources.start_sources()
+    s1.END_POINT = stubs['ora'].ENDPOINT
+    s2.END_POINT = stubs['plos'].ENDPOINT
+    s2.ENABLE_REMOTE = True # safe, the queries go to the stand-in
+    s3.END_POINT = stubs['datafinder'].ENDPOINT
+    try:
+        run(suites, verb)
+    finally:
+        stubsources.stop_sources(stubs)
+
 def log(message):
     print
     print message
     print
 
 log('Running all available tests. ------------------')
-run(test_suites)
+if LIVE:
+    run(test_suites)
+else:
+    run_offline(test_suites)
 log('Finished all available tests. -----------------')
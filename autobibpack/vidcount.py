@@ -10,10 +10,25 @@ collected by Piwik Web Analytics.'''
 import time, datetime
 import urllib2, socket
 import os
+import itertools
 
 import fetch # Needed to discover which set of items we want data for.
+import httppool # Keeps connections to the remote stats open.
+import workers # Gets the stats for many items at the same time.
+import dvindex # Looks up stats without opening a file for each item.
+import vidstate # Remembers item stats between runs.
+import output # Writes reports a line at a time.
+import metrics # Records the latency of every stats file read.
 
 ENABLE_STATIC_REMOTE = True # Fetch data from remote version
+STATS_SERVER = 'http://orastats.bodleian.ox.ac.uk' # Serves the remote stats.
+
+def stats_path(item):
+    '''Return the path of the stats file for item under the stats root.'''
+    d1 = item[5:7] # skip 'uuid:' and get first 2 chars 
+    d2 = item[7:9] # directory level 2 is the next 2 chars
+    fname = item[9:] # the filename is the rest of the uuid
+    return '/results/dv/%s/%s/%s'%(d1,d2,fname)
 
 class ViewsAndDownloads(object):
     '''Calculate views and downloads for a set of item.
@@ -24,6 +39,20 @@ class ViewsAndDownloads(object):
     def __init__(self, endpoint):
         '''Setup process, where list of items comes from endpoint.'''
         self.ENDPOINT = endpoint
+        self.CACHE = None # A cache.ResponseCache for the ID searches.
+        self.CACHE_TTL = None # How long those responses stay fresh.
+        self.LOCAL_ROOT = '/var/www/' # Where the local stats files are.
+        self.INDEX = None # A dvindex.DVIndex of the local stats files.
+        self.CONCURRENCY = 1 # How many items to get stats for at once.
+        self.CONTROL = None # A workers.Controller choosing how many, if any.
+        self.HOST_LIMIT = None # Connections open to the stats server at once.
+        self.BATCH = 200 # Items handed to the workers at a time.
+        self.STATS_TABLE = None # {item: get_stat result} shared by reports.
+        self.STATE = None # A vidstate.ItemState kept between runs.
+        self.STATS_SERVER = STATS_SERVER # Where remote stats come from.
+        self.TRANSPORT = None # Sends requests instead of httppool.
+        self.METRICS = metrics.METRICS # Records each search and stats read.
+        self.METRICS_IN_REPORT = False # Add the metrics to saved reports.
         self.reset()
         
     # Setup the process
@@ -32,13 +61,68 @@ class ViewsAndDownloads(object):
         '''Reset report to starting point.'''
         self.FIELD = '' # the field to search
         self.VALUE = '' # the value to search for
-        self.RAW_IDS = list() # a list of unique ids found
+        self.RAW_IDS = list() # a set (or stream) of unique ids found
         self.REPORT_METHOD = dict() # a log of the methods used
         self.REPORT_ITEMS = list() # a log of data for items
         self.VIEWS = 0 # total number of views
         self.DOWNLOADS = 0 # total number of downloads
         self.READY = False # disable the process until search is setup.
     
+    def set_cache(self, cache, ttl=None):
+        '''Keep the responses to the ID searches in cache.'''
+        self.CACHE = cache
+        self.CACHE_TTL = ttl
+
+    def set_concurrency(self, count, host_limit=None, adaptive=False):
+        '''Get the stats for up to count items at the same time.
+        
+        The host limit caps the connections the pool opens to the stats
+        server, other hosts keep the pool's own limit. If adaptive, the stats server's workers.Controller chooses how many
+        of the count are fetched at once, backing off when it struggles.'''
+        self.CONCURRENCY = max(1, int(count))
+        if host_limit: # first, as it caps the controller
+            self.HOST_LIMIT = host_limit
+            httppool.POOL.limit_host(self.STATS_SERVER, host_limit)
+        self.CONTROL = None
+        if adaptive:
+            self.CONTROL = workers.controller_for(self.STATS_SERVER,
+                                                  self.CONCURRENCY)
+
+    def set_index(self, path):
+        '''Look up stats in the dv index at path before opening files.'''
+        self.INDEX = dvindex.DVIndex(path)
+
+    def set_state(self, state):
+        '''Use a vidstate.ItemState (or a path to one) to skip unchanged items.'''
+        if isinstance(state, basestring):
+            state = vidstate.ItemState(state)
+        self.STATE = state
+
+    def set_metrics(self, recorder=None, in_report=True):
+        '''Record each request in recorder, adding them to reports if asked.
+        
+        With no recorder, a report with the metrics gets a Recorder of its
+        own, so they are not mixed with those of earlier reports.'''
+        if recorder is None and in_report:
+            recorder = metrics.Recorder()
+        if recorder is not None:
+            self.METRICS = recorder
+        self.METRICS_IN_REPORT = in_report
+
+    def set_transport(self, transport):
+        '''Send the searches and remote stats requests with transport.'''
+        self.TRANSPORT = transport
+
+    def set_stats_server(self, url):
+        '''Fetch the remote stats from url instead of orastats.'''
+        if self.HOST_LIMIT: # the limit moves with the stats
+            httppool.POOL.limit_host(self.STATS_SERVER)
+            httppool.POOL.limit_host(url, self.HOST_LIMIT)
+        self.STATS_SERVER = url.rstrip('/')
+        if self.CONTROL is not None:
+            self.CONTROL = workers.controller_for(self.STATS_SERVER,
+                                                  self.CONCURRENCY)
+
     def set_search(self, value, field):
         '''Configure the value and field to search for.'''
         self.FIELD = field
@@ -57,61 +141,114 @@ class ViewsAndDownloads(object):
         
     #  Get the item IDs and totals
     # ===================================================        
-    def _fetch_ids(self):
-        '''Obtain the IDs for the items we want to get totals for.'''
+    def _fetch_ids(self, stream=False):
+        '''Obtain the IDs for the items we want to get totals for.
+        
+        When stream is True RAW_IDS yields the ids as each page arrives
+        and the log is filled in once the last id has been used.'''
         start = time.time()
         search = fetch.Search('IDs fetching')
-        ids, log = search.auto_list_ids(self.ENDPOINT, self.VALUE, self.FIELD)
+        search.set_cache(self.CACHE, self.CACHE_TTL)
+        search.set_metrics(self.METRICS)
+        search.set_transport(self.TRANSPORT)
+        if stream:
+            self.RAW_IDS = self._stream_ids(search, start)
+            return
+        ids, log = search.auto_list_ids(self.ENDPOINT, self.VALUE, self.FIELD,
+                                        compact=True)
         self.REPORT_METHOD.update(log)
         self.RAW_IDS = ids
+        self._log_search(search, start)
+
+    def _log_search(self, search, start):
+        '''Log how the IDs were fetched and the bytes it took.'''
+        self.REPORT_METHOD['3b. Pages fetched by'] = search.PAGED_BY
+        sent = search.transfer_summary()
+        self.REPORT_METHOD['3c. Bytes of IDs sent/unpacked'] = '%s/%s'%(
+                                            sent['wire_bytes'], sent['bytes'])
         self.REPORT_METHOD['3a. Seconds taken to find IDs'] = time.time()-start 
+
+    def _stream_ids(self, search, start):
+        '''Yield the IDs from search then log how they were found.'''
+        log = dict()
+        for item in search.auto_iter_ids(self.ENDPOINT, self.VALUE,
+                                         self.FIELD, log=log):
+            yield item
+        self.REPORT_METHOD.update(log)
+        self._log_search(search, start)
         
     def url_source(self, item):
         '''Return the URL pattern for fetching data.'''
-        d1 = item[5:7] # skip 'uuid:' and get first 2 chars 
-        d2 = item[7:9] # directory level 2 is the next 2 chars
-        fname = item[9:] # the filename is the rest of the uuid
-        sub = '/results/dv/%s/%s/%s'%(d1,d2,fname)
-        staturl = 'http://orastats.bodleian.ox.ac.uk%s'%sub
+        sub = stats_path(item)
+        staturl = '%s%s'%(self.STATS_SERVER, sub)
         return staturl, sub
     
-    def static_remote(self, address):
-        '''Get the data from a static remote file in location address.'''
+    def static_remote(self, address, headers=None, info=None):
+        '''Get the data from a static remote file in location address.
+        
+        Extra headers can be sent with the request. If info is a
+        dictionary the status, ETag and Last-Modified are put in it.'''
+        start = time.time()
         try:
-            indata = urllib2.urlopen(address, timeout=5.0)
-            stats = indata.read()
-            indata.close()
+            if self.TRANSPORT is not None:
+                indata = self.TRANSPORT.urlopen(address, 5.0, headers)
+            else:
+                indata = httppool.urlopen(address, timeout=5.0, headers=headers)
+            try:
+                stats = indata.read()
+            finally: # gives the connection back even if the read fails
+                indata.close()
+            if info is not None:
+                info['status'] = indata.code
+                info['etag'] = indata.getheader('etag')
+                info['last_modified'] = indata.getheader('last-modified')
             error_open = False
             clean = 1
-        except (urllib2.URLError, urllib2.HTTPError, socket.error):
+            self.METRICS.record('stats_remote', address, time.time()-start,
+                                len(stats), cache=indata.code == 304 and
+                                'revalidated' or None)
+        except (urllib2.URLError, urllib2.HTTPError, socket.error) as error:
             error_open = True
             clean = 0
             stats = '0;0'
+            self.METRICS.record('stats_remote', address, time.time()-start,
+                                error=error)
         return stats, clean, error_open
     
     def static_local(self, filepath, root='/var/www/'):
         '''Get data from a static local file.'''
         indata = '%s%s'%(root,filepath)
+        start = time.time()
         try:
             infile = file(indata)
             stats = infile.read()
             infile.close()
             error_open = False
             clean = 1
-        except IOError:
+            self.METRICS.record('stats_local', indata, time.time()-start,
+                                len(stats))
+        except IOError as error:
             error_open = True
             clean = 0
             stats = '0;0'
+            self.METRICS.record('stats_local', indata, time.time()-start,
+                                error=error)
         return stats, clean, error_open
                                     
     def get_stat(self, item):
         '''Get the views and downloads for a single item.'''
         address, subpath = self.url_source(item)
         
+        # Items in the index need no file opening or parsing.
+        if self.INDEX is not None:
+            found = self.INDEX.lookup(item)
+            if found:
+                return found[0], found[1], address, 1, False, False
+        
         # Try and get from local file or remote source.
-        stats, clean, error_open = self.static_local(subpath)
-        if error_open and ENABLE_STATIC_REMOTE:
-            stats, clean, error_open = self.static_remote(address)
+        check = dict()
+        stats, clean, error_open = self._read_stats(item, address, subpath,
+                                                    check)
         
         # Extract the downloads and views.
         error_index = False
@@ -130,8 +267,87 @@ class ViewsAndDownloads(object):
             error_index = True
             clean = 0
             views = 0
+        
+        # Remember what was read so the next run can skip it if unchanged.
+        if self.STATE is not None and clean and not check.get('reused'):
+            self.STATE.put(item, views, downs, check.get('mtime'),
+                           check.get('etag'), check.get('last_modified'))
         return views , downs, address, clean, error_open, error_index
+
+    def _read_stats(self, item, address, subpath, check):
+        '''Return (stats, clean, error_open) for item, skipping it if unchanged.
+        
+        With a STATE, an item whose local file has the same modified time
+        as last run, or whose remote file gets a 304 answer, reuses the
+        saved stats. check is filled with how the stats were found.'''
+        found = None
+        if self.STATE is not None:
+            found = self.STATE.get(item)
+            try:
+                mtime = os.stat('%s%s'%(self.LOCAL_ROOT, subpath)).st_mtime
+            except OSError:
+                mtime = None
+            if found and mtime is not None and found['mtime'] == mtime:
+                check['reused'] = True
+                return self.STATE.unchanged(item, found), 1, False
+            check['mtime'] = mtime
+        stats, clean, error_open = self.static_local(subpath, self.LOCAL_ROOT)
+        if error_open and ENABLE_STATIC_REMOTE:
+            headers = dict()
+            if found and found['etag']:
+                headers['If-None-Match'] = found['etag']
+            if found and found['last_modified']:
+                headers['If-Modified-Since'] = found['last_modified']
+            info = dict()
+            stats, clean, error_open = self.static_remote(address, headers,
+                                                          info)
+            if found and info.get('status') == 304:
+                check['reused'] = True
+                return self.STATE.unchanged(item, found), 1, False
+            check['etag'] = info.get('etag')
+            check['last_modified'] = info.get('last_modified')
+        return stats, clean, error_open
             
+    def _iter_stats(self, ids=None):
+        '''Yield (item, get_stat result) in the same order as ids or RAW_IDS.
+        
+        With CONCURRENCY above one the items are handed out in batches
+        to a pool of workers, so results are in order however quickly
+        each request finishes and streamed ids are used as they arrive.
+        Items already in STATS_TABLE are not fetched again.'''
+        if ids is None:
+            ids = self.RAW_IDS
+        if self.STATS_TABLE is not None:
+            table = self.STATS_TABLE
+            for item in ids:
+                if item not in table:
+                    table[item] = self.get_stat(item)
+                yield item, table[item]
+            return
+        if self.CONCURRENCY <= 1:
+            for item in ids:
+                yield item, self.get_stat(item)
+            return
+        ids = iter(ids)
+        while True:
+            batch = list(itertools.islice(ids, self.BATCH))
+            if not batch:
+                return
+            stats = workers.map_ordered(self.get_stat, batch,
+                                        self.CONCURRENCY, retries=0,
+                                        control=self.CONTROL)
+            for item, stat in zip(batch, stats):
+                yield item, stat
+
+    def get_stats_table(self, ids):
+        '''Return {item: get_stat result} for ids, to share with reports.'''
+        table = dict()
+        for item, stat in self._iter_stats(ids):
+            table[item] = stat
+        if self.STATE is not None:
+            self.STATE.save()
+        return table
+
     def _get_stats(self):
         '''Get the views and downloads for all items.'''
         start = time.time()
@@ -142,9 +358,9 @@ class ViewsAndDownloads(object):
         clean_count = 0
         
         # Process all the found ids.
-        for item in self.RAW_IDS:
+        for item, stat in self._iter_stats():
             count += 1 
-            views, downs, source, clean, eopen, eindex = self.get_stat(item)
+            views, downs, source, clean, eopen, eindex = stat
             clean_count += clean
             errors_opening += eopen
             errors_index += eindex
@@ -156,25 +372,42 @@ class ViewsAndDownloads(object):
             #    break
             #time.sleep(0.1)
         
+        if self.STATE is not None:
+            self.STATE.save()
+        
         # Store results
         self.REPORT_METHOD['4a. Result IDs checked.'] = count
         self.REPORT_METHOD['4b. Number with results'] = clean_count
         self.REPORT_METHOD['4b. Opening issues'] = errors_opening
         self.REPORT_METHOD['4c. Decode issues'] = errors_index
         self.REPORT_METHOD['4d. Seconds taken get results'] = time.time()-start
+        if self.CONTROL is not None:
+            self.REPORT_METHOD['4g. Stats fetched at once (settled)'] = \
+                                                    self.CONTROL.settled()
         v = self.VIEWS
         d = self.DOWNLOADS
         self.REPORT_ITEMS.append('%s\t%s\tTotals for all items.\n'%(v,d))
         self.REPORT_METHOD['4e. Total number of views'] = v
         self.REPORT_METHOD['4f. Total number of downloads'] = d
             
-    def run(self):
-        '''Run the report to get views and downloads.'''
+    def run(self, stream=False):
+        '''Run the report to get views and downloads.
+        
+        With stream the stats for the first items are fetched while the
+        rest of the ids are still being found.'''
+        self.find_ids(stream)
+        self.count_stats()
+
+    def find_ids(self, stream=False):
+        '''Start the report by finding the ids of the items in it.'''
         if not self.READY:
             raise AttributeError
         when = str(datetime.datetime.now())
         self.REPORT_METHOD['1. Process start time'] = when
-        self._fetch_ids()
+        self._fetch_ids(stream)
+
+    def count_stats(self):
+        '''Finish the report by totalling the stats for the ids found.'''
         self._get_stats()
         when = str(datetime.datetime.now())
         self.REPORT_METHOD['9. Process end time'] = when
@@ -223,13 +456,23 @@ class ViewsAndDownloads(object):
         outfile.write(line)        
         outfile.close()
                     
-    def save_results(self, root=None, summary=True, items=True, ext='txt'):
-        '''Save a report of the views and downloads.'''
+    def save_results(self, root=None, summary=True, items=True, ext='txt',
+                     compress=False):
+        '''Save a report of the views and downloads, gzipped if compress.'''
         outdir = self.output_dir(root)    
         when = time.strftime('%y-%m-%d at %H:%M:%S', time.gmtime())
         self.save_summary(outdir, when)
+        if compress:
+            ext += '.gz'
         outpath = os.path.join(outdir, '%s.%s'%(when, ext))                      
-        outfile = file(outpath, 'w')
+        outfile = output.open_output(outpath, compress)
+        try:
+            self.write_results(outfile, when, summary, items)
+        finally:
+            outfile.close()
+
+    def write_results(self, outfile, when=None, summary=True, items=True):
+        '''Write the report to any file-like object a line at a time.'''
         outfile.write(self.header(when))
         if summary:
             pro = 'Processing summary =====================\n'
@@ -237,11 +480,12 @@ class ViewsAndDownloads(object):
             outfile.write(pro)
         if items:
             outfile.write('\n\nResults for each item.===================\n')
-            outfile.writelines(self.REPORT_ITEMS)
+            output.write_lines(outfile, self.REPORT_ITEMS)
         else:
             outfile.write('\n')
-
-        outfile.close()    
+        if self.METRICS_IN_REPORT:
+            outfile.write('\n\nRequest metrics ========================\n')
+            outfile.write(self.METRICS.report())
         
 if __name__ == '__main__':
     import sources
@@ -5,22 +5,99 @@ import time # used to put a gap between reports
 
 import sources # needed for endpoint
 import vidcount # needed to get views and downloads
+import records # needed to keep the ids of all reports compactly
               
 class Report():
     def __init__(self):
         self.END = sources.Ora().ENDPOINT
         self.SLEEP = 0 # how long should it wait between multiple reports.
+        self.CACHE = None # a cache.ResponseCache shared by the reports.
+        self.CONCURRENCY = 1 # how many items to get stats for at once.
+        self.ADAPTIVE = False # let the stats server choose, up to CONCURRENCY.
+        self.STATE = None # a vidstate.ItemState shared by the reports.
+        self.BATCH_LOG = dict() # what the last batch run saved.
+        self.ROOT = None # where to save reports, None is the current dir.
+        self.COMPRESS = False # gzip the saved reports.
+        self.METRICS = False # add the request metrics to the saved reports.
+        self.TRANSPORT = None # a replay transport to record or replay with.
         self.LIST_FUNDERS = ('JISC', 'wellcome', '"European Union"')
         self.LIST_CONTENT_SOURCES = ('polonsky', 'economics.ouls.ox.ac.uk')
         self.LIST_CUSTOM = (('issn','1545-9993'),
                             ('author', 'comina'),
                             ('faculty', '"School of Conservation Sciences"')
                             )
-    def run(self):
-        '''Run the standard reports'''
+    def new_report(self):
+        '''Return a views and downloads report using the shared cache.'''
+        s = vidcount.ViewsAndDownloads(self.END)
+        s.set_cache(self.CACHE)
+        s.set_concurrency(self.CONCURRENCY, adaptive=self.ADAPTIVE)
+        if self.STATE is not None:
+            s.set_state(self.STATE)
+        if self.METRICS:
+            s.set_metrics()
+        if self.TRANSPORT is not None:
+            s.set_transport(self.TRANSPORT)
+        return s
+
+    def pause(self):
+        '''Wait SLEEP between reports, unless the load is being adapted.'''
+        if not self.ADAPTIVE:
+            time.sleep(self.SLEEP)
+
+    def run(self, batch=False):
+        '''Run the standard reports, with option to share stats between them.'''
+        if batch:
+            self.run_batch()
+            return
         self.do_funders()
         self.do_contentsources()
         self.do_custom_reports()
+
+    def planned(self):
+        '''Return a list of (value, field) for all the standard reports.'''
+        plan = list()
+        for funder in self.LIST_FUNDERS:
+            plan.append((funder, 'funder'))
+        for source in self.LIST_CONTENT_SOURCES:
+            plan.append((source, 'recordContentSource'))
+        for field, value in self.LIST_CUSTOM:
+            plan.append((value, field))
+        return plan
+
+    def run_batch(self, plan=None):
+        '''Run reports, fetching the stats for an item once for all of them.
+        
+        The ids for every report are found first. Then the stats are
+        fetched for each id in the union of those ids, and every report
+        is totalled from that shared table before being saved.'''
+        if not plan:
+            plan = self.planned()
+        logging.info('Finding ids for %s reports'%len(plan))
+        reports = list()
+        union = records.IdSet() # packed, there may be millions of ids
+        for value, field in plan:
+            logging.debug('Finding ids for %s=%s'%(field, value))
+            s = self.new_report()
+            s.set_search(value, field)
+            s.find_ids()
+            reports.append(s)
+            for item in s.RAW_IDS:
+                union.add(item)
+            self.pause()
+        logging.info('Fetching stats for %s unique items'%len(union))
+        table = self.new_report().get_stats_table(union)
+        total = 0
+        for s in reports:
+            total += len(s.RAW_IDS)
+            s.STATS_TABLE = table
+            s.count_stats()
+            s.save_results(self.ROOT, compress=self.COMPRESS)
+        self.BATCH_LOG = {'reports': len(reports), 'item lookups': total,
+                          'stats fetched': len(union),
+                          'fetches saved': total-len(union)}
+        logging.info('Fetched stats for %s items instead of %s, saving %s'%(
+                     len(union), total, total-len(union)))
+        return reports
             
     def do_funders(self, funders=None):
         '''Do all the reports for funders.'''
@@ -29,11 +106,11 @@ class Report():
             funders = self.LIST_FUNDERS 
         for funder in funders:
             logging.debug('Doing funder: %s'%funder)
-            s = vidcount.ViewsAndDownloads(self.END)
+            s = self.new_report()
             s.set_funder(funder)
             s.run()
-            s.save_results()
-            time.sleep(self.SLEEP)    
+            s.save_results(self.ROOT, compress=self.COMPRESS)
+            self.pause()
     
     def do_contentsources(self, sources=None):
         '''Do all the reports for content sources.'''
@@ -42,11 +119,11 @@ class Report():
             sources = self.LIST_CONTENT_SOURCES
         for source in sources:
             logging.debug('Doing content source: %s'%source)
-            s = vidcount.ViewsAndDownloads(self.END)
+            s = self.new_report()
             s.set_recordContentSource(source)
             s.run()
-            s.save_results()
-            time.sleep(self.SLEEP)    
+            s.save_results(self.ROOT, compress=self.COMPRESS)
+            self.pause()
 
     def do_custom_reports(self, customs=None):
         '''Do all the custom reports.'''
@@ -58,14 +135,14 @@ class Report():
             value = custom[1]
             logging.debug('Doing custom: %s=%s'%(field, value))
             self.do_custom(value, field)
-            time.sleep(self.SLEEP)
+            self.pause()
 
     def do_custom(self, value, field):
         '''Do a single custom report where field'''
-        s = vidcount.ViewsAndDownloads(self.END)
+        s = self.new_report()
         s.set_search(value, field)
         s.run()
-        s.save_results()
+        s.save_results(self.ROOT, compress=self.COMPRESS)
         return s.report_method()
         
 if __name__ == '__main__':
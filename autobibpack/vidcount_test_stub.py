@@ -0,0 +1,337 @@
+'''Test the views and downloads report against a local stub Solr.
+
+The item stats come from a temporary copy of the dv directory tree so
+no network connection or live stats server is needed.'''
+import unittest
+import tempfile
+import shutil
+import os
+import gzip
+import time
+import stubsolr
+import workers
+import vidcount
+import dvindex
+import vidcount_ora
+import replay
+import httppool
+import metrics
+import StringIO
+
+def make_dv_tree(root, ids, seed=1, missing=10):
+    '''Write views;downloads files for ids, leaving out one in missing.'''
+    stats = stubsolr.make_stats(ids, seed, missing)
+    for item in stats:
+        path = os.path.join(root, vidcount.stats_path(item).lstrip('/'))
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        outfile = file(path, 'w')
+        outfile.write(stats[item])
+        outfile.close()
+
+class VidcountStub(unittest.TestCase):
+    '''Run reports against the stub Solr and a temporary dv tree.'''
+    def setUp(self):
+        self.DOCS = stubsolr.make_corpus(300)
+        self.STUB = stubsolr.StubSolr(self.DOCS).start()
+        self.ROOT = tempfile.mkdtemp()
+        make_dv_tree(self.ROOT, [doc['id'] for doc in self.DOCS])
+        self.REMOTE = vidcount.ENABLE_STATIC_REMOTE
+        vidcount.ENABLE_STATIC_REMOTE = False
+
+    def tearDown(self):
+        vidcount.ENABLE_STATIC_REMOTE = self.REMOTE
+        shutil.rmtree(self.ROOT)
+        self.STUB.stop()
+
+    def do_report(self, concurrency=1, stream=False, index=None, state=None):
+        s = vidcount.ViewsAndDownloads(self.STUB.ENDPOINT)
+        s.LOCAL_ROOT = self.ROOT
+        s.BATCH = 40
+        s.set_concurrency(concurrency)
+        if index:
+            s.set_index(index)
+        if state:
+            s.set_state(state)
+        s.set_funder('jisc')
+        s.run(stream)
+        return s
+
+    def check_same(self, one, two):
+        self.assertEqual(one.REPORT_ITEMS, two.REPORT_ITEMS)
+        self.assertEqual((one.VIEWS, one.DOWNLOADS),
+                         (two.VIEWS, two.DOWNLOADS))
+        for key in one.REPORT_METHOD:
+            if key.startswith('4') and 'Seconds' not in key:
+                self.assertEqual(one.REPORT_METHOD[key],
+                                 two.REPORT_METHOD[key])
+
+class TestVidcountConcurrent(VidcountStub):
+    '''Check concurrent stats fetching gives the same report as serial.'''
+    def test100_concurrent_same(self):
+        serial = self.do_report()
+        self.assertGreater(serial.REPORT_METHOD['4b. Opening issues'], 0)
+        self.check_same(serial, self.do_report(8))
+
+    def test105_concurrent_stream(self):
+        self.check_same(self.do_report(stream=True),
+                        self.do_report(8, stream=True))
+
+class TestVidcountIndex(VidcountStub):
+    '''Check stats from the dv index match those from the files.'''
+    def setUp(self):
+        VidcountStub.setUp(self)
+        self.INDEX = os.path.join(self.ROOT, 'dv.index')
+
+    def test110_index_same(self):
+        log = dvindex.build_index(self.ROOT, self.INDEX)
+        self.assertEqual(log['items'], 270) # one in ten has no stats file
+        self.check_same(self.do_report(stream=True),
+                        self.do_report(stream=True, index=self.INDEX))
+
+    def test115_incremental(self):
+        dvindex.build_index(self.ROOT, self.INDEX)
+        item = self.DOCS[1]['id']
+        address, sub = vidcount.ViewsAndDownloads('').url_source(item)
+        path = os.path.join(self.ROOT, sub.lstrip('/'))
+        os.remove(path)
+        last = '1' if item.endswith('0') else '0'
+        outfile = file(path[:-1]+last, 'w') # a new item in the same place
+        outfile.write('7;3')
+        outfile.close()
+        later = time.time()+10 # directory times may only have 1s accuracy
+        os.utime(os.path.dirname(path), (later, later))
+        log = dvindex.build_index(self.ROOT, self.INDEX)
+        self.assertEqual(log['scanned'], 1)
+        index = dvindex.DVIndex(self.INDEX)
+        self.assertEqual(index.lookup(item), None)
+        self.assertEqual(index.lookup(item[:-1]+last), (7, 3))
+        index.close()
+
+class TestVidcountState(VidcountStub):
+    '''Check a second run only reads the stats that have changed.'''
+    def test100_reuse_unchanged(self):
+        path = os.path.join(self.ROOT, 'state.json')
+        first = self.do_report(state=path)
+        self.assertEqual(first.STATE.STATS['reused'], 0)
+        self.assertGreater(first.STATE.STATS['new'], 0)
+        second = self.do_report(state=path)
+        self.assertEqual(second.STATE.STATS['reused'],
+                         first.STATE.STATS['new'])
+        self.assertEqual(second.STATE.STATS['new'], 0)
+        self.check_same(first, second)
+        self.check_same(first, self.do_report())
+
+    def test105_refetch_changed(self):
+        path = os.path.join(self.ROOT, 'state.json')
+        first = self.do_report(state=path)
+        # Change the stats of one found item and move its modified time on.
+        item = first.REPORT_ITEMS[1].split('\t')[2]
+        address, sub = first.url_source(item)
+        local = os.path.join(self.ROOT, sub.lstrip('/'))
+        outfile = file(local, 'w')
+        outfile.write('1000;1000\n')
+        outfile.close()
+        later = os.stat(local).st_mtime+10
+        os.utime(local, (later, later))
+        second = self.do_report(state=path)
+        self.assertEqual(second.STATE.STATS['refetched'], 1)
+        self.assertEqual(second.STATE.STATS['reused'],
+                         first.STATE.STATS['new']-1)
+        self.check_same(second, self.do_report())
+
+class TestVidcountRemote(VidcountStub):
+    '''Check stats served like orastats give the same totals as the files.'''
+    def test100_remote_same(self):
+        ids = [doc['id'] for doc in self.DOCS]
+        remote = stubsolr.StubSolr(self.DOCS, stats=stubsolr.make_stats(ids))
+        remote.start()
+        vidcount.ENABLE_STATIC_REMOTE = True
+        try:
+            s = vidcount.ViewsAndDownloads(remote.ENDPOINT)
+            s.LOCAL_ROOT = os.path.join(self.ROOT, 'none', '')
+            s.set_stats_server(remote.STATS_SERVER)
+            s.set_funder('jisc')
+            s.run()
+        finally:
+            remote.stop()
+        local = self.do_report()
+        self.assertEqual((s.VIEWS, s.DOWNLOADS),
+                         (local.VIEWS, local.DOWNLOADS))
+        self.assertEqual(s.REPORT_METHOD['4b. Opening issues'],
+                         local.REPORT_METHOD['4b. Opening issues'])
+        self.assertGreater(remote.REQUESTS, len(s.RAW_IDS)) # one per item
+
+    def test105_replay(self):
+        ids = [doc['id'] for doc in self.DOCS]
+        remote = stubsolr.StubSolr(self.DOCS, stats=stubsolr.make_stats(ids))
+        remote.start()
+        vidcount.ENABLE_STATIC_REMOTE = True
+        path = os.path.join(self.ROOT, 'run.archive')
+        reports = list()
+        try:
+            for transport in (replay.RecordTransport(path), None):
+                if transport is None:
+                    remote.stop() # so the replay can only use the archive
+                    transport = replay.ReplayTransport(path)
+                s = vidcount.ViewsAndDownloads(remote.ENDPOINT)
+                s.LOCAL_ROOT = os.path.join(self.ROOT, 'none', '')
+                s.set_stats_server(remote.STATS_SERVER)
+                s.set_transport(transport)
+                s.set_funder('jisc')
+                s.run()
+                transport.close()
+                reports.append(s)
+        finally:
+            remote.stop()
+        self.assertEqual(transport.MISSES, [])
+        self.check_same(reports[0], reports[1])
+
+    def test110_adaptive(self):
+        ids = [doc['id'] for doc in self.DOCS]
+        remote = stubsolr.StubSolr(self.DOCS, stats=stubsolr.make_stats(ids))
+        remote.start()
+        vidcount.ENABLE_STATIC_REMOTE = True
+        try:
+            s = vidcount.ViewsAndDownloads(remote.ENDPOINT)
+            s.LOCAL_ROOT = os.path.join(self.ROOT, 'none', '')
+            s.set_concurrency(4, adaptive=True)
+            s.set_stats_server(remote.STATS_SERVER)
+            s.set_funder('jisc')
+            s.run()
+        finally:
+            remote.stop()
+        local = self.do_report()
+        self.assertEqual((s.VIEWS, s.DOWNLOADS),
+                         (local.VIEWS, local.DOWNLOADS))
+        settled = s.REPORT_METHOD['4g. Stats fetched at once (settled)']
+        self.assertTrue(1 <= settled <= 4)
+        self.assertTrue(s.CONTROL is workers.controller_for(
+                                                    remote.STATS_SERVER))
+
+    def test115_host_limit(self):
+        most = httppool.POOL.HOST_LIMIT
+        s = vidcount.ViewsAndDownloads(self.STUB.ENDPOINT)
+        s.set_concurrency(4, host_limit=1)
+        s.set_stats_server(self.STUB.STATS_SERVER)
+        try:
+            self.assertEqual(httppool.POOL.host_limit(self.STUB.STATS_SERVER),
+                             1)
+            # Only the stats server is limited, not the rest of the pool.
+            self.assertEqual(httppool.POOL.host_limit(vidcount.STATS_SERVER),
+                             most)
+            self.assertEqual(httppool.POOL.HOST_LIMIT, most)
+        finally:
+            httppool.POOL.limit_host(self.STUB.STATS_SERVER)
+
+class TestVidcountMetrics(VidcountStub):
+    '''Check every search and stats read is recorded.'''
+    def test100_recorded(self):
+        recorder = metrics.Recorder()
+        s = vidcount.ViewsAndDownloads(self.STUB.ENDPOINT)
+        s.LOCAL_ROOT = self.ROOT
+        s.set_metrics(recorder)
+        s.set_funder('jisc')
+        s.run()
+        summary = recorder.summary()
+        solr = summary[('solr', metrics.endpoint_of(self.STUB.ENDPOINT))]
+        self.assertEqual(solr['count'], self.STUB.REQUESTS)
+        self.assertEqual(solr['qtime_p50'], 0)
+        self.assertEqual(solr['cache'], {'off': solr['count']})
+        local = summary[('stats_local', 'local')]
+        self.assertEqual(local['count'], len(s.RAW_IDS))
+        self.assertEqual(local['errors'].get('IOError'),
+                         s.REPORT_METHOD['4b. Opening issues'])
+        self.assertEqual(local['templates'].keys(),
+                         [self.ROOT+'/results/dv/*/*/*'])
+        self.assertEqual(sum(count for bound, count in local['histogram']),
+                         local['count'])
+        outfile = StringIO.StringIO()
+        s.write_results(outfile)
+        self.assertTrue('Request metrics' in outfile.getvalue())
+        self.assertTrue('\nstats_local\tlocal\t%s\t'%local['count']
+                        in outfile.getvalue())
+
+    def test105_template(self):
+        url = 'http://solr:8080/select?q=id:1&rows=10&fq=a&fq=b'
+        self.assertEqual(metrics.url_template(url),
+                         'http://solr:8080/select?fq=&q=&rows=')
+        self.assertEqual(metrics.percentile(range(101), 90), 90)
+
+    def test110_own_recorder(self):
+        counts = list()
+        for count in range(2):
+            s = vidcount.ViewsAndDownloads(self.STUB.ENDPOINT)
+            s.LOCAL_ROOT = self.ROOT
+            s.set_metrics()
+            s.set_funder('jisc')
+            s.run()
+            local = s.METRICS.summary()[('stats_local', 'local')]
+            counts.append(local['count'])
+        self.assertEqual(counts, [len(s.RAW_IDS)]*2) # not the first's too
+
+class StubReport(vidcount_ora.Report):
+    '''The ORA reports, reading stats from a temporary dv tree.'''
+    def new_report(self):
+        s = vidcount_ora.Report.new_report(self)
+        s.LOCAL_ROOT = self.LOCAL_ROOT
+        return s
+
+class TestVidcountBatch(VidcountStub):
+    '''Check a batch of reports fetches shared stats once.'''
+    def setUp(self):
+        VidcountStub.setUp(self)
+        self.PLAN = [('jisc', 'funder'), ('polonsky', 'recordContentSource'),
+                     ('synthetic', 'title')]
+        self.REPORT = StubReport()
+        self.REPORT.END = self.STUB.ENDPOINT
+        self.REPORT.LOCAL_ROOT = self.ROOT
+        self.REPORT.ROOT = os.path.join(self.ROOT, 'export')
+
+    def test100_batch_same(self):
+        reports = self.REPORT.run_batch(self.PLAN)
+        for s, (value, field) in zip(reports, self.PLAN):
+            single = vidcount.ViewsAndDownloads(self.STUB.ENDPOINT)
+            single.LOCAL_ROOT = self.ROOT
+            single.set_search(value, field)
+            single.run()
+            self.check_same(single, s)
+
+    def test105_fetches_saved(self):
+        reports = self.REPORT.run_batch(self.PLAN)
+        log = self.REPORT.BATCH_LOG
+        self.assertEqual(log['stats fetched'], len(self.DOCS))
+        self.assertEqual(log['item lookups'],
+                         sum(len(s.RAW_IDS) for s in reports))
+        self.assertGreater(log['fetches saved'], len(self.DOCS)/2)
+
+    def test110_compressed(self):
+        self.REPORT.COMPRESS = True
+        reports = self.REPORT.run_batch(self.PLAN)
+        saved = list()
+        for path, dirs, files in os.walk(self.REPORT.ROOT):
+            saved.extend(os.path.join(path, f) for f in files
+                         if f.endswith('.txt.gz'))
+        self.assertEqual(len(saved), len(self.PLAN))
+        infile = gzip.open(saved[0])
+        lines = infile.readlines()
+        infile.close()
+        self.assertTrue(lines[0].startswith('Report for'))
+        self.assertTrue(lines[-1].endswith('Totals for all items.\n'))
+
+# ===============================================================
+#  Enable use of these tests by external script.
+# ===============================================================
+SUITE_NAME = str(__name__)
+TESTS_AVAILABLE = [TestVidcountConcurrent, TestVidcountIndex,
+                   TestVidcountState, TestVidcountRemote,
+                   TestVidcountMetrics, TestVidcountBatch]
+def suite(tests=TESTS_AVAILABLE):
+    '''Return a test suite of tests so this can run run by external script.'''
+    suite  = unittest.TestSuite()
+    for test in tests:
+        suite.addTests(unittest.TestLoader().loadTestsFromTestCase(test))
+    return suite 
+    
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
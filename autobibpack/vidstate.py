@@ -0,0 +1,83 @@
+'''Remember the views and downloads of each item between report runs.
+
+Most items' numbers do not change between scheduled runs. Keeping what
+was found last time, with the modified time of the local stats file or
+the ETag and Last-Modified of the remote one, lets the next run check
+an item cheaply (a stat call or a 304 response) and only read the
+stats again for items that are new or have changed.
+
+Using the state
+===============
+state = ItemState('vidcount_state.json')
+s = vidcount.ViewsAndDownloads(endpoint)
+s.set_state(state) # saved at the end of each run
+...
+print state.STATS
+'''
+import os
+import json
+import time
+import threading
+
+class ItemState(object):
+    '''Per item views, downloads and how to tell if they have changed.'''
+    def __init__(self, path, max_age=None):
+        self.PATH = path
+        self.MAX_AGE = max_age # Seconds before an item is read again anyway.
+        self.LOCK = threading.Lock()
+        self.ITEMS = dict() # key = uuid, value = dictionary of state.
+        self.reset_stats()
+        self.load()
+
+    def reset_stats(self):
+        '''Set the counters of reused, refetched and new items to zero.'''
+        self.STATS = {'reused': 0, 'refetched': 0, 'new': 0}
+
+    def load(self):
+        '''Read the state saved by the last run, if there is one.'''
+        if not os.path.exists(self.PATH):
+            return
+        infile = file(self.PATH)
+        try:
+            self.ITEMS = json.load(infile)
+        except ValueError: # a damaged file just means starting again
+            self.ITEMS = dict()
+        infile.close()
+
+    def save(self):
+        '''Write the state to disk in one go.'''
+        with self.LOCK:
+            data = json.dumps(self.ITEMS, separators=(',', ':'))
+        temp = '%s.tmp'%self.PATH
+        outfile = file(temp, 'w')
+        outfile.write(data)
+        outfile.close()
+        os.rename(temp, self.PATH)
+
+    def get(self, item):
+        '''Return the saved state for item, or None if too old or missing.'''
+        with self.LOCK:
+            found = self.ITEMS.get(item)
+        if found and self.MAX_AGE is not None:
+            if time.time()-found['fetched'] > self.MAX_AGE:
+                return None
+        return found
+
+    def unchanged(self, item, found):
+        '''Return the stats text for an item found to be unchanged.'''
+        with self.LOCK:
+            self.STATS['reused'] += 1
+        return '%s;%s'%(found['views'], found['downloads'])
+
+    def put(self, item, views, downloads, mtime=None, etag=None,
+            last_modified=None):
+        '''Save the stats just read for item with how to check them later.'''
+        entry = {'views': views, 'downloads': downloads, 'mtime': mtime,
+                 'etag': etag, 'last_modified': last_modified,
+                 'fetched': time.time()}
+        with self.LOCK:
+            if item in self.ITEMS:
+                self.STATS['refetched'] += 1
+            else:
+                self.STATS['new'] += 1
+            self.ITEMS[item] = entry
@@ -0,0 +1,307 @@
+'''Run a function over many items with a bounded pool of threads.
+
+The results always come back in the same order as the items, however
+the requests finish, so reports built from them do not change between
+runs. Items that fail are retried in later rounds, items that worked
+are never run again.
+
+A TokenBucket shared by the threads limits how many calls a second are
+made, e.g. to one endpoint, however many threads there are.
+
+A Controller shared by everything calling one endpoint chooses how many
+calls are made at once. It adds one while the latency stays flat, cuts
+back when the latency or the Solr QTime rises, and cuts back and pauses
+for a while on timeouts and 429 or 503 answers. It learns of each
+request from the metrics module, so searches, day loads and stats
+fetches to the same endpoint all steer it.'''
+import threading
+import Queue
+import time
+import collections
+
+import metrics # tells the controllers how each request went
+import httppool # caps the controllers at its connections for a host
+
+BUCKETS = dict() # key = endpoint, value = the TokenBucket shared for it.
+BUCKETS_LOCK = threading.Lock()
+CONTROLLERS = dict() # key = scheme://host:port, value = its Controller.
+FIRST_LIMIT = 2 # Calls at once a new Controller starts with.
+SMOOTHING = 0.2 # Weight of the newest latency in the running average.
+BASE_DRIFT = 0.01 # How quickly the usual latency follows a higher one.
+LATENCY_RISE = 2.0 # Latency this many times the usual is a slow down...
+MIN_RISE = 0.01 # ...if it is also this many seconds more.
+QTIME_RISE = 2.0 # The same for QTime...
+MIN_QTIME_RISE = 20 # ...and milliseconds of QTime.
+SLOW_CUT = 0.75 # The share of calls kept when the endpoint slows down.
+OVERLOAD_CUT = 0.5 # The share of calls kept on a timeout, 429 or 503.
+CUT_GAP = 0.5 # Seconds between cuts, so one burst of errors cuts once.
+FIRST_BACKOFF = 0.5 # Seconds paused after the first overload in a row...
+MAX_BACKOFF = 30.0 # ...doubling with each one up to this.
+SETTLE_SAMPLES = 50 # Limits averaged to say where the controller settled.
+
+class TokenBucket(object):
+    '''Allow rate calls a second on average, with bursts of up to burst.'''
+    def __init__(self, rate, burst=1):
+        self.LOCK = threading.Lock()
+        self.RATE = float(rate)
+        self.BURST = burst
+        self.TOKENS = float(burst)
+        self.STAMP = time.time()
+        self.WAITED = 0.0 # Seconds spent waiting for a token.
+
+    def take(self):
+        '''Wait until a call is allowed, then use up one token.'''
+        while True:
+            with self.LOCK:
+                now = time.time()
+                self.TOKENS = min(self.BURST,
+                                  self.TOKENS+(now-self.STAMP)*self.RATE)
+                self.STAMP = now
+                if self.TOKENS >= 1:
+                    self.TOKENS -= 1
+                    return
+                wait = (1-self.TOKENS)/self.RATE
+                self.WAITED += wait
+            time.sleep(wait)
+
+def bucket_for(key, rate, burst=1):
+    '''Return the TokenBucket shared by everything calling key.'''
+    with BUCKETS_LOCK:
+        bucket = BUCKETS.get(key)
+        if bucket is None:
+            bucket = BUCKETS[key] = TokenBucket(rate, burst)
+        else:
+            with bucket.LOCK:
+                bucket.RATE = float(rate)
+                bucket.BURST = burst
+        return bucket
+
+class Controller(object):
+    '''Choose how many calls at once an endpoint is given, from 1 to most.'''
+    def __init__(self, most=8, least=1, start=FIRST_LIMIT):
+        self.COND = threading.Condition()
+        self.MOST = most
+        self.LEAST = least
+        self.LIMIT = float(max(least, min(start, most))) # Calls allowed.
+        self.ACTIVE = 0 # Calls being made now.
+        self.LATENCY = None # Running average of seconds taken.
+        self.BASE = None # The usual latency when all is well.
+        self.QTIME = None # Running average of the Solr QTime.
+        self.BASE_QTIME = None
+        self.BACKOFF = 0.0 # Seconds the last overload paused for.
+        self.PAUSE_UNTIL = 0.0 # No calls start before this time.
+        self.LAST_CUT = 0.0
+        self.HISTORY = collections.deque(maxlen=SETTLE_SAMPLES)
+        self.STATS = {'requests': 0, 'overloads': 0, 'slowdowns': 0,
+                      'most_active': 0}
+
+    def acquire(self):
+        '''Wait until another call is allowed, then count it as active.'''
+        with self.COND:
+            while True:
+                wait = self.PAUSE_UNTIL-time.time()
+                if wait <= 0 and self.ACTIVE < int(self.LIMIT):
+                    break
+                self.COND.wait(max(0.01, min(wait, 1.0)))
+            self.ACTIVE += 1
+            self.STATS['most_active'] = max(self.STATS['most_active'],
+                                            self.ACTIVE)
+
+    def release(self):
+        with self.COND:
+            self.ACTIVE -= 1
+            self.COND.notify_all()
+
+    def observe(self, sample):
+        '''Change the limit for how one request went, a metrics sample.'''
+        if sample.get('cache') == 'hit':
+            return # the endpoint was not asked
+        with self.COND:
+            self.STATS['requests'] += 1
+            now = time.time()
+            if overloaded(sample):
+                self.STATS['overloads'] += 1
+                self.cut(now, OVERLOAD_CUT)
+                self.BACKOFF = min(MAX_BACKOFF,
+                                   max(FIRST_BACKOFF, self.BACKOFF*2))
+                wait = sample.get('retry_after') or self.BACKOFF
+                self.PAUSE_UNTIL = max(self.PAUSE_UNTIL, now+wait)
+            elif not sample.get('error'):
+                self.BACKOFF = 0.0
+                self.LATENCY, self.BASE = smoothed(self.LATENCY, self.BASE,
+                                                   sample['seconds'])
+                if sample.get('qtime') is not None:
+                    self.QTIME, self.BASE_QTIME = smoothed(self.QTIME,
+                                        self.BASE_QTIME, sample['qtime'])
+                if self.rising():
+                    self.STATS['slowdowns'] += 1
+                    self.cut(now, SLOW_CUT)
+                else:
+                    self.LIMIT = min(self.MOST, self.LIMIT+1.0/self.LIMIT)
+            self.HISTORY.append(self.LIMIT)
+            self.COND.notify_all()
+
+    def rising(self):
+        '''Return True if the latency or QTime is well above the usual.'''
+        if self.LATENCY > self.BASE*LATENCY_RISE and \
+           self.LATENCY-self.BASE > MIN_RISE:
+            return True
+        return self.QTIME is not None and \
+               self.QTIME > self.BASE_QTIME*QTIME_RISE and \
+               self.QTIME-self.BASE_QTIME > MIN_QTIME_RISE
+
+    def cut(self, now, share):
+        '''Cut the limit to share of itself, at most once every CUT_GAP.'''
+        if now-self.LAST_CUT < CUT_GAP:
+            return
+        self.LIMIT = max(self.LEAST, self.LIMIT*share)
+        self.LAST_CUT = now
+
+    def settled(self):
+        '''Return the calls at once the controller has settled on.'''
+        with self.COND:
+            if not self.HISTORY:
+                return int(self.LIMIT)
+            return int(round(sum(self.HISTORY)/len(self.HISTORY)))
+
+    def summary(self):
+        '''Return the settled limit and what the controller has seen.'''
+        found = dict(self.STATS)
+        found['settled'] = self.settled()
+        found['limit'] = int(self.LIMIT)
+        for name, value in (('latency_ms', self.LATENCY),
+                            ('usual_ms', self.BASE)):
+            found[name] = None if value is None else round(value*1000, 1)
+        return found
+
+def smoothed(average, base, value):
+    '''Return the running average and usual value with value added.'''
+    if average is None:
+        return value, value
+    average += (value-average)*SMOOTHING
+    if average < base:
+        base = average
+    else:
+        base += (average-base)*BASE_DRIFT
+    return average, base
+
+def overloaded(sample):
+    '''Return True if a request timed out or was told to slow down.'''
+    if sample.get('status') in (429, 503):
+        return True
+    return sample.get('error') == 'timeout' or \
+           'timed out' in (sample.get('message') or '')
+
+def controller_for(url, most=8):
+    '''Return the Controller shared by every call to the endpoint of url.
+    
+    most is capped at the pool's connections for a host. Calls above
+    that would wait for a connection, and their time would count as the
+    endpoint slowing down.'''
+    key = metrics.endpoint_of(url)
+    most = max(1, min(most, httppool.POOL.host_limit(url)))
+    with BUCKETS_LOCK:
+        control = CONTROLLERS.get(key)
+        if control is None:
+            control = CONTROLLERS[key] = Controller(most)
+        else:
+            control.MOST = max(control.MOST, most)
+        metrics.watch(observe)
+        return control
+
+def observe(sample):
+    '''Tell the controller of the sample's endpoint, if any, how it went.'''
+    control = CONTROLLERS.get(sample['endpoint'])
+    if control is not None:
+        control.observe(sample)
+
+def map_ordered(func, items, concurrency=4, retries=2, limit=None,
+                progress=None, control=None):
+    '''Return [func(item) for item in items] using up to concurrency threads.
+
+    Each failing item is tried again up to retries more times. If it
+    still fails the error from the first such item is raised. If limit
+    is a TokenBucket each call waits for a token. If control is a
+    Controller it chooses how many of the threads make calls at once.
+    progress is called as progress(done, total, item, error) after
+    every call, error is None when the call worked.'''
+    items = list(items)
+    results = [None]*len(items)
+    pending = range(len(items))
+    errors = dict()
+    if control is not None:
+        func = controlled(func, control)
+    if limit is not None:
+        func = limited(func, limit)
+    if progress is not None:
+        func = reporting(func, len(items), progress)
+    for attempt in range(retries+1):
+        errors = run_round(func, items, pending, results, concurrency)
+        pending = sorted(errors)
+        if not pending:
+            return results
+    raise errors[pending[0]]
+
+def limited(func, limit):
+    '''Return func wrapped to take a token from limit before each call.'''
+    def call(item):
+        limit.take()
+        return func(item)
+    return call
+
+def controlled(func, control):
+    '''Return func wrapped to wait until control allows another call.'''
+    def call(item):
+        control.acquire()
+        try:
+            return func(item)
+        finally:
+            control.release()
+    return call
+
+def reporting(func, total, progress):
+    '''Return func wrapped to tell progress about each call.'''
+    lock = threading.Lock()
+    done = [0]
+    def call(item):
+        try:
+            answer = func(item)
+        except Exception, error:
+            with lock:
+                progress(done[0], total, item, error)
+            raise
+        with lock:
+            done[0] += 1
+            progress(done[0], total, item, None)
+        return answer
+    return call
+
+def run_round(func, items, pending, results, concurrency):
+    '''Run func on the pending item indexes, return {index: error}.'''
+    waiting = Queue.Queue()
+    for index in pending:
+        waiting.put(index)
+    errors = dict()
+    def work():
+        while True:
+            try:
+                index = waiting.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results[index] = func(items[index])
+            except Exception, error:
+                errors[index] = error
+    if concurrency <= 1:
+        work() # in this thread, so Ctrl-C stops it at once
+        return errors
+    threads = list()
+    for count in range(min(concurrency, len(pending))):
+        thread = threading.Thread(target=work)
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        while thread.is_alive(): # a join with no timeout blocks Ctrl-C
+            thread.join(0.1)
+    return errors
@@ -1,17 +1,34 @@
 '''Storage and generation of statistical data over time.
 
 This module will store totals for each day of the year. It will generate
-a storage dictionary populated with zeros which you can then use to
+a store of totals, one array position per day, which you can then use
 to fetch data from a data source.
 
 The data generated can then be output in various formats.
 '''
 import datetime
+from array import array # one compact block of totals, see _reset
 from calendar import monthrange # needed to work out days per year/month 
 import random, time # Enables the internal testing dummy data loader
-LOG_FETCH = False
+import os
+import json
+import threading
+import output
+import workers # Runs the day loaders on a pool of threads.
+import cache # Says which days have settled.
+LOG_FETCH = False # Print each day as it is fetched.
 SIM_DELAY = 0.0  #rough speed per search to simulate the time it takes.
 FETCH_DELAY = 0.0 # the time in seconds to pause between fetches
+CHECKPOINT_EVERY = 100 # Days fetched between saves of the checkpoint.
+
+settled = cache.settled # The same days are settled for the cache TTLs.
+
+def log_progress(done, total, day, error):
+    '''Print each day fetched, the progress used when LOG_FETCH is True.'''
+    if error is None:
+        print '%s/%s\t%s-%02d-%02d'%((done, total)+day)
+    else:
+        print 'retry\t%s-%02d-%02d\t%s'%(day+(error,))
 
 class StatMake(object):
     def __init__(self, data_loader=None):
@@ -20,6 +37,8 @@ class StatMake(object):
             self.FETCH_DATA = data_loader
         else:
             self.FETCH_DATA = self.dummy_data_loader # Example of data loader
+        self.set_scheduler()
+        self.set_checkpoint(None)
         self.reset()
     
     def dummy_data_loader(self, year, month, day):
@@ -39,6 +58,75 @@ class StatMake(object):
         self.MONTHS = range(1,13)
         self.reset_store()
         
+    def set_scheduler(self, concurrency=1, rate=None, retries=2, key=None,
+                      progress=None, adaptive=False):
+        '''Fetch days on up to concurrency threads, at most rate a second.
+        
+        Each day is tried again up to retries times if its loader fails.
+        StatMakes given the same key, e.g. the endpoint, share one rate
+        limit. progress is called as progress(done, total, day, error)
+        after every day, where day is (year, month, day). If adaptive
+        and key is the endpoint URL, its workers.Controller chooses how
+        many of the threads fetch at once, and FETCH_DELAY is not used.'''
+        self.CONCURRENCY = concurrency
+        self.RETRIES = retries
+        self.CONTROL = None
+        if adaptive and key:
+            self.CONTROL = workers.controller_for(key, concurrency)
+        if not rate:
+            self.LIMIT = None
+        elif key is None:
+            self.LIMIT = workers.TokenBucket(rate)
+        else:
+            self.LIMIT = workers.bucket_for(key, rate)
+        self.PROGRESS = progress
+
+    def set_checkpoint(self, path, key=None, every=CHECKPOINT_EVERY):
+        '''Save the days fetched to path so an interrupted fetch can resume.
+        
+        The checkpoint is saved every so many days and when the fetch
+        ends. The next fetch only gets the days missing from it, or not
+        yet settled. key names what is counted, e.g. the endpoint and
+        field, so a checkpoint for something else is not used.'''
+        self.CHECKPOINT = path
+        self.CHECKPOINT_KEY = key
+        self.CHECKPOINT_EVERY = every
+
+    def load_checkpoint(self, today=None):
+        '''Fill the settled days found in the checkpoint, return how many.'''
+        if not self.CHECKPOINT or not os.path.exists(self.CHECKPOINT):
+            return 0
+        infile = file(self.CHECKPOINT)
+        try:
+            saved = json.load(infile)
+        except ValueError: # a damaged checkpoint just means starting again
+            return 0
+        finally:
+            infile.close()
+        if saved.get('key') != self.CHECKPOINT_KEY:
+            return 0
+        count = 0
+        for year, month, day, total in saved['days']:
+            pos = self.OFFSET.get((year, month, day))
+            if pos is not None and settled((year, month, day), today):
+                self.STORE[pos] = total
+                self.FILLED[pos] = 1
+                count += 1
+        return count
+
+    def save_checkpoint(self):
+        '''Write the days filled so far to the checkpoint in one go.'''
+        days = list()
+        for pos, filled in enumerate(self.FILLED):
+            if filled:
+                days.append(self.DAYS[pos]+(self.STORE[pos],))
+        temp = '%s.tmp'%self.CHECKPOINT
+        outfile = file(temp, 'w')
+        json.dump({'key': self.CHECKPOINT_KEY, 'days': days}, outfile,
+                  separators=(',', ':'))
+        outfile.close()
+        os.rename(temp, self.CHECKPOINT)
+
     def set_years(self, start, end):
         '''Set the start and end years for the data required.'''
         self.YEARS = range(start, end+1)
@@ -51,124 +139,173 @@ class StatMake(object):
     
     def reset_store(self):
         '''Reset the store to reflect changes to years and months to check.'''
-        self.STORE = dict()
         self._store_action('reset')
 
     def _store_action(self, action=None, hide=None):
         '''Perform an action on the internal data store and hide bits if output.
         
         You can reset, fetch or return the data in different formats.''' 
-        RESET = 'reset'
-        FETCH = 'fetch'
-        TSV = 'pprint'
-        CSV = 'rawdata'
         if not action in self.STORE_ACTIONS:
             raise Exception
+        if action == 'reset':
+            self._reset()
+            return str()
+        elif action == 'fetch':
+            self._fetch()
+            return str()
+        return ''.join(self.iter_lines(action, hide))
+
+    def iter_lines(self, action='pprint', hide=None):
+        '''Yield the lines of the rawdata (CSV) or pprint (TSV) output.'''
+        if action == 'rawdata':
+            return self._iter_csv()
+        elif action == 'pprint':
+            return self._iter_tsv(hide)
+        raise Exception
+
+    def write(self, outfile, action='pprint', hide=None):
+        '''Write the output a line at a time to a file-like object.'''
+        return output.write_lines(outfile, self.iter_lines(action, hide))
+
+    def save(self, path, action='pprint', hide=None, compress=None):
+        '''Save the output to path, gzip compressed if it ends in .gz.'''
+        outfile = output.open_output(path, compress)
+        try:
+            self.write(outfile, action, hide)
+        finally:
+            outfile.close()
+
+    def _reset(self):
+        '''Make the calendar index and a store of one total for each day.
         
-        # Prepare the header if the store is output.
-        if action == CSV:
-            head = 'year,month,day,total\n' 
-        elif action == TSV:
-            head = 'Year\tMonth\tDay\tDTotal\tMTotal\tYTotal\tTotal\n'
-        else:
-            head = str() # head must contain some value or loop can fail.
+        STORE is a single array of totals in date order. DAYS gives the
+        (year, month, day) of each position, OFFSET the position of each
+        day, SPANS the [start, end) positions of each month and YEAR_SPANS
+        the months and positions of each year.'''
+        self.DAYS = list()
+        self.SPANS = list() # (year, month, start, end)
+        self.YEAR_SPANS = list() # (year, first month, last month, start, end)
+        for year in self.YEARS:
+            first = len(self.SPANS)
+            start_year = len(self.DAYS)
+            for month in self.MONTHS:
+                weekday, day_range = monthrange(year, month)
+                #weekday = day of the week month begins, NOT day of week for a date
+                start = len(self.DAYS)
+                for day in range(1, day_range):
+                    self.DAYS.append((year, month, day))
+                self.SPANS.append((year, month, start, len(self.DAYS)))
+            self.YEAR_SPANS.append((year, first, len(self.SPANS),
+                                    start_year, len(self.DAYS)))
+        self.OFFSET = dict((day, pos) for pos, day in enumerate(self.DAYS))
+        self.STORE = array('l', [1])*len(self.DAYS)
+        self.FILLED = bytearray(len(self.DAYS)) # 1 for each day fetched
+        self.LOADED_DAYS = 0 # Days the last fetch took from the checkpoint.
+
+    def _fetch(self):
+        '''Get the total for every day from the data loader.
+        
+        Days are fetched by the scheduler set with set_scheduler. Each
+        total goes straight to the day's place in the store, so the store
+        is the same whatever order the days finish in. With a checkpoint
+        the settled days it holds are not fetched again.'''
+        progress = self.PROGRESS
+        if progress is None and LOG_FETCH:
+            progress = log_progress
+        self.FILLED = bytearray(len(self.DAYS))
+        self.LOADED_DAYS = self.load_checkpoint()
+        wanted = [day for pos, day in enumerate(self.DAYS)
+                  if not self.FILLED[pos]]
+        lock = threading.Lock()
+        count = [0]
+        def load(day):
+            pos = self.OFFSET[day]
+            self.STORE[pos] = self.FETCH_DATA(*day)
+            self.FILLED[pos] = 1
+            if FETCH_DELAY and self.CONTROL is None:
+                time.sleep(FETCH_DELAY)
+            if self.CHECKPOINT:
+                with lock:
+                    count[0] += 1
+                    if count[0] % self.CHECKPOINT_EVERY == 0:
+                        self.save_checkpoint()
+        try:
+            workers.map_ordered(load, wanted, self.CONCURRENCY, self.RETRIES,
+                                self.LIMIT, progress, self.CONTROL)
+        finally:
+            if self.CHECKPOINT:
+                with lock:
+                    self.save_checkpoint()
+
+    def _sums(self):
+        '''Return the running totals of the store, sums[n] is STORE[:n].'''
+        sums = array('l', [0])*(len(self.STORE)+1)
+        total = 0
+        for pos, value in enumerate(self.STORE):
+            total += value
+            sums[pos+1] = total
+        return sums
+
+    def _iter_csv(self):
+        '''Yield every day as year,month,day,total lines.'''
+        head = 'year,month,day,total\n'
+        yield head
+        for (year, month, day), total in zip(self.DAYS, self.STORE):
+            yield '%s,%s,%s,%s\n'%(year, month, day, total)
+        yield head
+
+    def _iter_tsv(self, hide=None):
+        '''Yield the days, months and years with their totals as TSV lines.
         
-        # Customise the TSV output when needed.
-        hide_valid = ('day', 'month')
-        #if not hide in hide_valid:
-         #   hide = 'month'
+        hide can be 'day' to show only months or 'month' to show only years.'''
         if hide == 'day':
             head = 'Year\tMonth\tMTotal\tYTotal\tTotal\n'
-            SHOW_MONTH = True
-            SHOW_DAY = False
         elif hide == 'month':
             head = 'Year\tYTotal\tTotal\n'
-            SHOW_MONTH = False
-            SHOW_DAY = False
         else:
-            head = head
-            SHOW_MONTH = True
-            SHOW_DAY = True
-            
-        header = head # Enables the head to be using in multiple places.
-        lines = header # Store the textual output from data store.
-        total_all = 0 # Keep a running total for all years.
-        
-        # Perform operations for each year.
-        for year in self.YEARS:
-            total_year = 0
-            if action == RESET:
-                self.STORE[year] = dict()
-            elif action == FETCH and LOG_FETCH: # do nothing unless logging
-                print year
-            elif action == TSV and SHOW_MONTH:
-                lines += '%s\n'%(year)
-                
-            # Perform operations for each month
-            for month in self.MONTHS:
-                total_month = 0
-                if action == RESET:
-                    self.STORE[year][month] = dict()
-                elif action == FETCH and LOG_FETCH:  # do nothing unless logging
-                    print month
-                elif action == TSV and hide not in ['month','day']:
-                    lines += '\t%s\n'% month
-                day_range = 5
-                weekday, day_range = monthrange(year, month)
-                #weekday = day of the week month begins, NOT day of week for a date
-                
-                # Perform operations for each day
-                for day in range(1,day_range):
-                    if action == RESET:
-                        self.STORE[year][month][day] = {'total': 1, 'query': ''}
-                    elif action == FETCH:
-                        if LOG_FETCH:
-                            print day,
-                        self.STORE[year][month][day]['total'] = self.FETCH_DATA(year, month, day)
-                        time.sleep(FETCH_DELAY)
-                    elif action in (TSV, CSV):
-                        total = self.STORE[year][month][day]['total']
-                        total_all += total
-                        total_year += total
-                        total_month += total                                  
-                        if action == CSV:
-                            lines += '%s,%s,%s,%s\n'%(year, month, day, total)
-                        elif action == TSV:
-                            if SHOW_DAY:
-                                lines += '\t\t%s\t%s\n'%(day, total)
-          
-                # Output totals when needed
-                # -----------------------------------------
-                # For the month
-                if action == FETCH and LOG_FETCH:
-                    lines += ''
-                if action == TSV:
-                    if SHOW_DAY:
-                        lines += '%s\t%s\t\t\t%s\n'%(year, month, total_month)
-                    elif SHOW_MONTH:
-                        lines += '%s\t%s\t%s\n'%(year, month, total_month)
-                    
-            # For the year
-            if action == FETCH and LOG_FETCH:
-                print ''
-            elif action == TSV and hide not in ['month','day']:
-                lines += '%s\t\t\t\t\t%s\n'%(year, total_year)
-            elif action == TSV and hide == 'day':
-                lines += '%s\t\t\t%s\n'%(year, total_year)
-            elif action == TSV and hide == 'month':
-                lines += '%s\t%s\n'%(year, total_year)           
-        # For all years
-        if action == TSV:
-            if SHOW_MONTH and SHOW_DAY:
-                lines += 'Total\t\t\t\t\t\t%s\n'%total_all
-            elif SHOW_MONTH:
-                lines += 'Total\t\t\t\t%s\n'%total_all
-            elif not SHOW_MONTH and not SHOW_DAY:
-                lines += 'Total\t\t%s\n'%total_all
-        if not hide == 'month':
-            lines += header
-       
-        return lines
+            head = 'Year\tMonth\tDay\tDTotal\tMTotal\tYTotal\tTotal\n'
+        sums = self._sums()
+        yield head
+        for year, first, last, start_year, end_year in self.YEAR_SPANS:
+            if hide != 'month':
+                yield '%s\n'%year
+            for year, month, start, end in self.SPANS[first:last]:
+                total_month = sums[end]-sums[start]
+                if hide == 'day':
+                    yield '%s\t%s\t%s\n'%(year, month, total_month)
+                elif hide != 'month':
+                    yield '\t%s\n'%month
+                    for pos in range(start, end):
+                        yield '\t\t%s\t%s\n'%(self.DAYS[pos][2],
+                                               self.STORE[pos])
+                    yield '%s\t%s\t\t\t%s\n'%(year, month, total_month)
+            total_year = sums[end_year]-sums[start_year]
+            if hide == 'day':
+                yield '%s\t\t\t%s\n'%(year, total_year)
+            elif hide == 'month':
+                yield '%s\t%s\n'%(year, total_year)
+            else:
+                yield '%s\t\t\t\t\t%s\n'%(year, total_year)
+        if hide == 'day':
+            yield 'Total\t\t\t\t%s\n'%sums[-1]
+        elif hide == 'month':
+            yield 'Total\t\t%s\n'%sums[-1]
+        else:
+            yield 'Total\t\t\t\t\t\t%s\n'%sums[-1]
+        if hide != 'month':
+            yield head
+
+    def days(self):
+        '''Return a list of (year, month, day) for every day in the store.'''
+        return list(self.DAYS)
+
+    def set_total(self, year, month, day, total):
+        '''Store the total for a single day, e.g. from a bulk data source.'''
+        self.STORE[self.OFFSET[(year, month, day)]] = total
+
+    def get_total(self, year, month, day):
+        '''Return the total stored for a single day.'''
+        return self.STORE[self.OFFSET[(year, month, day)]]
 
     def fetch_data(self):
         '''Get the data from the source. It might make 1000s of calls.'''
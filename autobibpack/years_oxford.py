@@ -1,17 +1,29 @@
 import datetime
 import time
+import sys
+import urllib2
 import years
 import fetch
+import cache
 from sources import Ora, Datafinder8081, Datafinder8000
 
 #From schema
 #http://ora.ox.ac.uk:8080/solr/core_metadata/admin/file/?contentType=text/xml;charset=utf-8&file=schema.xml
 AVAILABLE_DATE_FIELDS = ['timestamp', 'creationDate', 'modifiedDate']
+FACET_METHODS = ('range', 'date') # facet.date for older Solr versions
+
+def count_memo(last):
+    '''Return the memo for counts of days up to last, None if still changing.
+    
+    Totals of the current month can go up, so they are always asked for.'''
+    if years.settled(last):
+        return fetch.COUNTS
+    return None
 
 class DateLoader(object):
     def __init__(self, name=None, endpoint=None,
                  field='timestamp', enable_get=False,
-                 start_year=None, end_year=None):
+                 start_year=None, end_year=None, use_facet=True):
         '''From endpoint use field to get data from start to end year, if enabled.'
         
         Configuring the DateLoader
@@ -26,6 +38,13 @@ class DateLoader(object):
         the process when the fetching process starts. This fetching process
         can hit the endpoint with 355/356 requests for each year required.
         
+        Faceting
+        --------
+        When use_facet is True the daily totals come from a single range
+        facet query for the whole of the years required. Sources that do
+        not support faceting are detected and fall back to the one request
+        per day data loader. Set use_facet to False to always do that.
+        
         Years required
         --------------
         The start year is the first year of data you wish to collect. It
@@ -71,9 +90,17 @@ class DateLoader(object):
         self.YEAR_END = end_year
         if not endpoint:
             self.END = Ora().ENDPOINT
-        if endpoint == 'datafinder':
+        elif endpoint == 'datafinder':
             self.END = Datafinder8081().ENDPOINT
             self.END = Datafinder8000().ENDPOINT
+        else: # the url of any other Solr source
+            self.END = endpoint
+        self.USE_FACET = use_facet # Try a facet query before daily queries.
+        self.LOADED_BY = '' # How the last fetch filled the store.
+        self.CACHE = None # A cache.ResponseCache for the queries made.
+        self.USE_BISECT = False # Count ranges when there is no faceting.
+        self.REQUESTS = 0 # Requests made by the last fetch.
+        self.RUN_LOG = dict() # Requests made against one for every day.
         self.ENABLE_GET_DOCUMENTS = enable_get # Force users to enable get.
                         
         self.reset()
@@ -87,65 +114,371 @@ class DateLoader(object):
         self.STATS.set_years(self.YEAR_START, self.YEAR_END)
         self.STATS.set_months(1, 12)
             
+    def set_cache(self, response_cache):
+        '''Keep the responses to queries in a cache.ResponseCache.'''
+        self.CACHE = response_cache
+
+    def set_checkpoint(self, path, every=years.CHECKPOINT_EVERY):
+        '''Save the days fetched one at a time to path to resume from.'''
+        key = '%s %s'%(self.END, self.FIELD)
+        self.STATS.set_checkpoint(path, key, every)
+
+    def set_scheduler(self, concurrency=1, rate=None, progress=None,
+                      adaptive=False):
+        '''Run day queries on concurrency threads, at most rate a second.
+        
+        The rate limit is shared by every loader using the same endpoint.
+        If adaptive, up to concurrency queries run at once as it copes.'''
+        self.STATS.set_scheduler(concurrency, rate, key=self.END,
+                                 progress=progress, adaptive=adaptive)
+
     def data_loader(self, year, month, day):
         '''Return the total of items with the same year, month and day.'''
-        self.SEARCH = fetch.Search(self.NAME)
-        self.SEARCH.set_endpoint(self.END)
-        # We might as well reduce the amount of data returned
-        self.SEARCH.set_rows(2) # only two items
-        self.SEARCH.set_field_getlist(('id',self.FIELD)) # and two fields
+        search = fetch.Search(self.NAME)
+        self.SEARCH = search # the last search, days may run in threads
+        search.set_endpoint(self.END)
+        if self.CACHE: # days that have finished can be kept for longer
+            ttl = cache.ttl_for_date((year, month, day))
+            search.set_cache(self.CACHE, ttl)
         # This data loader requires us to restrict the search by date       
-        wanted = self.SEARCH.format_date(year, month, day)
-        self.SEARCH.query_daterange(self.FIELD, wanted, wanted)
+        wanted = search.format_date(year, month, day)
+        search.query_daterange(self.FIELD, wanted, wanted)
         
-        # Now can get the data.
+        # Now can get the data, only the number found is needed.
         if self.ENABLE_GET_DOCUMENTS:
-            unused = self.SEARCH.get_documents() # execute the query 
-            return self.SEARCH.DOCS_FOUND
+            return search.count(count_memo((year, month, day)))
         else: # simulate with obviously wrong numbers
             return year+month+day+10000
     
+    def facet_loader(self):
+        '''Fill all days from one range facet query, False if unsupported.'''
+        daily = facet_days(self.NAME, self.END, [self.FIELD], self.YEAR_START,
+                           self.YEAR_END, self.CACHE)
+        if not daily or self.FIELD not in daily:
+            return False # the source rejected or ignored the facet query
+        self.fill_days(daily[self.FIELD])
+        return True
+
+    def fill_days(self, daily):
+        '''Fill the store from {(year, month, day): total}, missing days are 0.'''
+        for year, month, day in self.STATS.days():
+            total = daily.get((year, month, day), 0)
+            self.STATS.set_total(year, month, day, total)
+
+    def count_range(self, first, last):
+        '''Return how many items have a date from day first to last inclusive.'''
+        search = fetch.Search(self.NAME)
+        search.set_endpoint(self.END)
+        if self.CACHE:
+            search.set_cache(self.CACHE, cache.ttl_for_date(last))
+        search.query_daterange(self.FIELD, search.format_date(*first),
+                               search.format_date(*last))
+        found = search.count(count_memo(last))
+        self.REQUESTS += len(search.TRANSFERS)
+        return found
+
+    def bisect_loader(self):
+        '''Fill all days by counting ranges, only splitting those with items.
+        
+        A range with no items fills all its days with 0 from a single
+        request, so sparse fields cost far fewer requests than one a
+        day. The store leaves out some days, so only a range within one
+        month is known to be exact, and only then is the count for its
+        second half worked out from the first instead of asked for.'''
+        days = self.STATS.days()
+        starts = [start for year, month, start, end in self.STATS.SPANS]
+        def split(lo, hi, known):
+            total = known
+            if total is None:
+                total = self.count_range(days[lo], days[hi-1])
+            if total == 0:
+                for pos in range(lo, hi):
+                    self.STATS.set_total(*(days[pos]+(0,)))
+                return
+            if hi-lo == 1:
+                self.STATS.set_total(*(days[lo]+(total,)))
+                return
+            if days[lo][:2] == days[hi-1][:2]: # one month, nothing left out
+                mid = (lo+hi)//2
+                left = self.count_range(days[lo], days[mid-1])
+                split(lo, mid, left)
+                split(mid, hi, total-left)
+            else: # split at the start of the month nearest the middle
+                inside = [start for start in starts if lo < start < hi]
+                mid = min(inside, key=lambda start: abs(start-(lo+hi)//2))
+                split(lo, mid, None)
+                split(mid, hi, None)
+        if days:
+            split(0, len(days), None)
+
+    def set_bisect(self, use_bisect=True):
+        '''Count ranges of days, not every day, when faceting is not there.'''
+        self.USE_BISECT = use_bisect
+
     def fetch_stats(self, confirm=False):
         if confirm:
-            self.STATS.fetch_data()
+            self.REQUESTS = 0
+            if self.ENABLE_GET_DOCUMENTS and self.USE_FACET:
+                self.REQUESTS += 1
+                if self.facet_loader():
+                    self.LOADED_BY = 'facet'
+                    self.log_requests()
+                    return
+            self.fetch_unfaceted()
         else:
             print 'You need to actively confirm you want to fetch data.'
+
+    def fetch_unfaceted(self):
+        '''Fill the store without a facet query, by ranges or day by day.'''
+        if self.ENABLE_GET_DOCUMENTS and self.USE_BISECT:
+            self.bisect_loader()
+            self.LOADED_BY = 'bisect'
+        else:
+            self.STATS.fetch_data()
+            days = len(self.STATS.days())-self.STATS.LOADED_DAYS
+            self.REQUESTS += days
+            self.LOADED_BY = 'day'
+        self.log_requests()
+
+    def log_requests(self):
+        '''Record the requests made against one request for every day.'''
+        self.RUN_LOG = {'loaded by': self.LOADED_BY,
+                        'requests': self.REQUESTS,
+                        'per day requests': len(self.STATS.days())}
+        if self.LOADED_BY in ('day', 'shared day') and \
+           self.STATS.CONTROL is not None:
+            # how many days were asked for at once, see workers.Controller
+            self.RUN_LOG['concurrency'] = self.STATS.CONTROL.summary()
     
     def months(self):
         return self.STATS.show_months()
         
     def years(self):
         return self.STATS.show_years()
+
+    def write_months(self, outfile):
+        '''Write the monthly summary to outfile a line at a time.'''
+        self.STATS.write(outfile, 'pprint', 'day')
+
+    def write_years(self, outfile):
+        '''Write the yearly summary to outfile a line at a time.'''
+        self.STATS.write(outfile, 'pprint', 'month')
     
     def __str__(self):
         return self.STATS.show_years()
 
-def wiki_stat_make():
-    out = 'Generating ORA stats\n\n'
+def day_query(field, year, month, day):
+    '''Return the field:[range] clause DateLoader counts a day with.'''
+    search = fetch.Search()
+    wanted = search.format_date(year, month, day)
+    search.query_daterange(field, wanted, wanted)
+    return '%s:%s'%(field, search.QUERYCOLON[field])
+
+def facet_days(name, endpoint, fields, start_year, end_year, cache_to=None):
+    '''Return {field: {(year, month, day): total}} from one facet query.
+    
+    Every field is counted by the same request. Fields the source did
+    not count are missing, None is returned if it rejected the query.
+    Older Solr versions reject facet.range with a 400, so facet.date is
+    tried before giving up.'''
+    start = '%s-01-01T00:00:00Z'%start_year
+    end = '%s-01-01T00:00:00Z'%(end_year+1)
+    ranges = None
+    for method in FACET_METHODS:
+        search = fetch.Search(name)
+        search.set_endpoint(endpoint)
+        search.set_rows(0) # only the facet counts are needed
+        for field in fields:
+            search.set_facet_range(field, start, end, '+1DAY', method)
+        if cache_to:
+            ttl = cache.ttl_for_date((end_year, 12, 31))
+            search.set_cache(cache_to, ttl)
+        try:
+            ranges = search.get_facet_ranges()
+            break
+        except urllib2.HTTPError, error:
+            if error.code != 400:
+                return None # not a complaint about the facet method
+        except (ValueError, KeyError):
+            return None # the source garbled the facet query
+    if ranges is None:
+        return None # the source rejected every facet method
+    found = dict()
+    for field in ranges:
+        daily = found[field] = dict()
+        for bucket, total in ranges[field].items():
+            key = (int(bucket[0:4]), int(bucket[5:7]), int(bucket[8:10]))
+            daily[key] = total
+    return found
+
+class MultiDateLoader(object):
+    def __init__(self, name=None, endpoint=None,
+                 fields=AVAILABLE_DATE_FIELDS, enable_get=False,
+                 start_year=None, end_year=None, use_facet=True):
+        '''Collect the daily totals for several date fields at once.
+        
+        There is a DateLoader for each field in LOADERS. With use_facet
+        all the fields are counted by a single range facet query, so
+        three fields cost the same one request as one field. Fields the
+        source does not range facet share one request a day, with a
+        facet query for each field, or if the source does not answer
+        those either fall back to their own per day queries.
+        
+        Using the MultiDateLoader
+        =========================
+        m = MultiDateLoader('all', enable_get=True, start_year=2007)
+        m.fetch_stats(True)
+        print m.LOADERS['timestamp'].years()
+        '''
+        self.NAME = name
+        self.FIELDS = list(fields)
+        self.USE_FACET = use_facet
+        self.LOADERS = dict() # key = field, value = DateLoader
+        for field in self.FIELDS:
+            self.LOADERS[field] = DateLoader(name, endpoint, field, enable_get,
+                                             start_year, end_year, use_facet)
+        first = self.LOADERS[self.FIELDS[0]]
+        self.END = first.END
+        self.YEAR_START = first.YEAR_START
+        self.YEAR_END = first.YEAR_END
+        self.ENABLE_GET_DOCUMENTS = enable_get
+        self.CACHE = None
+
+    def set_cache(self, response_cache):
+        '''Keep the responses to queries in a cache.ResponseCache.'''
+        self.CACHE = response_cache
+        for field in self.FIELDS:
+            self.LOADERS[field].set_cache(response_cache)
+
+    def set_bisect(self, use_bisect=True):
+        '''Count ranges of days for fields the source does not facet.'''
+        for field in self.FIELDS:
+            self.LOADERS[field].set_bisect(use_bisect)
+
+    def set_scheduler(self, concurrency=1, rate=None, progress=None,
+                      adaptive=False):
+        '''Run any per day queries on threads, see DateLoader.set_scheduler.'''
+        for field in self.FIELDS:
+            self.LOADERS[field].set_scheduler(concurrency, rate, progress,
+                                              adaptive)
+
+    def fetch_stats(self, confirm=False):
+        '''Fill the store of every field, sharing the facet query.'''
+        if not confirm:
+            print 'You need to actively confirm you want to fetch data.'
+            return
+        daily = None
+        if self.ENABLE_GET_DOCUMENTS and self.USE_FACET:
+            daily = facet_days(self.NAME, self.END, self.FIELDS,
+                               self.YEAR_START, self.YEAR_END, self.CACHE)
+        left = list()
+        for field in self.FIELDS:
+            loader = self.LOADERS[field]
+            loader.REQUESTS = 0 # the facet request is shared
+            if daily and field in daily:
+                loader.fill_days(daily[field])
+                loader.LOADED_BY = 'facet'
+                loader.log_requests()
+            else:
+                left.append(field)
+        if len(left) > 1 and self.fetch_shared_days(left):
+            return
+        for field in left:
+            self.LOADERS[field].fetch_unfaceted()
+
+    def count_days(self, fields, year, month, day):
+        '''Return {field: total} for a day from one request for all fields.
+        
+        Each field is a facet query, None is returned if the source
+        rejected or ignored them.'''
+        search = fetch.Search(self.NAME)
+        search.set_endpoint(self.END)
+        search.set_rows(0)
+        if self.CACHE:
+            search.set_cache(self.CACHE, cache.ttl_for_date((year, month, day)))
+        queries = dict((field, day_query(field, year, month, day))
+                       for field in fields)
+        for query in queries.values():
+            search.add_facet_query(query)
+        try:
+            counts = search.get_facet_queries()
+        except (urllib2.HTTPError, ValueError, KeyError):
+            return None
+        if not counts or any(query not in counts for query in queries.values()):
+            return None
+        return dict((field, counts[query]) for field, query in queries.items())
+
+    def fetch_shared_days(self, fields):
+        '''Fill the days of fields with one request a day for all of them.
+        
+        The first field's scheduler runs the days. False is returned, and
+        nothing filled, if the source does not answer facet queries, or
+        if the fields count ranges or resume from checkpoints on their own.'''
+        loaders = [self.LOADERS[field] for field in fields]
+        if not self.ENABLE_GET_DOCUMENTS or \
+           any(loader.USE_BISECT or loader.STATS.CHECKPOINT
+               for loader in loaders):
+            return False
+        stats = loaders[0].STATS
+        days = stats.days()
+        first = days and self.count_days(fields, *days[0])
+        if not first:
+            return False
+        found = {days[0]: first} # the day that asked, so it is not asked again
+        def load(year, month, day):
+            totals = found.pop((year, month, day), None) or \
+                     self.count_days(fields, year, month, day)
+            if totals is None:
+                raise IOError('no facet query counts for %s-%s-%s'%(year,
+                              month, day))
+            for field, loader in zip(fields[1:], loaders[1:]):
+                loader.STATS.set_total(year, month, day, totals[field])
+            return totals[fields[0]]
+        loader_for_one = stats.FETCH_DATA
+        stats.FETCH_DATA = load
+        try:
+            stats.fetch_data()
+        finally:
+            stats.FETCH_DATA = loader_for_one
+        loaders[0].REQUESTS = len(days)
+        for loader in loaders:
+            loader.LOADED_BY = 'shared day'
+            loader.log_requests()
+        return True
+
+def wiki_stat_make(outfile=None):
+    '''Write the year and month summaries for every date field to outfile.
+    
+    The output goes to standard output unless outfile is given, it can
+    be a file opened with output.open_output to save it compressed.'''
+    if outfile is None:
+        outfile = sys.stdout
+    outfile.write('Generating ORA stats\n\n')
     start_total_time = time.time()
     time_log = list()
     
+    # All the fields are fetched together so they can share requests.
+    print 'Doing %s' %', '.join(AVAILABLE_DATE_FIELDS)
+    multi = MultiDateLoader(enable_get=True, start_year=2007)
+    multi.fetch_stats(True)
+    entry = '%s = time taken to fetch all fields'%(time.time()-start_total_time)
+    time_log.append(entry)
     for fieldname in AVAILABLE_DATE_FIELDS:
-        start_time = time.time()
-        print 'Doing %s' %fieldname
-        out += '===================================\n'
-        out += 'Field: %s\n'%str(fieldname).upper()
-        out += '===================================\n'
-        ost = DateLoader(enable_get=True, field=fieldname, start_year=2007)
-        ost.fetch_stats(True)
-        out += '-----------------------------------\n'
-        out += 'Summary by year\n'
-        out += '-----------------------------------\n'
-        out += ost.years()
-        out += '-----------------------------------\n'
-        out += '\nSummary by month\n'
-        out += '-----------------------------------\n'
-        out += ost.months()
-        out += '\n'
-        end_time = time.time()
-        entry = '%s = time taken for field: %s'%(end_time-start_time, fieldname)
+        ost = multi.LOADERS[fieldname]
+        outfile.write('===================================\n')
+        outfile.write('Field: %s\n'%str(fieldname).upper())
+        outfile.write('===================================\n')
+        outfile.write('-----------------------------------\n')
+        outfile.write('Summary by year\n')
+        outfile.write('-----------------------------------\n')
+        ost.write_years(outfile)
+        outfile.write('-----------------------------------\n')
+        outfile.write('\nSummary by month\n')
+        outfile.write('-----------------------------------\n')
+        ost.write_months(outfile)
+        outfile.write('\n')
+        entry = '%s = how field %s was loaded'%(ost.LOADED_BY, fieldname)
         time_log.append(entry)
-    print out
     for log in time_log:
         print log
     end_total_time = time.time()
@@ -162,9 +495,11 @@ def datafindersingleembago():
     dfield = 'embargoedUntilDate'    
     ost = DateLoader(enable_get=True, start_year=2082, end_year=2082,
                      endpoint='datafinder', field=dfield)
+    ost.set_bisect() # almost every day is empty
     ost.fetch_stats(True)
     print ost.years()
     print ost.months()
+    print ost.RUN_LOG
     
 
 if __name__ == '__main__':
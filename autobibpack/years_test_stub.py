@@ -0,0 +1,387 @@
+'''Test the DateLoader against a local stub Solr.
+
+These tests do not need a network connection so they can be run
+anywhere, and they check the facet and per day loaders agree.'''
+import unittest
+import tempfile
+import shutil
+import gzip
+import os
+import StringIO
+import random
+import time
+import threading
+import workers
+import datetime
+import stubsolr
+import years_oxford
+import fetch
+import years
+
+class TestDateLoaderFacet(unittest.TestCase):
+    '''Check the facet loader fills the store the same as daily queries.'''
+    def setUp(self):
+        self.YEAR = 2012
+        self.FIELD = 'creationDate'
+        self.DOCS = stubsolr.make_corpus(300, self.YEAR, self.YEAR)
+        self.STUB = stubsolr.StubSolr(self.DOCS).start()
+        fetch.COUNTS.clear() # counts from other tests' stubs on this port
+
+    def tearDown(self):
+        self.STUB.stop()
+        fetch.COUNTS.clear()
+
+    def do_loader(self, use_facet, stub=None):
+        stub = stub or self.STUB
+        loader = years_oxford.DateLoader('stub', stub.ENDPOINT, self.FIELD,
+                        True, self.YEAR, self.YEAR, use_facet)
+        loader.fetch_stats(True)
+        return loader
+
+    def test100_facet_one_request(self):
+        loader = self.do_loader(True)
+        self.assertEqual(loader.LOADED_BY, 'facet')
+        self.assertEqual(self.STUB.REQUESTS, 1)
+
+    def test105_facet_same_as_daily(self):
+        facet = self.do_loader(True).STATS.raw_data()
+        daily = self.do_loader(False)
+        self.assertEqual(daily.LOADED_BY, 'day')
+        self.assertEqual(facet, daily.STATS.raw_data())
+
+    def test110_fallback_without_facet(self):
+        stub = stubsolr.StubSolr(self.DOCS, facet=False).start()
+        try:
+            loader = self.do_loader(True, stub)
+        finally:
+            stub.stop()
+        self.assertEqual(loader.LOADED_BY, 'day')
+        expected = self.do_loader(True).STATS.raw_data()
+        self.assertEqual(expected, loader.STATS.raw_data())
+
+    def test115_repeat_counts_free(self):
+        first = self.do_loader(False)
+        before = self.STUB.REQUESTS
+        again = self.do_loader(False)
+        self.assertEqual(self.STUB.REQUESTS, before)
+        self.assertEqual(first.STATS.raw_data(), again.STATS.raw_data())
+
+    def test120_current_month_asked_again(self):
+        today = time.gmtime()[:3]
+        loader = years_oxford.DateLoader('stub', self.STUB.ENDPOINT,
+                        self.FIELD, True, today[0], today[0], False)
+        before = self.STUB.REQUESTS
+        for count in range(2):
+            loader.data_loader(*today)
+        self.assertEqual(self.STUB.REQUESTS-before, 2)
+
+    def test125_adaptive_days(self):
+        loader = years_oxford.DateLoader('stub', self.STUB.ENDPOINT,
+                        self.FIELD, True, self.YEAR, self.YEAR, False)
+        loader.set_scheduler(4, adaptive=True)
+        loader.fetch_stats(True)
+        self.assertEqual(loader.STATS.raw_data(),
+                         self.do_loader(True).STATS.raw_data())
+        adapted = loader.RUN_LOG['concurrency']
+        self.assertTrue(1 <= adapted['settled'] <= 4)
+
+class TestDateLoaderBisect(unittest.TestCase):
+    '''Check counting ranges gives the same days as daily queries.'''
+    def setUp(self):
+        fetch.COUNTS.clear() # counts from other tests' stubs on this port
+
+    def tearDown(self):
+        fetch.COUNTS.clear()
+
+    def do_loaders(self, size):
+        docs = stubsolr.make_corpus(size, 2011, 2012)
+        stub = stubsolr.StubSolr(docs, facet=False).start()
+        found = list()
+        try:
+            for use_bisect in (False, True):
+                loader = years_oxford.DateLoader('stub', stub.ENDPOINT,
+                                    'creationDate', True, 2011, 2012)
+                loader.set_bisect(use_bisect)
+                loader.fetch_stats(True)
+                found.append(loader)
+        finally:
+            stub.stop()
+        self.assertEqual(found[0].STATS.raw_data(), found[1].STATS.raw_data())
+        self.assertEqual(found[1].LOADED_BY, 'bisect')
+        return found
+
+    def test100_sparse(self):
+        daily, ranges = self.do_loaders(6)
+        days = len(daily.STATS.days())
+        self.assertEqual(daily.RUN_LOG['requests'], days+1) # and the facet
+        self.assertEqual(ranges.RUN_LOG['per day requests'], days)
+        self.assertLess(ranges.RUN_LOG['requests'], days/5)
+
+    def test105_dense(self):
+        self.do_loaders(400)
+
+class TestMultiDateLoader(unittest.TestCase):
+    '''Check several fields share requests and match single loaders.'''
+    def setUp(self):
+        self.YEAR = 2012
+        self.DOCS = stubsolr.make_corpus(300, self.YEAR, self.YEAR)
+        self.STUB = stubsolr.StubSolr(self.DOCS).start()
+        fetch.COUNTS.clear() # counts from other tests' stubs on this port
+
+    def tearDown(self):
+        self.STUB.stop()
+        fetch.COUNTS.clear()
+
+    def do_multi(self, fields, stub=None):
+        stub = stub or self.STUB
+        multi = years_oxford.MultiDateLoader('stub', stub.ENDPOINT, fields,
+                                             True, self.YEAR, self.YEAR)
+        multi.fetch_stats(True)
+        return multi
+
+    def test100_one_request(self):
+        multi = self.do_multi(years_oxford.AVAILABLE_DATE_FIELDS)
+        self.assertEqual(self.STUB.REQUESTS, 1)
+        for field in years_oxford.AVAILABLE_DATE_FIELDS:
+            single = years_oxford.DateLoader('stub', self.STUB.ENDPOINT,
+                                    field, True, self.YEAR, self.YEAR, False)
+            single.fetch_stats(True)
+            self.assertEqual(multi.LOADERS[field].LOADED_BY, 'facet')
+            self.assertEqual(multi.LOADERS[field].STATS.raw_data(),
+                             single.STATS.raw_data())
+
+    def test105_single_field(self):
+        self.do_multi(['timestamp'])
+        self.assertEqual(self.STUB.REQUESTS, 1)
+
+    def test110_fallback_without_facet(self):
+        fields = ['timestamp', 'creationDate']
+        expected = self.do_multi(fields)
+        stub = stubsolr.StubSolr(self.DOCS, facet=False).start()
+        try:
+            multi = self.do_multi(fields, stub)
+        finally:
+            stub.stop()
+        for field in fields:
+            self.assertEqual(multi.LOADERS[field].LOADED_BY, 'day')
+            self.assertEqual(multi.LOADERS[field].STATS.raw_data(),
+                             expected.LOADERS[field].STATS.raw_data())
+
+    def test112_date_facet(self):
+        fields = ['timestamp', 'creationDate']
+        expected = self.do_multi(fields)
+        stub = stubsolr.StubSolr(self.DOCS, facet=('date',)).start()
+        try:
+            multi = self.do_multi(fields, stub)
+            requests = stub.REQUESTS
+        finally:
+            stub.stop()
+        self.assertEqual(requests, 2) # facet.range refused, then facet.date
+        for field in fields:
+            self.assertEqual(multi.LOADERS[field].LOADED_BY, 'facet')
+            self.assertEqual(multi.LOADERS[field].STATS.raw_data(),
+                             expected.LOADERS[field].STATS.raw_data())
+
+    def test115_shared_days(self):
+        fields = ['timestamp', 'creationDate', 'modifiedDate']
+        expected = self.do_multi(fields)
+        stub = stubsolr.StubSolr(self.DOCS, facet=('query',)).start()
+        try:
+            multi = self.do_multi(fields, stub)
+            requests = stub.REQUESTS
+        finally:
+            stub.stop()
+        days = len(multi.LOADERS['timestamp'].STATS.days())
+        # range and date facets refused, then one a day for all the fields
+        self.assertEqual(requests, 2+days)
+        for field in fields:
+            self.assertEqual(multi.LOADERS[field].LOADED_BY, 'shared day')
+            self.assertEqual(multi.LOADERS[field].STATS.raw_data(),
+                             expected.LOADERS[field].STATS.raw_data())
+
+class TestStatMakeStore(unittest.TestCase):
+    '''Check the totals and layout of the StatMake output.'''
+    def setUp(self):
+        self.STATS = years.StatMake()
+        self.STATS.set_years(2013, 2013)
+        self.STATS.set_months(1, 2)
+        for count, (year, month, day) in enumerate(self.STATS.days()):
+            self.STATS.set_total(year, month, day, count)
+
+    def test100_days(self):
+        days = self.STATS.days()
+        self.assertEqual(len(days), 30+27) # the last day is not stored
+        self.assertEqual(days[30], (2013, 2, 1))
+        self.assertEqual(self.STATS.get_total(2013, 2, 1), 30)
+        self.assertRaises(KeyError, self.STATS.set_total, 2013, 3, 1, 1)
+
+    def test105_show_months(self):
+        self.assertEqual(self.STATS.show_months(),
+                         'Year\tMonth\tMTotal\tYTotal\tTotal\n'
+                         '2013\n2013\t1\t435\n2013\t2\t1161\n'
+                         '2013\t\t\t1596\nTotal\t\t\t\t1596\n'
+                         'Year\tMonth\tMTotal\tYTotal\tTotal\n')
+        self.assertEqual(self.STATS.show_years(),
+                         'Year\tYTotal\tTotal\n2013\t1596\nTotal\t\t1596\n')
+
+    def test110_raw_data(self):
+        lines = self.STATS.raw_data().splitlines()
+        self.assertEqual(lines[0], 'year,month,day,total')
+        self.assertEqual(lines[31], '2013,2,1,30')
+        self.assertEqual(lines[-1], lines[0])
+        self.assertEqual(len(lines), 57+2)
+
+    def test115_write_streamed(self):
+        outfile = StringIO.StringIO()
+        self.STATS.write(outfile, 'pprint', 'day')
+        self.assertEqual(outfile.getvalue(), self.STATS.show_months())
+        root = tempfile.mkdtemp()
+        try:
+            path = os.path.join(root, 'days.csv.gz')
+            self.STATS.save(path, 'rawdata')
+            infile = gzip.open(path)
+            self.assertEqual(infile.read(), self.STATS.raw_data())
+            infile.close()
+        finally:
+            shutil.rmtree(root)
+
+class TestStatMakeScheduler(unittest.TestCase):
+    '''Check concurrent, rate limited fetching fills the store the same.'''
+    def setUp(self):
+        self.LOCK = threading.Lock()
+        self.CALLS = dict()
+
+    def loader(self, year, month, day):
+        '''Return a fixed total after a random wait, failing first calls.'''
+        with self.LOCK:
+            calls = self.CALLS[(year, month, day)] = \
+                self.CALLS.get((year, month, day), 0)+1
+        time.sleep(random.random()*0.002)
+        if day % 7 == 0 and calls == 1:
+            raise IOError('flaky day')
+        return year*10000+month*100+day
+
+    def do_fetch(self, concurrency=1, rate=None, progress=None):
+        stats = years.StatMake(self.loader)
+        stats.set_years(2012, 2012)
+        stats.set_months(1, 3)
+        stats.set_scheduler(concurrency, rate, progress=progress)
+        stats.fetch_data()
+        return stats
+
+    def test100_concurrent_same(self):
+        serial = self.do_fetch().raw_data()
+        self.CALLS = dict()
+        self.assertEqual(serial, self.do_fetch(8).raw_data())
+        self.assertEqual(self.CALLS[(2012, 1, 7)], 2) # retried once
+
+    def test105_progress(self):
+        seen = list()
+        def progress(done, total, day, error):
+            seen.append((done, total, day, error is None))
+        stats = self.do_fetch(4, progress=progress)
+        total = len(stats.days())
+        worked = [entry for entry in seen if entry[3]]
+        self.assertEqual(len(worked), total)
+        self.assertEqual(sorted(e[0] for e in worked), range(1, total+1))
+        self.assertEqual(len(seen)-total, len([d for d in stats.days()
+                                               if d[2] % 7 == 0]))
+
+    def test110_rate_limit(self):
+        bucket = workers.TokenBucket(200)
+        start = time.time()
+        workers.map_ordered(lambda item: item, range(41), 8, limit=bucket)
+        self.assertGreater(time.time()-start, 0.19) # 40 waits of 1/200s
+        self.assertTrue(workers.bucket_for('a', 10) is
+                        workers.bucket_for('a', 20))
+
+    def test115_loader_concurrent(self):
+        docs = stubsolr.make_corpus(200, 2012, 2012)
+        stub = stubsolr.StubSolr(docs).start()
+        try:
+            found = list()
+            for concurrency in (1, 6):
+                loader = years_oxford.DateLoader('stub', stub.ENDPOINT,
+                                        'timestamp', True, 2012, 2012, False)
+                loader.set_scheduler(concurrency, 1000)
+                loader.fetch_stats(True)
+                found.append(loader.STATS.raw_data())
+        finally:
+            stub.stop()
+        self.assertEqual(found[0], found[1])
+
+class TestStatMakeCheckpoint(unittest.TestCase):
+    '''Check an interrupted fetch resumes from its checkpoint.'''
+    def setUp(self):
+        self.ROOT = tempfile.mkdtemp()
+        self.PATH = os.path.join(self.ROOT, 'days.json')
+        self.CALLS = list()
+        self.FAIL_AFTER = None
+
+    def tearDown(self):
+        shutil.rmtree(self.ROOT)
+
+    def loader(self, year, month, day):
+        if self.FAIL_AFTER is not None and len(self.CALLS) >= self.FAIL_AFTER:
+            raise IOError('source went away')
+        self.CALLS.append((year, month, day))
+        return year+month*31+day
+
+    def make_stats(self, start, end, key='one'):
+        stats = years.StatMake(self.loader)
+        stats.set_years(start, end)
+        stats.set_scheduler(retries=0)
+        stats.set_checkpoint(self.PATH, key, every=25)
+        return stats
+
+    def test100_resume(self):
+        self.FAIL_AFTER = 60
+        stats = self.make_stats(2011, 2012)
+        self.assertRaises(IOError, stats.fetch_data)
+        self.FAIL_AFTER = None
+        self.CALLS = list()
+        again = self.make_stats(2011, 2012)
+        again.fetch_data()
+        self.assertEqual(again.LOADED_DAYS, 60)
+        self.assertEqual(len(self.CALLS), len(again.days())-60)
+        self.assertEqual(self.CALLS[0], again.days()[60])
+        whole = years.StatMake(self.loader)
+        whole.set_years(2011, 2012)
+        whole.fetch_data()
+        self.assertEqual(again.raw_data(), whole.raw_data())
+
+    def test105_refetch_changing(self):
+        year = datetime.date.today().year
+        self.make_stats(year-1, year).fetch_data()
+        self.CALLS = list()
+        stats = self.make_stats(year-1, year)
+        stats.fetch_data()
+        changing = [day for day in stats.days() if not years.settled(day)]
+        self.assertEqual(self.CALLS, changing)
+        self.assertEqual(stats.LOADED_DAYS, len(stats.days())-len(changing))
+
+    def test110_other_key(self):
+        self.make_stats(2012, 2012).fetch_data()
+        self.CALLS = list()
+        stats = self.make_stats(2012, 2012, 'two')
+        stats.fetch_data()
+        self.assertEqual(stats.LOADED_DAYS, 0)
+        self.assertEqual(len(self.CALLS), len(stats.days()))
+
+# ===============================================================
+#  Enable use of these tests by external script.
+# ===============================================================
+SUITE_NAME = str(__name__)
+TESTS_AVAILABLE = [TestDateLoaderFacet, TestDateLoaderBisect,
+                   TestMultiDateLoader,
+                   TestStatMakeStore, TestStatMakeScheduler,
+                   TestStatMakeCheckpoint]
+def suite(tests=TESTS_AVAILABLE):
+    '''Return a test suite of tests so this can run run by external script.'''
+    suite  = unittest.TestSuite()
+    for test in tests:
+        suite.addTests(unittest.TestLoader().loadTestsFromTestCase(test))
+    return suite 
+    
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())